@@ -0,0 +1,6 @@
+"""
+可以重复运行的基准测试，不需要网络，服务端都是 stand_ins 中本进程内的替身，结果输出成json，方便对比不同版本。
+
+python -m benchmarks.run --output result.json
+python -m benchmarks.compare old_result.json result.json
+"""
@@ -0,0 +1,221 @@
+import concurrent.futures
+import itertools
+import threading
+from http.client import HTTPConnection
+
+from universal_object_pool import ObjectPool
+from benchmarks.measure import run_scenario, timed_borrow
+from benchmarks import stand_ins
+
+"""
+contrib 中每种对象池对比 池化 和 每次临时创建连接 ，服务端用 stand_ins 中本进程内的替身，不需要网络。
+contrib 依赖的三方包在各个函数里面才导入，没安装的 suite 由 run.py 记录为跳过。
+"""
+
+
+def bench_http(quick=False, host=None, port=None):
+    """
+    :param host: 不传则启动本进程内的 http 替身服务。也可以先运行 tests_object_pool/aio_server.py ，传 127.0.0.1 5678 测它。
+    """
+    from universal_object_pool.contrib.http_pool import HttpOperator, request_batch
+
+    shutdown = None
+    if host is None:
+        host, port, shutdown = stand_ins.start_http_server()
+    results = []
+    op_num = 2000 if quick else 20000
+    for pool_size, thread_num in ((10, 10), (50, 50)):
+        def setup():
+            pool = ObjectPool(HttpOperator, object_pool_size=pool_size, object_init_kwargs=dict(host=host, port=port), is_pool_log_enabled=False)
+            return (lambda: timed_borrow(pool, HttpOperator.request_and_getresponse, 'GET', '/')), (lambda: None)
+
+        results.append(run_scenario('http', 'pooled_keep_alive', setup, thread_num, op_num, pool_size=pool_size))
+
+    def setup_new_connection():
+        def work():
+            conn = HTTPConnection(host, port)
+            conn.request('GET', '/', headers={'Connection': 'close'})
+            conn.getresponse().read()
+            conn.close()
+
+        return work, (lambda: None)
+
+    results.append(run_scenario('http', 'new_connection_every_request', setup_new_connection, 50, op_num))
+
+    batch_size = 100
+
+    def setup_batch():
+        pool = ObjectPool(HttpOperator, object_pool_size=50, object_init_kwargs=dict(host=host, port=port), is_pool_log_enabled=False)
+        return (lambda: request_batch(pool, [('GET', '/')] * batch_size) and None), (lambda: None)
+
+    results.append(run_scenario('http', 'request_batch', setup_batch, 1, op_num // batch_size, pool_size=50, batch_size=batch_size))
+    if shutdown:
+        shutdown()
+    return results
+
+
+def bench_pymysql(quick=False):
+    import pymysql
+    from universal_object_pool.contrib.pymysql_pool import PyMysqlOperator, PyMysqlBatchWriter, stream_query
+
+    host, port, shutdown = stand_ins.start_mysql_server()
+    conn_kwargs = dict(host=host, port=port, user='root', password='123456')
+    sql = 'INSERT INTO db1.table1(uname ,age) VALUES(%s ,%s) ON DUPLICATE KEY UPDATE uname = values(uname), age = values(age)'
+    results = []
+    op_num = 2000 if quick else 20000
+    for pool_size, thread_num in ((10, 10), (50, 50)):
+        def setup():
+            pool = ObjectPool(PyMysqlOperator, object_pool_size=pool_size, object_init_kwargs=conn_kwargs, is_pool_log_enabled=False)
+            return (lambda: timed_borrow(pool, PyMysqlOperator.execute, sql, ('name', 1))), (lambda: None)
+
+        results.append(run_scenario('pymysql', 'pooled_execute', setup, thread_num, op_num, pool_size=pool_size))
+
+    def setup_new_connection():
+        def work():
+            conn = pymysql.connect(**conn_kwargs)
+            with conn.cursor() as cursor:
+                cursor.execute(sql, ('name', 1))
+            conn.commit()
+            conn.close()
+
+        return work, (lambda: None)
+
+    results.append(run_scenario('pymysql', 'new_connection_every_execute', setup_new_connection, 50, op_num // 5))
+
+    def setup_batch_writer():
+        pool = ObjectPool(PyMysqlOperator, object_pool_size=10, object_init_kwargs=conn_kwargs, is_pool_log_enabled=False)
+        batch_writer = PyMysqlBatchWriter(pool, batch_size=100, flush_interval_seconds=0.005)
+        return (lambda: batch_writer.write(sql, ('name', 1)).result() and None), batch_writer.shutdown
+
+    results.append(run_scenario('pymysql', 'batch_writer', setup_batch_writer, 50, op_num, pool_size=10, batch_size=100))
+    shutdown()
+
+    # 流式读取的内存峰值和结果集行数无关，一次 fetchall 的内存峰值随行数增长。
+    row_num = 20000 if quick else 200000
+    host, port, shutdown = stand_ins.start_mysql_server(select_row_num=row_num)
+    conn_kwargs.update(host=host, port=port)
+
+    def setup_stream():
+        pool = ObjectPool(PyMysqlOperator, object_pool_size=1, object_init_kwargs=conn_kwargs, is_pool_log_enabled=False)
+
+        def work():
+            for _ in stream_query(pool, 'SELECT c1 FROM t', chunk_size=1000):
+                pass
+
+        return work, (lambda: None)
+
+    def setup_fetchall():
+        pool = ObjectPool(PyMysqlOperator, object_pool_size=1, object_init_kwargs=conn_kwargs, is_pool_log_enabled=False)
+        return (lambda: timed_borrow(pool, lambda op: op.execute('SELECT c1 FROM t', None) and op.fetchall())), (lambda: None)
+
+    results.append(run_scenario('pymysql', 'stream_query', setup_stream, 1, 3, memory_op_num=1, row_num=row_num, chunk_size=1000))
+    results.append(run_scenario('pymysql', 'fetchall', setup_fetchall, 1, 3, memory_op_num=1, row_num=row_num))
+    shutdown()
+    return results
+
+
+def bench_pika(quick=False):
+    import pika
+    from universal_object_pool.contrib.pika_pool import PikaOperator, PikaBatchPublisher
+
+    host, port, shutdown = stand_ins.start_amqp_server()
+    init_kwargs = dict(host=host, port=port, user='guest', password='guest', queue='bench_queue')
+    results = []
+    op_num = 5000 if quick else 50000
+    for pool_size, thread_num in ((10, 10), (10, 50)):
+        def setup():
+            pool = ObjectPool(PikaOperator, object_pool_size=pool_size, object_init_kwargs=init_kwargs, is_pool_log_enabled=False)
+            return (lambda: timed_borrow(pool, PikaOperator.simple_publish, 'hello')), (lambda: None)
+
+        results.append(run_scenario('pika', 'pooled_publish', setup, thread_num, op_num, pool_size=pool_size))
+
+    def setup_new_connection():
+        def work():
+            connection = pika.BlockingConnection(pika.ConnectionParameters(
+                host=host, port=port, credentials=pika.PlainCredentials('guest', 'guest')))
+            channel = connection.channel()
+            channel.basic_publish(exchange='', routing_key='bench_queue', body='hello')
+            connection.close()
+
+        return work, (lambda: None)
+
+    results.append(run_scenario('pika', 'new_connection_every_publish', setup_new_connection, 10, op_num // 50))
+
+    def setup_batch_publisher():
+        pool = ObjectPool(PikaOperator, object_pool_size=10, object_init_kwargs=init_kwargs, is_pool_log_enabled=False)
+        batch_publisher = PikaBatchPublisher(pool, batch_size=200, flush_interval_seconds=0.005)
+        return (lambda: batch_publisher.publish('hello').result()), batch_publisher.shutdown
+
+    results.append(run_scenario('pika', 'batch_publisher_confirmed', setup_batch_publisher, 50, op_num, pool_size=10, batch_size=200))
+    shutdown()
+    return results
+
+
+def bench_paramiko(quick=False):
+    from universal_object_pool.contrib.paramiko_pool import ParamikoOperator
+
+    host, port, shutdown = stand_ins.start_ssh_server()
+    init_kwargs = dict(host=host, port=port, username='root', password='123456')
+    results = []
+    op_num = 100 if quick else 1000
+
+    def _exec(operator):
+        stdin, stdout, stderr = operator.ssh.exec_command('date')
+        stdout.read()
+
+    def setup():
+        pool = ObjectPool(ParamikoOperator, object_pool_size=10, object_init_kwargs=init_kwargs, is_pool_log_enabled=False)
+        return (lambda: timed_borrow(pool, _exec)), (lambda: None)
+
+    results.append(run_scenario('paramiko', 'pooled_exec_command', setup, 10, op_num, pool_size=10))
+
+    def setup_multiplex():
+        from universal_object_pool import MultiplexObjectPool
+        pool = MultiplexObjectPool(ParamikoOperator, object_pool_size=2, object_init_kwargs=init_kwargs, is_pool_log_enabled=False)
+        return (lambda: timed_borrow(pool, lambda op: list(op.iter_exec_cmd('date')))), (lambda: None)
+
+    results.append(run_scenario('paramiko', 'multiplex_iter_exec_cmd', setup_multiplex, 10, op_num, pool_size=2, max_sessions=10))
+
+    def setup_new_connection():
+        def work():
+            operator = ParamikoOperator(**init_kwargs)
+            _exec(operator)
+            operator.clean_up()
+
+        return work, (lambda: None)
+
+    results.append(run_scenario('paramiko', 'new_connection_every_exec', setup_new_connection, 10, op_num // 10))
+    shutdown()
+    return results
+
+
+def bench_threadpool(quick=False):
+    """ 提交 op_num 个很小的任务，从第一次提交到最后一个任务执行完、线程池 shutdown 的耗时。"""
+    from universal_object_pool.contrib.threadpool_using_object_pool import ThreadObjectPool
+
+    results = []
+    op_num = 10000 if quick else 100000
+
+    def _make_setup(executor_factory):
+        def setup():
+            executor = executor_factory()
+            counter = itertools.count(1)
+            all_done_event = threading.Event()
+
+            def _task():
+                if next(counter) == op_num:
+                    all_done_event.set()
+
+            def teardown():
+                all_done_event.wait()
+                executor.shutdown(wait=True)
+
+            return (lambda: executor.submit(_task) and None), teardown
+
+        return setup
+
+    for name, executor_factory in (('thread_object_pool', lambda: ThreadObjectPool(100)),
+                                   ('stdlib_thread_pool_executor', lambda: concurrent.futures.ThreadPoolExecutor(100))):
+        results.append(run_scenario('threadpool', name, _make_setup(executor_factory), 1, op_num, memory_op_num=op_num,
+                                    is_include_teardown=True, pool_size=100))
+    return results
@@ -0,0 +1,131 @@
+import random
+import threading
+import time
+
+from universal_object_pool import (ObjectPool, AbstractObject, MultiplexObjectPool, KeyedObjectPool, AsyncObjectPool,
+                                   AbstractAsyncObject)
+from benchmarks.measure import run_scenario, timed_borrow, async_timed_borrow
+
+"""
+对象池本身的开销，对象什么都不做，测不同对象池大小和线程数下每秒借还次数和借用耗时。
+以及 mock_spend_time_object_use_object_pool.py 中 对象池 vs 每次临时创建对象 vs 全局对象加锁 的对比(耗时按比例缩小了)。
+"""
+
+
+class NoopObject(AbstractObject):
+    def __init__(self, key=None):
+        pass
+
+    def clean_up(self):
+        pass
+
+    def before_back_to_queue(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class SharedNoopObject(NoopObject):
+    max_concurrent_borrowers = 4
+
+
+class AsyncNoopObject(AbstractAsyncObject):
+    def __init__(self):
+        pass
+
+    async def clean_up(self):
+        pass
+
+    async def before_back_to_queue(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def _noop(obj):
+    pass
+
+
+async def _async_noop(obj):
+    pass
+
+
+def bench_object_pool(quick=False):
+    results = []
+    op_num = 20000 if quick else 200000
+    for pool_size in (1, 10, 50):
+        for thread_num in (1, 10, 50):
+            def setup():
+                pool = ObjectPool(NoopObject, object_pool_size=pool_size, is_pool_log_enabled=False)
+                return (lambda: timed_borrow(pool, _noop)), (lambda: None)
+
+            results.append(run_scenario('pool', 'object_pool_noop', setup, thread_num, op_num, pool_size=pool_size))
+
+    for thread_num in (10, 50):
+        def setup():
+            pool = MultiplexObjectPool(SharedNoopObject, object_pool_size=10, is_pool_log_enabled=False)
+            return (lambda: timed_borrow(pool, _noop)), (lambda: None)
+
+        results.append(run_scenario('pool', 'multiplex_pool_noop', setup, thread_num, op_num, pool_size=10, max_concurrent_borrowers=4))
+
+    for thread_num in (10, 50):
+        def setup():
+            pool = KeyedObjectPool(NoopObject, max_num_per_key=10, max_total_num=50, is_pool_log_enabled=False)
+            return (lambda: timed_borrow_keyed(pool, (random.randrange(10),))), (lambda: None)
+
+        results.append(run_scenario('pool', 'keyed_pool_noop', setup, thread_num, op_num, key_num=10, max_num_per_key=10, max_total_num=50))
+
+    for coroutine_num in (10, 100):
+        def setup():
+            pool = AsyncObjectPool(AsyncNoopObject, object_pool_size=10, is_pool_log_enabled=False)
+            return (lambda: async_timed_borrow(pool, _async_noop)), pool.close
+
+        results.append(run_scenario('pool', 'async_pool_noop', setup, coroutine_num, op_num, is_async=True, pool_size=10))
+    return results
+
+
+def timed_borrow_keyed(pool: KeyedObjectPool, key):
+    t0 = time.perf_counter()
+    with pool.get(key) as obj:
+        borrow_seconds = time.perf_counter() - t0
+        _noop(obj)
+    return borrow_seconds
+
+
+class SpendTimeObject(AbstractObject):
+    """ 和 MockSpendTimeObject 一样创建耗时又耗cpu，同一个对象的操作是排他的，耗时缩小了。"""
+
+    def __init__(self):
+        time.sleep(0.01)
+        s = 0
+        for j in range(200000):
+            s += j
+        self._lock = threading.Lock()
+
+    def do_sth(self):
+        with self._lock:
+            time.sleep(0.005)
+
+    def clean_up(self):
+        pass
+
+    def before_back_to_queue(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def bench_spend_time_object(quick=False):
+    results = []
+    op_num = 100 if quick else 500
+    thread_num = 50
+
+    def setup_pool():
+        pool = ObjectPool(SpendTimeObject, object_pool_size=40, is_pool_log_enabled=False)
+        return (lambda: timed_borrow(pool, SpendTimeObject.do_sth)), (lambda: None)
+
+    def setup_create_every_time():
+        return (lambda: SpendTimeObject().do_sth()), (lambda: None)
+
+    def setup_global_object():
+        global_obj = SpendTimeObject()
+        return (lambda: global_obj.do_sth()), (lambda: None)
+
+    results.append(run_scenario('mock', 'spend_time_object_pool', setup_pool, thread_num, op_num, pool_size=40))
+    results.append(run_scenario('mock', 'spend_time_object_create_every_time', setup_create_every_time, thread_num, op_num))
+    results.append(run_scenario('mock', 'spend_time_object_global_locked', setup_global_object, thread_num, op_num))
+    return results
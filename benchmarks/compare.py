@@ -0,0 +1,52 @@
+import argparse
+import json
+import sys
+
+"""
+对比两次基准测试的json结果，吞吐量下降或者 p99 借用耗时上升超过阈值的场景算作性能退化，新结果中失败的场景也算退化，有退化时退出码为1，可以用在CI里面。
+"""
+
+
+def _scenario_key(result: dict):
+    return result['suite'], result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(old_path, new_path, threshold=0.1) -> list:
+    with open(old_path, encoding='utf8') as f:
+        old_results = {_scenario_key(r): r for r in json.load(f)['results'] if 'skipped' not in r and 'failed' not in r}
+    with open(new_path, encoding='utf8') as f:
+        new_results = [r for r in json.load(f)['results'] if 'skipped' not in r]
+    regressions = []
+    for new in new_results:
+        if 'failed' in new:
+            print(f'失败 {new["suite"]:<10} {new["name"]:<40} {str(new["params"]):<50} {new["failed"]}')
+            regressions.append(new)
+            continue
+        old = old_results.get(_scenario_key(new))
+        if old is None:
+            continue
+        throughput_change = new['ops_per_second'] / old['ops_per_second'] - 1
+        p99_change = None
+        if old['borrow_p99_ms'] and new['borrow_p99_ms'] is not None:
+            p99_change = new['borrow_p99_ms'] / old['borrow_p99_ms'] - 1
+        is_regression = throughput_change < -threshold or (p99_change is not None and p99_change > threshold)
+        print(f'{"退化" if is_regression else "    "} {new["suite"]:<10} {new["name"]:<40} {str(new["params"]):<50} '
+              f'吞吐量 {throughput_change:+7.1%}  p99 {"-" if p99_change is None else f"{p99_change:+7.1%}"}')
+        if is_regression:
+            regressions.append(new)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='对比两次基准测试结果')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1, help='变化超过这个比例算退化，默认0.1即10%%')
+    args = parser.parse_args(argv)
+    regressions = compare(args.old, args.new, args.threshold)
+    print(f'{len(regressions)} 个场景性能退化')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
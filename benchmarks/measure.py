@@ -0,0 +1,197 @@
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import typing
+
+"""
+基准测试的计时、借用耗时分位数、内存统计和json输出。
+
+一个场景由 setup 函数描述，setup() 返回 (work, teardown) ：
+work() 执行一次操作(例如借一个连接发一个请求)，返回这次借用对象的耗时秒数，不经过对象池的对比方案返回 None ；
+teardown() 在测完之后关闭对象池、服务端等。
+每个场景先在 tracemalloc 下跑少量操作统计内存，再不开 tracemalloc 跑完整的操作次数统计吞吐量和借用耗时，tracemalloc 会让代码慢好几倍。
+work() 抛出异常的场景记录为失败，不输出吞吐量，否则出错很快的场景会显示成吞吐量很高。
+"""
+
+
+class ScenarioFailed(Exception):
+    """ 场景中有 work() 抛出了异常。"""
+
+
+def timed_borrow(pool, use: typing.Callable, *args, **kwargs):
+    """ 借用对象并调用 use(obj, *args, **kwargs) ，返回借用耗时秒数(从调用 get 到拿到对象)。"""
+    t0 = time.perf_counter()
+    context = pool.get()
+    obj = context.__enter__()
+    borrow_seconds = time.perf_counter() - t0
+    exc_info = (None, None, None)
+    try:
+        use(obj, *args, **kwargs)
+    except BaseException:
+        exc_info = sys.exc_info()
+        raise
+    finally:
+        context.__exit__(*exc_info)
+    return borrow_seconds
+
+
+async def async_timed_borrow(pool, use: typing.Callable, *args, **kwargs):
+    t0 = time.perf_counter()
+    async with pool.get() as obj:
+        borrow_seconds = time.perf_counter() - t0
+        await use(obj, *args, **kwargs)
+    return borrow_seconds
+
+
+def _percentile_ms(sorted_seconds: list, p):
+    if not sorted_seconds:
+        return None
+    return sorted_seconds[min(len(sorted_seconds) - 1, int(round(p * (len(sorted_seconds) - 1))))] * 1000
+
+
+def _raise_if_failed(errors: list, op_num):
+    if errors:
+        raise ScenarioFailed(f'{op_num} 次操作中有 {len(errors)} 个并发者出错，第一个错误 {type(errors[0]).__name__}: {errors[0]}') from errors[0]
+
+
+def _run_threads(setup, thread_num, op_num, is_include_teardown=False):
+    """ thread_num 个线程一共执行 op_num 次 work ，返回 (耗时秒数, 所有借用耗时) 。有线程出错时抛出 ScenarioFailed 。"""
+    work, teardown = setup()
+    borrow_seconds_list = []
+    errors = []
+    lock = threading.Lock()
+    start_event = threading.Event()
+
+    def _worker(n):
+        local_list = []
+        start_event.wait()
+        try:
+            for _ in range(n):
+                borrow_seconds = work()
+                if borrow_seconds is not None:
+                    local_list.append(borrow_seconds)
+        except BaseException as e:  # 这个线程不再继续，测完之后整个场景算失败
+            with lock:
+                errors.append(e)
+        with lock:
+            borrow_seconds_list.extend(local_list)
+
+    threads = [threading.Thread(target=_worker, args=(op_num // thread_num + (1 if i < op_num % thread_num else 0),))
+               for i in range(thread_num)]
+    for t in threads:
+        t.start()
+    t0 = time.perf_counter()
+    start_event.set()
+    for t in threads:
+        t.join()
+    if is_include_teardown:
+        teardown()
+    seconds = time.perf_counter() - t0
+    if not is_include_teardown:
+        teardown()
+    _raise_if_failed(errors, op_num)
+    return seconds, borrow_seconds_list
+
+
+def _run_coroutines(setup, coroutine_num, op_num, is_include_teardown=False):
+    """ work 是 async def ，coroutine_num 个协程并发。setup 在事件循环里面调用，teardown 可以是 async def 。"""
+
+    async def _main():
+        work, teardown = setup()
+        borrow_seconds_list = []
+
+        async def _worker(n):
+            for _ in range(n):
+                borrow_seconds = await work()
+                if borrow_seconds is not None:
+                    borrow_seconds_list.append(borrow_seconds)
+
+        t0 = time.perf_counter()
+        worker_results = await asyncio.gather(*[_worker(op_num // coroutine_num + (1 if i < op_num % coroutine_num else 0))
+                                                for i in range(coroutine_num)], return_exceptions=True)
+        t1 = time.perf_counter()
+        ret = teardown()
+        if asyncio.iscoroutine(ret):
+            await ret
+        _raise_if_failed([r for r in worker_results if isinstance(r, BaseException)], op_num)
+        return (time.perf_counter() if is_include_teardown else t1) - t0, borrow_seconds_list
+
+    return asyncio.run(_main())
+
+
+def run_scenario(suite, name, setup, thread_num, op_num, memory_op_num=None, is_async=False, is_include_teardown=False, **params) -> dict:
+    """
+    :param suite: 场景分组，例如 pool http pymysql
+    :param name: 场景名字，同一个 suite 下 name + params 唯一确定一个场景，用来对比不同版本的结果
+    :param setup: setup() 返回 (work, teardown) ，见模块说明。is_async 为 True 时 work 是 async def ，setup 在事件循环里面调用，teardown 可以是 async def 。
+    :param thread_num: 并发线程数(is_async 时是并发协程数)
+    :param op_num: 总操作次数
+    :param memory_op_num: 统计内存时执行的操作次数，默认是 op_num 的十分之一
+    :param is_include_teardown: 耗时是否包括 teardown ，例如线程池的 teardown 是等待所有任务执行完
+    :param params: 其他场景参数，例如 pool_size ，原样写进结果
+    :return: 有 work() 出错时返回带 failed 字段的结果，不统计吞吐量
+    """
+    memory_op_num = memory_op_num or max(thread_num, op_num // 10)
+    runner = _run_coroutines if is_async else _run_threads
+    try:
+        tracemalloc.start()
+        try:
+            runner(setup, thread_num, memory_op_num, is_include_teardown)
+            memory_current, memory_peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        seconds, borrow_seconds_list = runner(setup, thread_num, op_num, is_include_teardown)
+    except ScenarioFailed as e:
+        print(f'{suite:<10} {name:<40} {str(params):<28} threads={thread_num:<4} 失败: {e}')
+        return dict(suite=suite, name=name, params=dict(thread_num=thread_num, **params), op_num=op_num, failed=str(e))
+    borrow_seconds_list.sort()
+    result = dict(suite=suite, name=name, params=dict(thread_num=thread_num, **params), op_num=op_num,
+                  seconds=round(seconds, 6), ops_per_second=round(op_num / seconds, 2),
+                  borrow_p50_ms=_percentile_ms(borrow_seconds_list, 0.5), borrow_p99_ms=_percentile_ms(borrow_seconds_list, 0.99),
+                  borrow_max_ms=_percentile_ms(borrow_seconds_list, 1),
+                  memory_peak_kb=round(memory_peak / 1024, 1), memory_retained_kb=round(memory_current / 1024, 1))
+    print(f'{suite:<10} {name:<40} {str(params):<28} threads={thread_num:<4} {result["ops_per_second"]:>12.0f} ops/s  '
+          f'p50={_format_ms(result["borrow_p50_ms"])} p99={_format_ms(result["borrow_p99_ms"])}  peak={result["memory_peak_kb"]}KB')
+    return result
+
+
+def _format_ms(ms):
+    return '-' if ms is None else f'{ms:.3f}ms'
+
+
+def skipped_result(suite, reason) -> dict:
+    """ 缺少可选依赖(例如没安装 paramiko)的 suite 也写一条记录，对比版本时能看出是跳过了而不是变没了。"""
+    print(f'{suite:<10} 跳过: {reason}')
+    return dict(suite=suite, skipped=reason)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _package_version():
+    try:
+        from importlib import metadata
+        return metadata.version('universal_object_pool')
+    except Exception:
+        return None
+
+
+def write_json(results: list, output_path):
+    data = dict(meta=dict(package_version=_package_version(), git_commit=_git_commit(), python=sys.version.split()[0],
+                          implementation=platform.python_implementation(), platform=platform.platform(),
+                          cpu_count=os.cpu_count(), time=time.strftime('%Y-%m-%d %H:%M:%S')),
+                results=results)
+    with open(output_path, 'w', encoding='utf8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    print(f'结果已写入 {output_path}')
@@ -0,0 +1,45 @@
+import argparse
+import functools
+import sys
+
+from benchmarks import bench_pool, bench_contrib
+from benchmarks.measure import skipped_result, write_json
+
+SUITES = {
+    'pool': bench_pool.bench_object_pool,
+    'mock': bench_pool.bench_spend_time_object,
+    'http': bench_contrib.bench_http,
+    'pymysql': bench_contrib.bench_pymysql,
+    'pika': bench_contrib.bench_pika,
+    'paramiko': bench_contrib.bench_paramiko,
+    'threadpool': bench_contrib.bench_threadpool,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='universal_object_pool 基准测试')
+    parser.add_argument('--output', default='benchmark_result.json', help='json结果文件路径')
+    parser.add_argument('--suite', default=','.join(SUITES), help=f'逗号分隔，可选 {",".join(SUITES)}')
+    parser.add_argument('--quick', action='store_true', help='操作次数减少到十分之一左右，用于CI冒烟')
+    parser.add_argument('--http-host', default=None, help='不传则使用本进程内的http替身，例如先运行 tests_object_pool/aio_server.py 再传 127.0.0.1')
+    parser.add_argument('--http-port', type=int, default=5678)
+    args = parser.parse_args(argv)
+
+    results = []
+    for suite in args.suite.split(','):
+        bench_func = SUITES[suite]
+        if suite == 'http' and args.http_host:
+            bench_func = functools.partial(bench_func, host=args.http_host, port=args.http_port)
+        try:
+            results.extend(bench_func(quick=args.quick))
+        except ImportError as e:  # contrib 依赖的三方包是可选的
+            results.append(skipped_result(suite, f'{type(e).__name__}: {e}'))
+    write_json(results, args.output)
+    failed_results = [r for r in results if 'failed' in r]
+    if failed_results:
+        print(f'{len(failed_results)} 个场景失败: {", ".join(r["suite"] + "." + r["name"] for r in failed_results)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
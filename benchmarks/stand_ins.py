@@ -0,0 +1,303 @@
+"""
+基准测试用的本进程内的服务端替身，不需要网络，也不需要安装 mysql rabbitmq sshd 。
+只实现了对应客户端(pymysql pika paramiko)连接和基准测试用到的那一小部分协议，每个请求都立即返回成功，测的是客户端和对象池的开销。
+
+每个 start_xxx_server 函数在后台守护线程启动一个监听 127.0.0.1 随机端口的服务，返回 (host, port, shutdown函数) 。
+"""
+import socket
+import socketserver
+import struct
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024  # 默认是5，几十个线程同时建立连接会被丢弃SYN，客户端要等重传超时
+
+
+class _ThreadingHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+
+
+def _serve_in_background(server: socketserver.BaseServer):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def shutdown():
+        server.shutdown()
+        server.server_close()
+
+    return server.server_address[0], server.server_address[1], shutdown
+
+
+"""
+HTTP/1.1 keep-alive 服务端，响应固定的 body 。
+"""
+
+
+class _HttpHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # 响应头和响应体分两次写socket，不关闭nagle会被客户端的延迟确认拖慢40毫秒
+    body = b'Hello, stand-in'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+
+def start_http_server():
+    return _serve_in_background(_ThreadingHTTPServer(('127.0.0.1', 0), _HttpHandler))
+
+
+"""
+MySQL 协议服务端，接受任何用户名密码。SELECT 返回 select_row_num 行一列的结果集，其他语句(INSERT COMMIT SET AUTOCOMMIT等)都返回OK包。
+"""
+
+_MYSQL_CAPABILITIES = (0x1 | 0x2 | 0x4 | 0x8 | 0x200 | 0x2000 | 0x8000 | 0x20000 | 0x80000)  # PROTOCOL_41 SECURE_CONNECTION PLUGIN_AUTH 等
+_COM_QUIT = 0x01
+_COM_QUERY = 0x03
+
+
+def _lenenc_int(n):
+    if n < 251:
+        return bytes([n])
+    if n < 1 << 16:
+        return b'\xfc' + struct.pack('<H', n)
+    if n < 1 << 24:
+        return b'\xfd' + struct.pack('<I', n)[:3]
+    return b'\xfe' + struct.pack('<Q', n)
+
+
+def _lenenc_str(b: bytes):
+    return _lenenc_int(len(b)) + b
+
+
+class _MysqlHandler(socketserver.BaseRequestHandler):
+    select_row_num = 1
+
+    def _recv_exact(self, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.request.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError('客户端断开')
+            buf += chunk
+        return bytes(buf)
+
+    def _read_packet(self):
+        header = self._recv_exact(4)
+        length = header[0] | header[1] << 8 | header[2] << 16
+        self._seq = (header[3] + 1) % 256
+        return self._recv_exact(length)
+
+    def _write_packets(self, *payloads):
+        out = bytearray()
+        for payload in payloads:
+            out += struct.pack('<I', len(payload))[:3] + bytes([self._seq]) + payload
+            self._seq = (self._seq + 1) % 256
+        self.request.sendall(out)
+
+    @staticmethod
+    def _ok_packet(affected_rows=0):
+        return b'\x00' + _lenenc_int(affected_rows) + _lenenc_int(0) + struct.pack('<HH', 0x0002, 0)
+
+    @staticmethod
+    def _eof_packet():
+        return b'\xfe' + struct.pack('<HH', 0, 0x0002)
+
+    def _result_set_packets(self):
+        column = (_lenenc_str(b'def') + _lenenc_str(b'') + _lenenc_str(b'') + _lenenc_str(b'') + _lenenc_str(b'c1') + _lenenc_str(b'c1')
+                  + b'\x0c' + struct.pack('<HIBHB', 33, 255, 0xfd, 0, 0) + b'\x00\x00')
+        rows = [_lenenc_str(str(i).encode()) for i in range(self.select_row_num)]
+        return [_lenenc_int(1), column, self._eof_packet()] + rows + [self._eof_packet()]
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._seq = 0
+        salt = b'12345678abcdefghijkl'
+        greeting = (b'\x0a' + b'5.7.99-stand-in\x00' + struct.pack('<I', threading.get_ident() & 0xffffffff) + salt[:8] + b'\x00'
+                    + struct.pack('<HBHHB', _MYSQL_CAPABILITIES & 0xffff, 33, 0x0002, _MYSQL_CAPABILITIES >> 16, len(salt) + 1)
+                    + b'\x00' * 10 + salt[8:] + b'\x00' + b'mysql_native_password\x00')
+        self._write_packets(greeting)
+        try:
+            self._read_packet()  # 登录包，不校验
+            self._write_packets(self._ok_packet())
+            while True:
+                packet = self._read_packet()
+                command = packet[0]
+                if command == _COM_QUIT:
+                    return
+                if command == _COM_QUERY and packet[1:].lstrip()[:6].upper() == b'SELECT':
+                    self._write_packets(*self._result_set_packets())
+                elif command == _COM_QUERY:
+                    self._write_packets(self._ok_packet(affected_rows=packet.count(b'),(') + 1))
+                else:  # COM_PING COM_INIT_DB 等
+                    self._write_packets(self._ok_packet())
+        except (ConnectionError, OSError):
+            pass
+
+
+def start_mysql_server(select_row_num=1):
+    handler = type('MysqlHandler', (_MysqlHandler,), dict(select_row_num=select_row_num))
+    return _serve_in_background(_ThreadingTCPServer(('127.0.0.1', 0), handler))
+
+
+"""
+AMQP 0-9-1 服务端，支持 pika BlockingConnection 的连接握手、开关channel、声明队列、发布消息、事务和发布确认，消息直接丢弃。
+"""
+
+_FRAME_METHOD = 1
+_FRAME_HEADER = 2
+_FRAME_BODY = 3
+_FRAME_END = b'\xce'
+
+
+def _shortstr(b: bytes):
+    return bytes([len(b)]) + b
+
+
+def _longstr(b: bytes):
+    return struct.pack('>I', len(b)) + b
+
+
+def _field_table(d: dict):
+    body = bytearray()
+    for k, v in d.items():
+        body += _shortstr(k.encode())
+        if isinstance(v, bool):
+            body += b't' + bytes([v])
+        elif isinstance(v, dict):
+            body += b'F' + _field_table(v)
+        else:
+            body += b'S' + _longstr(str(v).encode())
+    return struct.pack('>I', len(body)) + bytes(body)
+
+
+class _AmqpHandler(socketserver.BaseRequestHandler):
+    def _recv_exact(self, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.request.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError('客户端断开')
+            buf += chunk
+        return bytes(buf)
+
+    def _send_method(self, channel, class_id, method_id, args=b''):
+        payload = struct.pack('>HH', class_id, method_id) + args
+        self.request.sendall(struct.pack('>BHI', _FRAME_METHOD, channel, len(payload)) + payload + _FRAME_END)
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        confirm_channels = {}  # channel -> 已经确认到的 delivery_tag
+        body_remain = {}  # channel -> 还没收完的消息体字节数
+        try:
+            self._recv_exact(8)  # b'AMQP\x00\x00\x09\x01'
+            self._send_method(0, 10, 10, b'\x00\x09' + _field_table(
+                {'product': 'stand-in', 'capabilities': {'publisher_confirms': True, 'basic.nack': True}})
+                              + _longstr(b'PLAIN') + _longstr(b'en_US'))
+            while True:
+                frame_type, channel, size = struct.unpack('>BHI', self._recv_exact(7))
+                payload = self._recv_exact(size + 1)[:-1]
+                if frame_type == _FRAME_HEADER:
+                    body_size = struct.unpack('>Q', payload[4:12])[0]
+                    body_remain[channel] = body_size
+                elif frame_type == _FRAME_BODY:
+                    body_remain[channel] -= len(payload)
+                if frame_type in (_FRAME_HEADER, _FRAME_BODY) and body_remain[channel] == 0 and channel in confirm_channels:
+                    confirm_channels[channel] += 1  # 整条消息收完了，发送 Basic.Ack
+                    self._send_method(channel, 60, 80, struct.pack('>QB', confirm_channels[channel], 0))
+                if frame_type != _FRAME_METHOD:
+                    continue  # 消息头、消息体、心跳
+                class_id, method_id = struct.unpack('>HH', payload[:4])
+                if (class_id, method_id) == (10, 11):  # Connection.StartOk
+                    self._send_method(0, 10, 30, struct.pack('>HIH', 2047, 131072, 0))
+                elif (class_id, method_id) == (10, 40):  # Connection.Open
+                    self._send_method(0, 10, 41, _shortstr(b''))
+                elif (class_id, method_id) == (10, 50):  # Connection.Close
+                    self._send_method(0, 10, 51)
+                    return
+                elif (class_id, method_id) == (20, 10):  # Channel.Open
+                    self._send_method(channel, 20, 11, _longstr(b''))
+                elif (class_id, method_id) == (20, 40):  # Channel.Close
+                    confirm_channels.pop(channel, None)
+                    self._send_method(channel, 20, 41)
+                elif (class_id, method_id) == (50, 10):  # Queue.Declare
+                    queue_name = payload[7:7 + payload[6]]
+                    self._send_method(channel, 50, 11, _shortstr(queue_name) + struct.pack('>II', 0, 0))
+                elif (class_id, method_id) == (85, 10):  # Confirm.Select
+                    confirm_channels[channel] = 0
+                    if not payload[4] & 1:
+                        self._send_method(channel, 85, 11)
+                elif (class_id, method_id) in ((90, 10), (90, 20), (90, 30)):  # Tx.Select Tx.Commit Tx.Rollback
+                    self._send_method(channel, 90, method_id + 1)
+        except (ConnectionError, OSError):
+            pass
+
+
+def start_amqp_server():
+    return _serve_in_background(_ThreadingTCPServer(('127.0.0.1', 0), _AmqpHandler))
+
+
+"""
+SSH 服务端(paramiko 的服务端模式)，接受任何用户名密码，exec 命令直接返回 'ok\\n' ，支持打开 sftp 子系统。
+"""
+
+
+def start_ssh_server():
+    import paramiko
+    from paramiko.common import cMSG_CHANNEL_SUCCESS
+
+    host_key = paramiko.RSAKey.generate(2048)
+
+    class _Transport(paramiko.Transport):
+        """ exec 请求的成功回复是在 check_channel_exec_request 返回之后才发出去的，回复命令输出要等它发出去，否则客户端先收到channel关闭会报错。"""
+
+        def __init__(self, sock):
+            super().__init__(sock)
+            self.request_replied_events = {}  # chanid -> threading.Event
+
+        def _send_user_message(self, data):
+            super()._send_user_message(data)
+            raw = data.asbytes()
+            if raw[:1] == cMSG_CHANNEL_SUCCESS:
+                self.request_replied_events.setdefault(struct.unpack('>I', raw[1:5])[0], threading.Event()).set()
+
+    class _ServerInterface(paramiko.ServerInterface):
+        def get_allowed_auths(self, username):
+            return 'password'
+
+        def check_auth_password(self, username, password):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_channel_request(self, kind, chanid):
+            return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+        def check_channel_exec_request(self, channel, command):
+            replied_event = channel.transport.request_replied_events.setdefault(channel.remote_chanid, threading.Event())
+
+            def _reply():
+                replied_event.wait(5)
+                channel.transport.request_replied_events.pop(channel.remote_chanid, None)
+                channel.sendall(b'ok\n')
+                channel.send_exit_status(0)
+                channel.close()
+
+            threading.Thread(target=_reply, daemon=True).start()
+            return True
+
+    class _SshHandler(socketserver.BaseRequestHandler):
+        def handle(self):
+            transport = _Transport(self.request)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, paramiko.SFTPServerInterface)
+            transport.start_server(server=_ServerInterface())
+            transport.join()
+
+    return _serve_in_background(_ThreadingTCPServer(('127.0.0.1', 0), _SshHandler))
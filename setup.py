@@ -41,7 +41,12 @@ setup(
         'nb_log',
         'decorator_libs',
         'threadpool_executor_shrink_able',
-    ]
+    ],
+    extras_require={
+        # contrib/pika_pool.py 的 publish_batch 用 SelectConnection 和 Channel.confirm_delivery(ack_nack_callback, callback) ，
+        # 这两个的回调参数在 pika 1.0 改过，0.x 的签名不一样；限制在 2.0 以下，避免下一个大版本再改公开接口。
+        'pika': ['pika>=1.0,<2'],
+    },
 )
 """
 打包上传
@@ -0,0 +1,78 @@
+"""
+对比 借用对象时持有锁创建对象和阻塞等待(旧实现) 和 锁外创建、条件变量公平唤醒(新实现) 的借用耗时分布。
+对象创建耗时 0.2秒，每次使用耗时 0.01秒，100线程争抢20个对象。主要看 p99 借用耗时。
+"""
+import threading
+import time
+from queue import LifoQueue
+
+from universal_object_pool import ObjectPool, AbstractObject
+
+
+class SlowCreateObject(AbstractObject):
+    def __init__(self):
+        time.sleep(0.2)  # 模拟创建pymysql连接或者浏览器比较慢
+
+    def clean_up(self):
+        pass
+
+    def before_back_to_queue(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class LegacyLockedObjectPool(ObjectPool):
+    """ 旧版的借用逻辑，整个借用过程都持有 self._lock 。"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._legacy_queue = LifoQueue(self.object_pool_size)
+
+    def _borrow_a_object(self, block, timeout):
+        with self._lock:
+            if self._legacy_queue.qsize() == 0 and self._has_create_object_num < self.object_pool_size:
+                self._legacy_queue.put(self.object_type(**self._object_init_kwargs))
+                self._has_create_object_num += 1
+            obj = self._legacy_queue.get(block, timeout)
+            self.is_using_num += 1
+            obj.the_obj_last_use_time = time.time()
+            return obj
+
+    def _back_a_object(self, obj):
+        self._legacy_queue.put(obj)
+        self.is_using_num -= 1
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def run_benchmark(pool_klass, thread_num=100, borrow_times_per_thread=20, pool_size=20):
+    pool = pool_klass(object_type=SlowCreateObject, object_pool_size=pool_size)
+    pool.set_log_level(30)
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def worker():
+        my_latencies = []
+        for _ in range(borrow_times_per_thread):
+            t0 = time.perf_counter()
+            with pool.get():
+                my_latencies.append(time.perf_counter() - t0)
+                time.sleep(0.01)
+        with latencies_lock:
+            latencies.extend(my_latencies)
+
+    t_start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(thread_num)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    total = time.perf_counter() - t_start
+    latencies.sort()
+    print(f'{pool_klass.__name__:<25} 总耗时 {total:.2f}s  '
+          f'p50 {percentile(latencies, 50) * 1000:.1f}ms  p99 {percentile(latencies, 99) * 1000:.1f}ms  '
+          f'max {latencies[-1] * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    run_benchmark(LegacyLockedObjectPool)
+    run_benchmark(ObjectPool)
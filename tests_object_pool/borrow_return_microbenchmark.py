@@ -0,0 +1,37 @@
+"""
+单线程循环借用和归还一个什么都不做的对象，测出对象池本身每次借还的开销，单位微秒。
+分别测试 默认info级别日志、debug级别日志、完全关闭对象池日志 三种情况。
+"""
+import time
+
+from universal_object_pool import ObjectPool, AbstractObject
+
+
+class NoopObject(AbstractObject):
+    def __init__(self):
+        pass
+
+    def clean_up(self):
+        pass
+
+    def before_back_to_queue(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def run_microbenchmark(cycle_num=100000, **pool_kwargs):
+    pool = ObjectPool(object_type=NoopObject, object_pool_size=1, **pool_kwargs)
+    with pool.get():  # 先把对象创建好，不算在耗时里面
+        pass
+    t0 = time.perf_counter()
+    for _ in range(cycle_num):
+        with pool.get():
+            pass
+    per_cycle_us = (time.perf_counter() - t0) / cycle_num * 1000 * 1000
+    print(f'{str(pool_kwargs):<40} 每次借还耗时 {per_cycle_us:.2f} 微秒')
+    return per_cycle_us
+
+
+if __name__ == '__main__':
+    run_microbenchmark(log_level=20)
+    run_microbenchmark(cycle_num=2000, log_level=10)  # debug日志会真的打印，次数少一点
+    run_microbenchmark(is_pool_log_enabled=False)
@@ -0,0 +1,45 @@
+"""
+对比 自定义对象通过 __getattr__ 调用 core_obj 方法 的两种模式的耗时，以及直接调用 core_obj 方法的耗时。
+is_cache_core_obj_methods = True 时，第一次调用后绑定好的方法缓存在对象上，之后的调用接近直接调用。
+"""
+import time
+
+from universal_object_pool import AbstractObject
+
+
+class Core:
+    def execute(self, x):
+        return x
+
+
+class DefaultDelegateObject(AbstractObject):
+    def __init__(self):
+        self.core_obj = Core()
+
+    def clean_up(self):
+        pass
+
+    def before_back_to_queue(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class CachedDelegateObject(DefaultDelegateObject):
+    is_cache_core_obj_methods = True
+
+
+def run_benchmark(name, fun, call_num=1000000):
+    t0 = time.perf_counter()
+    for i in range(call_num):
+        fun(i)
+    print(f'{name:<30} 每次调用耗时 {(time.perf_counter() - t0) / call_num * 1000 * 1000 * 1000:.1f} 纳秒')
+
+
+if __name__ == '__main__':
+    default_obj = DefaultDelegateObject()
+    cached_obj = CachedDelegateObject()
+    core = default_obj.core_obj
+    run_benchmark('直接调用 core.execute', lambda i: core.execute(i))
+    run_benchmark('默认 __getattr__ 委托', lambda i: default_obj.execute(i))
+    run_benchmark('缓存绑定方法的委托', lambda i: cached_obj.execute(i))
+    cached_obj.core_obj = Core()  # 重新赋值后缓存失效，下一次调用重新绑定新的 core_obj 的方法
+    assert cached_obj.execute(1) == 1 and cached_obj.execute.__self__ is cached_obj.core_obj
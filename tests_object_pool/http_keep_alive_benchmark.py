@@ -0,0 +1,43 @@
+"""
+先运行 aio_server.py ，再运行这个文件。
+对比 http 连接池的三种用法每秒完成的请求数：
+1. 每个请求都加 Connection: close 头(以前的demo为了避免端口耗尽的做法)，每个请求都要新建tcp连接。
+2. keep-alive 复用连接，每个请求借还一次连接。
+3. request_batch 把一批请求分散到多个连接上，每个连接只借还一次。
+"""
+import time
+
+from threadpool_executor_shrink_able import BoundedThreadPoolExecutor
+
+from universal_object_pool import ObjectPool
+from universal_object_pool.contrib.http_pool import HttpOperator, request_batch
+
+
+def run_benchmark(host='127.0.0.1', port=5678, request_num=10000, thread_num=50):
+    for headers in ({'Connection': 'close'}, {}):
+        http_pool = ObjectPool(object_type=HttpOperator, object_pool_size=thread_num, object_init_kwargs=dict(host=host, port=port),
+                               is_pool_log_enabled=False)
+
+        def test_request():
+            with http_pool.get() as conn:  # type: HttpOperator
+                conn.request_and_getresponse('GET', '/', headers=headers)
+
+        thread_pool = BoundedThreadPoolExecutor(thread_num)
+        t0 = time.perf_counter()
+        for _ in range(request_num):
+            thread_pool.submit(test_request)
+        thread_pool.shutdown()
+        spend = time.perf_counter() - t0
+        reconnect_num = sum(conn.reconnect_num for conn in http_pool._idle_objects)
+        print(f'{"每个请求借还一次 " + str(headers):<45} {request_num / spend:>10.0f} 请求/秒  检测到服务端关闭连接后重连 {reconnect_num} 次')
+
+    http_pool = ObjectPool(object_type=HttpOperator, object_pool_size=thread_num, object_init_kwargs=dict(host=host, port=port),
+                           is_pool_log_enabled=False)
+    t0 = time.perf_counter()
+    responses = request_batch(http_pool, [('GET', '/')] * request_num)
+    spend = time.perf_counter() - t0
+    print(f'{"request_batch":<45} {request_num / spend:>10.0f} 请求/秒  响应数 {len(responses)}')
+
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,117 @@
+"""
+对比 每发布一条消息借还一次 PikaOperator(现在demo的用法) 和 PikaBatchPublisher 攒批 publisher confirms 发布 的每秒发布消息数。
+不需要真的rabbitmq，用一个本地的 broker 替身：每个 basic_publish 写socket耗时 0.05 毫秒，等待broker回复 Basic.Ack 一次往返 1 毫秒，
+批量发布时一批消息连续写出去，broker 回复的 Basic.Ack 整批只等待一次往返。
+"""
+import threading
+import time
+
+from threadpool_executor_shrink_able import BoundedThreadPoolExecutor
+
+from universal_object_pool import ObjectPool
+from universal_object_pool.contrib.pika_pool import PikaOperator, PikaBatchPublisher
+
+PUBLISH_WRITE_SECONDS = 0.00005
+ROUND_TRIP_SECONDS = 0.001
+
+
+class FakeBrokerChannel:
+    def __init__(self, broker_received: list):
+        self.is_open = True
+        self._broker_received = broker_received
+
+    def queue_declare(self, queue):
+        time.sleep(ROUND_TRIP_SECONDS)
+
+    def basic_publish(self, exchange, routing_key, body):
+        time.sleep(PUBLISH_WRITE_SECONDS)
+        self._broker_received.append(body)
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeConfirmPublisher:
+    """ 替代 publish_batch 用的 SelectConnection 发布者，一批消息写完后等一次往返收到 broker 的确认。"""
+
+    def __init__(self, broker_received: list):
+        self._broker_received = broker_received
+
+    def publish_batch(self, bodies, routing_key):
+        for body in bodies:
+            time.sleep(PUBLISH_WRITE_SECONDS)
+            self._broker_received.append(body)
+        time.sleep(ROUND_TRIP_SECONDS)
+        return [None] * len(bodies)
+
+    def close(self):
+        pass
+
+
+class FakeBrokerConnection:
+    broker_received = []
+
+    def __init__(self):
+        self.is_open = True
+
+    def channel(self):
+        return FakeBrokerChannel(self.broker_received)
+
+    def close(self):
+        self.is_open = False
+
+
+class StandInPikaOperator(PikaOperator):
+    def _create_channel(self):
+        time.sleep(ROUND_TRIP_SECONDS * 3)
+        self.connection = FakeBrokerConnection()
+        self.channel = self.connection.channel()
+        self.channel.queue_declare(queue=self._queue)
+        self.core_obj = self.channel
+
+    def _create_confirm_publisher(self):
+        time.sleep(ROUND_TRIP_SECONDS * 3)
+        return FakeConfirmPublisher(FakeBrokerConnection.broker_received)
+
+
+def run_benchmark(msg_num=20000, thread_num=50, pool_size=10):
+    pika_pool = ObjectPool(object_type=StandInPikaOperator, object_pool_size=pool_size, is_pool_log_enabled=False,
+                           object_init_kwargs=dict(host='127.0.0.1', port=5672, user='guest', password='guest', queue='test_queue'))
+
+    def publish_one(x):
+        with pika_pool.get() as op:
+            op.simple_publish(f'hello_{x}')
+
+    FakeBrokerConnection.broker_received.clear()
+    thread_pool = BoundedThreadPoolExecutor(thread_num)
+    t0 = time.perf_counter()
+    for x in range(msg_num):
+        thread_pool.submit(publish_one, x)
+    thread_pool.shutdown()
+    spend = time.perf_counter() - t0
+    print(f'每条借还一次(无确认)  {msg_num / spend:>10.0f} 条/秒  broker收到 {len(FakeBrokerConnection.broker_received)}')
+
+    FakeBrokerConnection.broker_received.clear()
+    batch_publisher = PikaBatchPublisher(pika_pool, batch_size=500)
+    futures = []
+    futures_lock = threading.Lock()
+
+    def publish_batched(x):
+        f = batch_publisher.publish(f'hello_{x}')
+        with futures_lock:
+            futures.append(f)
+
+    thread_pool = BoundedThreadPoolExecutor(thread_num)
+    t0 = time.perf_counter()
+    for x in range(msg_num):
+        thread_pool.submit(publish_batched, x)
+    thread_pool.shutdown()
+    for f in futures:
+        f.result()
+    spend = time.perf_counter() - t0
+    print(f'攒批发布(publisher confirms) {msg_num / spend:>10.0f} 条/秒  broker收到 {len(FakeBrokerConnection.broker_received)}  {batch_publisher.stats()}')
+    batch_publisher.shutdown()
+
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,46 @@
+"""
+PyMysqlBatchWriter 写入时连接断开(OperationalError)：断开的连接要被摧毁，不能在断开的连接上 rollback 把借用名额卡死，
+重试时借到的是别的连接，对象池的容量不变。服务端用 benchmarks.stand_ins 的 mysql 替身，不需要真的mysql。
+"""
+import socket
+
+from benchmarks import stand_ins
+from universal_object_pool import ObjectPool
+from universal_object_pool.contrib.pymysql_pool import PyMysqlOperator, PyMysqlBatchWriter
+
+SQL = 'INSERT INTO db1.table1(uname ,age) VALUES(%s ,%s)'
+
+
+def test_operational_error_retires_connection_and_keeps_pool_size():
+    host, port, shutdown = stand_ins.start_mysql_server()
+    pool_size = 2
+    pool = ObjectPool(PyMysqlOperator, object_pool_size=pool_size, min_idle=pool_size, is_pool_log_enabled=False,
+                      object_init_kwargs=dict(host=host, port=port, user='root', password='123456'))
+    batch_writer = PyMysqlBatchWriter(pool, batch_size=3, flush_interval_seconds=0.01, max_workers=1)
+    try:
+        with pool.get(timeout=5) as operator:  # type: PyMysqlOperator
+            dead_conn = operator.conn
+        dead_conn._sock.shutdown(socket.SHUT_RDWR)  # 模拟服务端断开了这个空闲连接
+
+        futures = [batch_writer.write(SQL, (f'name_{i}', i)) for i in range(3)]
+        assert [f.result(timeout=10) for f in futures] == [3, 3, 3]  # 重试成功，每行的结果是这一批 executemany 的 rowcount
+        stats = batch_writer.stats()
+        assert stats['retry_num'] == 1 and stats['fail_num'] == 0
+
+        assert pool.is_using_num == 0
+        assert pool._has_create_object_num <= pool_size
+        assert all(operator.conn is not dead_conn for operator in pool._idle_objects)
+        # 对象池的全部容量都还能同时借出来，没有名额被卡死
+        contexts = [pool.get(timeout=5) for _ in range(pool_size)]
+        operators = [context.__enter__() for context in contexts]
+        assert all(operator.conn is not dead_conn for operator in operators)
+        for context in contexts:
+            context.__exit__(None, None, None)
+    finally:
+        batch_writer.shutdown()
+        shutdown()
+
+
+if __name__ == '__main__':
+    test_operational_error_retires_connection_and_keeps_pool_size()
+    print('ok')
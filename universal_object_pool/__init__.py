@@ -1,100 +1,424 @@
 import abc
+import collections
+import functools
+import inspect
+import logging
 import queue
+import random
 import threading
 import time
-from queue import LifoQueue
+import typing
 import decorator_libs
 import nb_log
 
+from universal_object_pool.clean_up_executor import CleanUpExecutor, get_default_clean_up_executor
+from universal_object_pool.pool_stats import PoolStats, stats_to_prometheus_text
+from universal_object_pool.batch_flusher import BatchFlusher
+
+_CREATE_PERMIT = object()  # 表示借用者拿到的不是空闲对象，而是一个已经预留好的创建对象名额。
+
+_disabled_logger = logging.getLogger('universal_object_pool.disabled')  # is_pool_log_enabled=False 时用这个，所有日志调用直接返回。
+_disabled_logger.disabled = True
+
+
+class _BorrowWaiter:
+    """ 排队等待借用对象的线程。归还对象或者空出创建名额时，按先来后到直接交给队头的等待者，避免后来的线程插队。"""
+    __slots__ = ('condition', 'obj', 'is_permit_create')
+
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock)
+        self.obj = None
+        self.is_permit_create = False  # 为True表示已经替这个等待者预留好了一个创建对象的名额，由它自己在锁外创建对象。
+
+
+class ValidatePolicy:
+    """ 什么时候调用对象的 validate 方法检查对象是否还能用，检查不通过的对象会被摧毁，不会交给借用者。"""
+    NONE = None  # 不检查，只靠 error_type_list_set_not_available 在出错之后把对象标记为不可用。
+    ON_BORROW = 'on_borrow'  # 每次借出之前都检查，最可靠，但是每次借用都要多一次检查的耗时。
+    IDLE_OVER = 'idle_over'  # 对象空闲时间超过 validate_idle_seconds 才在借出之前检查，刚用过的对象不检查。
+    BACKGROUND = 'background'  # 后台定时分批检查空闲对象，检查不在借用者的请求路径上。
+
 
 # noinspection PyUnusedLocal
 class ObjectPool(nb_log.LoggerMixin, nb_log.LoggerLevelSetterMixin):
-    def __init__(self, object_type, object_init_kwargs: dict = None, object_pool_size=10, max_idle_seconds=30 * 60):
+    def __init__(self, object_type, object_init_kwargs: dict = None, object_pool_size=10, max_idle_seconds=30 * 60,
+                 max_concurrent_create_num=5, min_idle=0, prewarm=False,
+                 cleanup_interval_seconds=10, cleanup_batch_size=None,
+                 clean_up_executor: CleanUpExecutor = None, clean_up_timeout=None,
+                 log_level=20, is_pool_log_enabled=True,
+                 validate_policy=ValidatePolicy.NONE, validate_idle_seconds=60,
+                 validate_interval_seconds=30, validate_batch_size=5,
+                 max_lifetime_seconds=None, max_uses=None, lifetime_jitter_ratio=0.1):
         """
 
         :param object_type: 对象类型，将会实例化此类
         :param object_init_kwargs: 对象的__init__方法的初始化参数
         :param object_pool_size: 对象池大小
         :param max_idle_seconds: 最大空闲时间，大于次时间没被使用的对象，将会被自动摧毁和弹出。摧毁是自动调用对象的clean_up方法
+        :param max_concurrent_create_num: 最多同时有几个线程在创建对象。创建对象是在锁外面进行的，创建慢的对象(例如浏览器)不会卡住其他借用和归还对象的线程。
+        :param min_idle: 最少保持多少个空闲对象，定时清理后如果空闲对象少于这个数，会在后台自动补充创建，避免请求来了才临时创建对象。
+        :param prewarm: 是否在实例化对象池时就并发创建好 min_idle 个对象，会阻塞直到创建完成。
+        :param cleanup_interval_seconds: 每隔多少秒检查一次空闲超时的对象。
+        :param cleanup_batch_size: 每次检查最多摧毁多少个空闲超时的对象，None 表示不限制，剩下的等下一轮。
+        :param clean_up_executor: 摧毁对象用的有界线程池，不传则所有对象池共用一个默认的。
+        :param clean_up_timeout: 每个对象的 clean_up 最多等待多少秒，None 表示一直等待。
+        :param log_level: 对象池内部日志的级别，设置为10可以看到每次借用和归还对象的日志。
+        :param is_pool_log_enabled: 为False则完全关闭对象池内部日志，借用和归还对象时连日志级别判断都省了。
+        :param validate_policy: 什么时候调用对象的 validate 方法检查对象是否可用，见 ValidatePolicy 。
+        :param validate_idle_seconds: validate_policy 为 IDLE_OVER 时，空闲超过这个秒数的对象借出前才检查。
+        :param validate_interval_seconds: validate_policy 为 BACKGROUND 时，每隔多少秒后台检查一批空闲对象。
+        :param validate_batch_size: validate_policy 为 BACKGROUND 时，每次检查空闲最久的多少个对象，一个一个地拿出来检查。
+        :param max_lifetime_seconds: 对象从创建开始最多存活多少秒，到期后在归还时或者后台定时清理时摧毁，不会在借用者拿到对象之后才摧毁。
+            避免 mysql wait_timeout、ssh重新协商密钥、浏览器内存膨胀 等问题。None 表示不限制。
+        :param max_uses: 对象最多被借用多少次，达到后归还时摧毁。None 表示不限制。
+        :param lifetime_jitter_ratio: 每个对象的实际存活时间在 max_lifetime_seconds 的基础上随机减少最多这个比例，
+            避免同一时刻创建的一批对象同时到期，同时重建。
         """
         self._object_init_kwargs = {} if object_init_kwargs is None else object_init_kwargs
         self._max_idle_seconds = max_idle_seconds  # 大于此空闲时间没被使用的对象，将会被自动摧毁从对象池弹出。
         self.object_pool_size = object_pool_size
-        self.queue = self._queue = LifoQueue(object_pool_size)
-        self._lock = threading.Lock()
+        self._max_concurrent_create_num = max(1, max_concurrent_create_num)
+        self._idle_objects = collections.deque()  # 空闲对象，按归还时间排序，左边是空闲最久的，右边是最近归还的，借用时候从右边取(后进先出)。
+        self._waiters = collections.deque()  # type: typing.Deque[_BorrowWaiter]
+        self._lock = threading.Lock()  # 只保护上面这些簿记数据，创建对象和阻塞等待都不在锁内进行。
         self.is_using_num = 0
-        self._has_create_object_num = 0
+        self._has_create_object_num = 0  # 包括正在创建中的对象，即已经预留了名额的对象。
+        self._creating_num = 0
+        self._min_idle = min(min_idle, object_pool_size)
+        self._is_filling_to_min_idle = False
+        self._cleanup_batch_size = cleanup_batch_size
+        self._clean_up_executor = clean_up_executor or get_default_clean_up_executor()
+        self._clean_up_timeout = clean_up_timeout
+        self._stats = PoolStats()
+        self._validate_policy = validate_policy
+        self._validate_idle_seconds = validate_idle_seconds
+        self._validate_batch_size = validate_batch_size
+        self._max_lifetime_seconds = max_lifetime_seconds
+        self._max_uses = max_uses
+        self._lifetime_jitter_ratio = lifetime_jitter_ratio
         self.object_type = object_type
-        self.logger.setLevel(20)
-        self._check_and_cleanup_objects()
+        self.logger.setLevel(log_level)
+        self._pool_logger = self.logger if is_pool_log_enabled else _disabled_logger  # 缓存起来，不用每次访问 LoggerMixin 的 logger 属性。
+        if prewarm:
+            self._fill_to_min_idle()
+        decorator_libs.keep_circulating(cleanup_interval_seconds, block=False, daemon=True)(self._check_and_cleanup_objects)()
+        if validate_policy == ValidatePolicy.BACKGROUND:
+            decorator_libs.keep_circulating(validate_interval_seconds, block=False, daemon=True)(self._validate_idle_objects_in_background)()
 
-    @decorator_libs.keep_circulating(10, block=False, daemon=True)
     def _check_and_cleanup_objects(self):
+        t0 = time.time()
+        to_be_cleanup_objects = []
         with self._lock:
-            t0 = time.time()
-            to_be_requeue_object = []
-            while 1:
-                try:
-                    obj = self._queue.get_nowait()
-                except queue.Empty:
+            # 空闲对象按归还时间排好序了，只需要从左边弹出超时的，不用把整个池子清空再放回去，借用者不会看到空池子。
+            expire_time = time.time() - self._max_idle_seconds
+            while self._idle_objects and self._idle_objects[0].the_obj_last_use_time < expire_time:
+                if self._cleanup_batch_size is not None and len(to_be_cleanup_objects) >= self._cleanup_batch_size:
                     break
+                to_be_cleanup_objects.append(self._idle_objects.popleft())
+            idle_expire_num = len(to_be_cleanup_objects)
+            if self._max_lifetime_seconds is not None:
+                # 到达存活期限的对象不是按归还时间排序的，要遍历一遍，对象池一般不大。
+                now = time.time()
+                for obj in [obj for obj in self._idle_objects if obj.the_obj_expire_time < now]:
+                    if self._cleanup_batch_size is not None and len(to_be_cleanup_objects) >= self._cleanup_batch_size:
+                        break
+                    self._idle_objects.remove(obj)
+                    to_be_cleanup_objects.append(obj)
+            if to_be_cleanup_objects:
+                self._has_create_object_num -= len(to_be_cleanup_objects)
+                self._on_objects_leave_pool_locked(to_be_cleanup_objects)
+                self._dispatch_to_waiters_locked()
+        for index, obj in enumerate(to_be_cleanup_objects):
+            self._destroy_object(obj)
+            if index < idle_expire_num:
+                self._pool_logger.info('此对象空闲时间超过 %s  秒，使用 %s 方法 自动摧毁%s', self._max_idle_seconds, obj.clean_up, obj)  # 例如mysql的连接，默认配置是超过8小时空闲，就会被回收，你再用这个连接对象去操作数据库就报报错了。
+            else:
+                self._pool_logger.info('此对象存活时间超过 %s  秒，自动摧毁%s', self._max_lifetime_seconds, obj)
+        if time.time() - t0 > 5:
+            self._pool_logger.warning('耗时 %s', time.time() - t0)
+        self._start_fill_to_min_idle_in_background()
+
+    def _on_objects_leave_pool_locked(self, objs):
+        """ 空闲对象被清理出对象池时调用，子类可以重写来同步自己的簿记数据。"""
+        pass
+
+    def _destroy_object(self, obj):
+        self._stats.on_destroy()
+        self._clean_up_executor.submit(obj, self._clean_up_timeout)
+
+    def _is_object_valid(self, obj):
+        try:
+            return obj.validate() is not False
+        except Exception as e:
+            self._pool_logger.warning('检查对象 %s 是否可用时出错 %s', obj, e)
+            return False
+
+    def _is_need_validate_on_borrow(self, obj):
+        if self._validate_policy == ValidatePolicy.ON_BORROW:
+            return True
+        if self._validate_policy == ValidatePolicy.IDLE_OVER:
+            return time.time() - obj.the_obj_last_use_time > self._validate_idle_seconds
+        return False
+
+    def _validate_idle_objects_in_background(self):
+        """
+        每次从空闲最久的一端检查 validate_batch_size 个对象，检查耗时不在借用者的请求路径上。
+        一次只拿出一个对象检查，通过检查的放回原位置，不可用的摧毁。其他空闲对象照常借出，借用者不会看到一个被后台检查拿空了的对象池。
+        """
+        validated_objects = []
+        has_invalid_object = False
+        for _ in range(self._validate_batch_size):
+            with self._lock:
+                for index, obj in enumerate(self._idle_objects):
+                    if not any(obj is validated_obj for validated_obj in validated_objects):
+                        break
+                else:
+                    break  # 空闲对象都检查过了
+                del self._idle_objects[index]
+            validated_objects.append(obj)
+            is_valid = self._is_object_valid(obj)
+            with self._lock:
+                if is_valid:
+                    self._idle_objects.insert(min(index, len(self._idle_objects)), obj)
                 else:
-                    # if time.time() - obj.the_obj_last_use_time > 30 * 60:
-                    if time.time() - obj.the_obj_last_use_time > self._max_idle_seconds:
-                        # t1 = time.time()
-                        threading.Thread(target=obj.clean_up).start()
-                        # print(time.time() -t1)
-                        self.logger.info(
-                            f'此对象空闲时间超过 {self._max_idle_seconds}  秒，使用 {obj.clean_up} 方法 自动摧毁{obj}')  # 例如mysql的连接，默认配置是超过8小时空闲，就会被回收，你再用这个连接对象去操作数据库就报报错了。
-                        self._has_create_object_num -= 1
-                    else:
-                        to_be_requeue_object.append(obj)
-            [self._queue.put_nowait(obj) for obj in to_be_requeue_object]
-            if time.time() - t0 > 5:
-                self.logger.warning(f'耗时 {time.time() - t0}')
+                    self._has_create_object_num -= 1
+                    self._on_objects_leave_pool_locked([obj])
+                self._dispatch_to_waiters_locked()
+            if not is_valid:
+                has_invalid_object = True
+                self._stats.on_validate_fail()
+                self._pool_logger.warning('对象 %s 检查不可用，摧毁它', obj)
+                self._destroy_object(obj)
+        if has_invalid_object:
+            self._start_fill_to_min_idle_in_background()
 
-    def _borrow_a_object(self, block, timeout):
+    def _reserve_min_idle_create_num_locked(self):
+        """ 为补充空闲对象预留创建名额，返回预留的个数。必须在持有 self._lock 时调用。"""
+        num = min(self._min_idle - len(self._idle_objects) - self._creating_num,
+                  self.object_pool_size - self._has_create_object_num,
+                  self._max_concurrent_create_num - self._creating_num)
+        num = max(num, 0)
+        self._has_create_object_num += num
+        self._creating_num += num
+        return num
+
+    def _create_object_to_idle(self, fail_list: list):
+        try:
+            obj = self._create_object()
+        except Exception as e:
+            self._pool_logger.error('补充创建空闲对象出错 %s', e, exc_info=True)
+            fail_list.append(e)
+            return
+        with self._lock:
+            self._on_created_object_to_idle_locked(obj)
+            self._dispatch_to_waiters_locked()
+
+    def _on_created_object_to_idle_locked(self, obj):
+        obj.the_obj_last_use_time = time.time()
+        self._idle_objects.append(obj)
+
+    def _fill_to_min_idle(self):
+        """ 并发创建对象，直到空闲对象数量达到 min_idle 。"""
+        while 1:
+            with self._lock:
+                num = self._reserve_min_idle_create_num_locked()
+            if num == 0:
+                break
+            fail_list = []
+            threads = [threading.Thread(target=self._create_object_to_idle, args=(fail_list,), daemon=True) for _ in range(num)]
+            [t.start() for t in threads]
+            [t.join() for t in threads]
+            if fail_list:  # 创建出错了就等下一轮定时检查再补充，不在这里死循环重试。
+                break
+
+    def _start_fill_to_min_idle_in_background(self):
         with self._lock:
-            t0 = time.time()
+            if self._is_filling_to_min_idle or len(self._idle_objects) >= self._min_idle:
+                return
+            self._is_filling_to_min_idle = True
+
+        def _fill():
             try:
-                # print(self._queue.qsize(), self._has_create_object_num,self.object_pool_size)
-                if self._queue.qsize() == 0 and self._has_create_object_num < self.object_pool_size:
-                    t1 = time.perf_counter()
-                    obj = self.object_type(**self._object_init_kwargs)
-                    self.logger.info(f'创建对象 {obj} ,耗时 {round(time.perf_counter() - t1, 3)}')
-                    self._queue.put(obj)
-                    self._has_create_object_num += 1
-                    # print(self._queue.qsize())
-                t2 = time.time()
-                obj = self._queue.get(block, timeout)
-                # print(time.time() -t2)
-                self.is_using_num += 1
-                self.logger.debug(f'获取对象 {obj}')
-                obj.the_obj_last_use_time = time.time()
-                return obj
-            except queue.Empty as e:
-                self.logger.critical(f'{e}  对象池暂时没有可用的对象了，请把timeout加大、或者不设置timeout(没有对象就进行永久阻塞等待)、或者设置把对象池的数量加大',
-                                     exc_info=True)
-                raise e
-            except Exception as e:
-                self.logger.critical(e, exc_info=True)
-                raise e
+                self._fill_to_min_idle()
             finally:
-                pass
-                # print(time.time() -t0)
+                self._is_filling_to_min_idle = False
+
+        threading.Thread(target=_fill, daemon=True).start()
+
+    def _is_prefer_create_new_object_locked(self):
+        """ 有空闲对象时是否仍然优先创建新对象，子类可以重写。"""
+        return False
+
+    def _try_acquire_locked(self):
+        """
+        必须在持有 self._lock 时调用。
+        :return: 空闲对象；或者 _CREATE_PERMIT 表示已经预留了一个创建名额；或者 None 表示暂时拿不到。
+        """
+        if self._idle_objects and not self._is_prefer_create_new_object_locked():
+            return self._idle_objects.pop()
+        if self._has_create_object_num < self.object_pool_size and self._creating_num < self._max_concurrent_create_num:
+            self._has_create_object_num += 1
+            self._creating_num += 1
+            return _CREATE_PERMIT
+        if self._idle_objects:
+            return self._idle_objects.pop()
+        return None
+
+    def _dispatch_to_waiters_locked(self):
+        """ 把空闲对象或者创建名额按先来后到交给等待者，必须在持有 self._lock 时调用。"""
+        while self._waiters:
+            ret = self._try_acquire_locked()
+            if ret is None:
+                break
+            waiter = self._waiters.popleft()
+            if ret is _CREATE_PERMIT:
+                waiter.is_permit_create = True
+            else:
+                waiter.obj = ret
+            waiter.condition.notify()
+
+    def _wait_in_line_locked(self, timeout):
+        waiter = _BorrowWaiter(self._lock)
+        self._waiters.append(waiter)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while waiter.obj is None and not waiter.is_permit_create:
+            if deadline is None:
+                waiter.condition.wait()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiters.remove(waiter)
+                    return None
+                waiter.condition.wait(remaining)
+        return _CREATE_PERMIT if waiter.is_permit_create else waiter.obj
+
+    def _create_object(self):
+        """ 在锁外面创建对象，创建名额已经在锁内预留好了。"""
+        t1 = time.perf_counter()
+        try:
+            obj = self.object_type(**self._object_init_kwargs)
+            obj.the_obj_create_time = time.time()
+            obj.the_obj_use_num = 0
+            obj.the_obj_expire_time = float('inf') if self._max_lifetime_seconds is None else \
+                obj.the_obj_create_time + self._max_lifetime_seconds * (1 - random.uniform(0, self._lifetime_jitter_ratio))
+            self._stats.on_create(time.perf_counter() - t1, True)
+            self._pool_logger.info('创建对象 %s ,耗时 %s', obj, round(time.perf_counter() - t1, 3))
+            return obj
+        except BaseException:
+            self._stats.on_create(time.perf_counter() - t1, False)
+            with self._lock:
+                self._has_create_object_num -= 1
+                self._dispatch_to_waiters_locked()
+            raise
+        finally:
+            with self._lock:
+                self._creating_num -= 1
+                self._dispatch_to_waiters_locked()
+
+    def _borrow_a_object(self, block, timeout):
+        t0 = time.perf_counter()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while 1:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                with self._lock:
+                    ret = None
+                    if not self._waiters:  # 已经有人在排队就不插队
+                        ret = self._try_acquire_locked()
+                    if ret is None and block and (remaining is None or remaining > 0):
+                        ret = self._wait_in_line_locked(remaining)
+                    if ret is None:
+                        raise queue.Empty
+                    if ret is not _CREATE_PERMIT:
+                        self.is_using_num += 1
+                if ret is _CREATE_PERMIT:
+                    obj = self._create_object()  # 刚创建的对象不需要检查
+                    with self._lock:
+                        self._on_borrow_created_object_locked(obj)
+                    break
+                obj = ret
+                if not self._is_need_validate_on_borrow(obj) or self._is_object_valid(obj):
+                    break
+                with self._lock:  # 检查不通过，摧毁掉再借一次
+                    self.is_using_num -= 1
+                    self._has_create_object_num -= 1
+                    self._dispatch_to_waiters_locked()
+                self._stats.on_validate_fail()
+                self._pool_logger.warning('对象 %s 检查不可用，摧毁它', obj)
+                self._destroy_object(obj)
+            obj.the_obj_use_num += 1
+            obj.the_obj_borrow_time = time.perf_counter()
+            self._stats.on_borrow(obj.the_obj_borrow_time - t0)
+            if self._pool_logger.isEnabledFor(logging.DEBUG):
+                self._pool_logger.debug('获取对象 %s', obj)
+            return obj
+        except queue.Empty as e:
+            self._stats.on_borrow_timeout()
+            self._pool_logger.critical('%s  对象池暂时没有可用的对象了，请把timeout加大、或者不设置timeout(没有对象就进行永久阻塞等待)、或者设置把对象池的数量加大',
+                                       e, exc_info=True)
+            raise e
+        except Exception as e:
+            self._pool_logger.critical(e, exc_info=True)
+            raise e
+
+    def _on_borrow_created_object_locked(self, obj):
+        self.is_using_num += 1
+
+    def _is_need_recycle(self, obj):
+        return obj.the_obj_expire_time < time.time() or (self._max_uses is not None and obj.the_obj_use_num >= self._max_uses)
 
     def _back_a_object(self, obj):
-        if getattr(obj, 'is_available', None) is False:
-            self.logger.critical(f'{obj} 不可用,不放入')
-            self._has_create_object_num -= 1
-        else:
-            self._queue.put(obj)
-            self.logger.debug(f'归还对象 {obj}')
-        self.is_using_num -= 1
+        is_invalidate = getattr(obj, 'is_available', None) is False
+        self._stats.on_back(time.perf_counter() - getattr(obj, 'the_obj_borrow_time', time.perf_counter()), is_invalidate)
+        is_recycle = not is_invalidate and self._is_need_recycle(obj)
+        with self._lock:
+            if is_invalidate or is_recycle:
+                self._has_create_object_num -= 1
+            else:
+                obj.the_obj_last_use_time = time.time()  # 在锁内按归还顺序记录时间，保证空闲队列按时间有序。
+                self._idle_objects.append(obj)
+            self.is_using_num -= 1
+            self._dispatch_to_waiters_locked()
+        if is_invalidate:
+            self._pool_logger.critical('%s 不可用,不放入', obj)
+            self._destroy_object(obj)
+        elif is_recycle:
+            self._stats.on_recycle()
+            self._pool_logger.info('%s 达到最大存活时间或者最大使用次数，摧毁它', obj)
+            self._destroy_object(obj)
+            self._start_fill_to_min_idle_in_background()
+        elif self._pool_logger.isEnabledFor(logging.DEBUG):
+            self._pool_logger.debug('归还对象 %s', obj)
 
     def get(self, block=True, timeout=None):
         return _ObjectContext(self, block=block, timeout=timeout)
 
+    @property
+    def queue(self) -> queue.LifoQueue:
+        """
+        兼容以前的 pool.queue 属性，以前空闲对象放在 LifoQueue 里面，现在放在 _idle_objects 双端队列里面。
+        返回的是当前空闲对象的只读快照，可以 qsize() empty() 查看空闲数量，往里面 put get 不会影响对象池。
+        """
+        with self._lock:
+            idle_objects = list(self._idle_objects)
+        q = queue.LifoQueue(self.object_pool_size)
+        for obj in idle_objects:
+            q.put_nowait(obj)
+        return q
+
+    def stats(self) -> dict:
+        """ 对象池的运行指标，包括借用等待耗时、占用耗时、创建耗时的直方图，以及当前空闲、使用中、总共的对象数量。"""
+        ret = self._stats.to_dict()
+        with self._lock:
+            ret.update(idle_num=len(self._idle_objects), using_num=self.is_using_num,
+                       total_num=self._has_create_object_num, waiting_num=len(self._waiters),
+                       object_pool_size=self.object_pool_size)
+        ret['clean_up_executor'] = self._clean_up_executor.stats()
+        return ret
+
+    def to_prometheus_text(self, pool_name=None) -> str:
+        return stats_to_prometheus_text(self.stats(), pool_name or self.object_type.__name__)
+
 
 # noinspection PyProtectedMember
 class _ObjectContext(nb_log.LoggerMixin):
@@ -113,12 +437,17 @@ class _ObjectContext(nb_log.LoggerMixin):
     def __exit__(self, exc_type, exc_val, exc_tb):
         # self.logger.info(self.obj)
         if exc_type:
-            self.logger.critical(exc_type)
+            self._pool._pool_logger.critical(exc_type)
         if exc_type in getattr(self.obj, 'error_type_list_set_not_available', []):
             self.obj._set_not_available()
         if self.obj is not None:
-            self.obj.before_back_to_queue(exc_type, exc_val, exc_tb)
-            self._pool._back_a_object(self.obj, )
+            try:
+                self.obj.before_back_to_queue(exc_type, exc_val, exc_tb)
+            except BaseException:
+                self.obj._set_not_available()  # 归还前的清理出错了(例如在断开的连接上 rollback)，不能再借给别人
+                raise
+            finally:
+                self._pool._back_a_object(self.obj, )  # 不管清理是否出错都要归还，否则对象池永久少一个名额
         self.obj = None
 
     def __del__(self):
@@ -128,13 +457,39 @@ class _ObjectContext(nb_log.LoggerMixin):
         self.obj = None
 
 
+@functools.lru_cache(maxsize=None)
+def _get_type_method_names(core_obj_type) -> frozenset:
+    """ 每种核心对象类型只计算一次，哪些属性是方法(可以绑定后缓存)，哪些是普通属性(每次都要实时取值，例如 cursor.lastrowid)。"""
+    names = set()
+    for name in dir(core_obj_type):
+        try:
+            if inspect.isroutine(inspect.getattr_static(core_obj_type, name)):
+                names.add(name)
+        except AttributeError:
+            pass
+    return frozenset(names)
+
+
 class AbstractObject(metaclass=abc.ABCMeta, ):
     error_type_list_set_not_available = []  # 可以设置当发生了什么类型的错误，就把对象设置为失效不可用。
+    max_concurrent_borrowers = 1  # 在 MultiplexObjectPool 中，一个对象最多同时借给几个借用者，对象自己要保证这么多线程同时用它是安全的。
+    is_cache_core_obj_methods = False  # 为True时，第一次通过自定义对象调用 core_obj 的某个方法后，绑定好的方法会缓存到自定义对象上，之后调用几乎和直接调用一样快。core_obj 重新赋值时缓存自动失效。
 
     @abc.abstractmethod
     def __init__(self):
         self.core_obj = None  # 这个主要是为了把自定义对象的属性指向的核心对象的方法自动全部注册到自定义对象的方法。
 
+    @property
+    def core_obj(self):
+        return self.__dict__['_core_obj'] if '_core_obj' in self.__dict__ else self.__getattr__('core_obj')
+
+    @core_obj.setter
+    def core_obj(self, value):
+        instance_dict = self.__dict__
+        for name in instance_dict.pop('_core_obj_cached_method_names', ()):  # 绑定的是旧 core_obj 的方法，要作废。
+            instance_dict.pop(name, None)
+        instance_dict['_core_obj'] = value
+
     @abc.abstractmethod
     def clean_up(self):
         """ 这里写关闭操作，如果没有逻辑，可以写 pass """
@@ -145,6 +500,13 @@ class AbstractObject(metaclass=abc.ABCMeta, ):
 
     def _set_not_available(self):
         self.is_available = False
+        on_set_not_available = self.__dict__.get('the_obj_on_set_not_available')  # 对象池需要马上知道时设置，例如 MultiplexObjectPool
+        if on_set_not_available is not None:
+            on_set_not_available(self)
+
+    def validate(self) -> bool:
+        """ 检查对象是否还能用，例如mysql连接ping一下。返回False或者抛出异常，对象池会摧毁这个对象。什么时候调用见 ObjectPool 的 validate_policy 参数。"""
+        return True
 
     @abc.abstractmethod
     def before_back_to_queue(self, exc_type, exc_val, exc_tb):
@@ -154,6 +516,16 @@ class AbstractObject(metaclass=abc.ABCMeta, ):
         """ 这个很强悍，可以使某个官方对象的全部方法和属性自动加到自己的自定义对象上面来。例如 myobj.conn.query(sql) 能直接 myobj.query(sql)"""
         # if 'item' in self.__dict__:
         #     return getattr(self,item)
-        if 'core_obj' in self.__dict__:
-            return getattr(self.core_obj, item)
+        instance_dict = self.__dict__
+        if '_core_obj' in instance_dict:
+            core_obj = instance_dict['_core_obj']
+            value = getattr(core_obj, item)
+            if self.is_cache_core_obj_methods and item in _get_type_method_names(type(core_obj)):
+                instance_dict[item] = value  # 下次直接从实例字典取到，不再进入 __getattr__
+                instance_dict.setdefault('_core_obj_cached_method_names', []).append(item)
+            return value
         raise ValueError(f'{item} 方法或属性不存在')
+
+from universal_object_pool.async_pool import AsyncObjectPool, AbstractAsyncObject  # noqa  放在最后面避免循环导入
+from universal_object_pool.keyed_pool import KeyedObjectPool  # noqa
+from universal_object_pool.multiplex_pool import MultiplexObjectPool  # noqa
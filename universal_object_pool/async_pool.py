@@ -0,0 +1,273 @@
+import abc
+import asyncio
+import collections
+import inspect
+import logging
+import time
+import typing
+
+import nb_log
+
+from universal_object_pool import AbstractObject, _disabled_logger
+from universal_object_pool.clean_up_executor import CleanUpExecutor, get_default_clean_up_executor
+from universal_object_pool.pool_stats import PoolStats, stats_to_prometheus_text
+
+"""
+asyncio 版本的对象池，用法和 ObjectPool 一样，只是 with 变成 async with 。
+
+AbstractObject 的 clean_up before_use before_back_to_queue 既可以写成普通方法，也可以写成 async def 。
+object_type 除了是类，也可以是一个 async def 的工厂函数，返回创建好的对象。
+没有对象时借用者 await 一个 asyncio.Future ，不会占用线程，一个事件循环可以同时有成千上万个借用者在等待。
+"""
+
+
+_CREATE_PERMIT = object()  # 表示借用者拿到的不是空闲对象，而是一个已经预留好的创建对象名额。
+
+
+async def _maybe_await(ret):
+    if inspect.isawaitable(ret):
+        return await ret
+    return ret
+
+
+class AsyncObjectPool(nb_log.LoggerMixin, nb_log.LoggerLevelSetterMixin):
+    def __init__(self, object_type, object_init_kwargs: dict = None, object_pool_size=10, max_idle_seconds=30 * 60,
+                 max_concurrent_create_num=5, cleanup_interval_seconds=10, cleanup_batch_size=None,
+                 clean_up_executor: CleanUpExecutor = None, clean_up_timeout=None,
+                 log_level=20, is_pool_log_enabled=True):
+        """
+        :param object_type: 对象类型，将会实例化此类。也可以是 async def 的工厂函数。
+        :param object_init_kwargs: 对象的__init__方法(或者工厂函数)的初始化参数
+        :param object_pool_size: 对象池大小
+        :param max_idle_seconds: 最大空闲时间，大于次时间没被使用的对象，将会被自动摧毁和弹出。摧毁是自动调用对象的clean_up方法
+        :param max_concurrent_create_num: 最多同时有几个协程在创建对象。
+        :param cleanup_interval_seconds: 每隔多少秒检查一次空闲超时的对象。
+        :param cleanup_batch_size: 每次检查最多摧毁多少个空闲超时的对象，None 表示不限制。
+        :param clean_up_executor: 普通方法(不是async def)的 clean_up 放在这个有界线程池里运行，不阻塞事件循环。不传则用默认共用的。
+        :param clean_up_timeout: 每个对象的 clean_up 最多等待多少秒，None 表示一直等待。
+        :param log_level: 对象池内部日志的级别。
+        :param is_pool_log_enabled: 为False则完全关闭对象池内部日志。
+        """
+        self._object_init_kwargs = {} if object_init_kwargs is None else object_init_kwargs
+        self._max_idle_seconds = max_idle_seconds
+        self.object_pool_size = object_pool_size
+        self._max_concurrent_create_num = max(1, max_concurrent_create_num)
+        self._idle_objects = collections.deque()
+        self._waiters = collections.deque()  # type: typing.Deque[asyncio.Future]
+        self.is_using_num = 0
+        self._has_create_object_num = 0
+        self._creating_num = 0
+        self.object_type = object_type
+        self._cleanup_interval_seconds = cleanup_interval_seconds
+        self._cleanup_batch_size = cleanup_batch_size
+        self._clean_up_executor = clean_up_executor or get_default_clean_up_executor()
+        self._clean_up_timeout = clean_up_timeout
+        self._stats = PoolStats()
+        self._cleanup_task = None  # type: typing.Optional[asyncio.Task]
+        self.logger.setLevel(log_level)
+        self._pool_logger = self.logger if is_pool_log_enabled else _disabled_logger
+
+    def _start_cleanup_task_if_need(self):
+        # 构造池的时候可能还没有运行中的事件循环，所以在第一次借用时才启动定时清理。
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.ensure_future(self._keep_circulating_check_and_cleanup_objects())
+
+    async def _keep_circulating_check_and_cleanup_objects(self):
+        while 1:
+            await asyncio.sleep(self._cleanup_interval_seconds)
+            try:
+                await self._check_and_cleanup_objects()
+            except Exception as e:
+                self._pool_logger.error(e, exc_info=True)
+
+    async def _check_and_cleanup_objects(self):
+        to_be_cleanup_objects = []
+        expire_time = time.time() - self._max_idle_seconds
+        while self._idle_objects and self._idle_objects[0].the_obj_last_use_time < expire_time:  # 空闲对象按归还时间有序
+            if self._cleanup_batch_size is not None and len(to_be_cleanup_objects) >= self._cleanup_batch_size:
+                break
+            to_be_cleanup_objects.append(self._idle_objects.popleft())
+        if not to_be_cleanup_objects:
+            return
+        self._has_create_object_num -= len(to_be_cleanup_objects)
+        self._dispatch_to_waiters()
+        for obj in to_be_cleanup_objects:
+            self._pool_logger.info('此对象空闲时间超过 %s  秒，使用 %s 方法 自动摧毁%s', self._max_idle_seconds, obj.clean_up, obj)
+            asyncio.ensure_future(self._clean_up_object(obj))
+
+    async def _clean_up_object(self, obj):
+        self._stats.on_destroy()
+        if not asyncio.iscoroutinefunction(obj.clean_up):
+            self._clean_up_executor.submit(obj, self._clean_up_timeout)
+            return
+        try:
+            await asyncio.wait_for(obj.clean_up(), self._clean_up_timeout)
+        except Exception as e:
+            self._pool_logger.error('摧毁对象 %s 出错 %s', obj, e, exc_info=True)
+
+    def _try_acquire(self):
+        if self._idle_objects:
+            return self._idle_objects.pop()
+        if self._has_create_object_num < self.object_pool_size and self._creating_num < self._max_concurrent_create_num:
+            self._has_create_object_num += 1
+            self._creating_num += 1
+            return _CREATE_PERMIT
+        return None
+
+    def _dispatch_to_waiters(self):
+        while self._waiters:
+            waiter = self._waiters[0]
+            if waiter.done():  # 已经超时或者被取消了
+                self._waiters.popleft()
+                continue
+            ret = self._try_acquire()
+            if ret is None:
+                break
+            self._waiters.popleft()
+            waiter.set_result(ret)
+
+    def _give_back_acquired(self, ret):
+        """ 借用者拿到了对象或者名额但是被取消了，要还回去。"""
+        if ret is _CREATE_PERMIT:
+            self._has_create_object_num -= 1
+            self._creating_num -= 1
+        else:
+            self._idle_objects.append(ret)
+        self._dispatch_to_waiters()
+
+    async def _create_object(self):
+        t1 = time.perf_counter()
+        try:
+            obj = await _maybe_await(self.object_type(**self._object_init_kwargs))
+            self._stats.on_create(time.perf_counter() - t1, True)
+            self._pool_logger.info('创建对象 %s ,耗时 %s', obj, round(time.perf_counter() - t1, 3))
+            return obj
+        except BaseException:
+            self._stats.on_create(time.perf_counter() - t1, False)
+            self._has_create_object_num -= 1
+            raise
+        finally:
+            self._creating_num -= 1
+            self._dispatch_to_waiters()
+
+    async def _borrow_a_object(self, block, timeout):
+        t0 = time.perf_counter()
+        self._start_cleanup_task_if_need()
+        ret = None
+        if not self._waiters:
+            ret = self._try_acquire()
+        if ret is None and block:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                ret = await asyncio.wait_for(asyncio.shield(waiter), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self._stats.on_borrow_timeout()
+                if waiter.done() and not waiter.cancelled():  # 刚好在超时的同时被分配到了
+                    self._give_back_acquired(waiter.result())
+                else:
+                    waiter.cancel()
+                    self._waiters.remove(waiter)
+                raise
+        if ret is None:
+            self._stats.on_borrow_timeout()
+            self._pool_logger.critical('对象池暂时没有可用的对象了，请把timeout加大、或者不设置timeout(没有对象就进行永久阻塞等待)、或者设置把对象池的数量加大')
+            raise asyncio.TimeoutError
+        obj = await self._create_object() if ret is _CREATE_PERMIT else ret
+        self.is_using_num += 1
+        obj.the_obj_borrow_time = time.perf_counter()
+        self._stats.on_borrow(obj.the_obj_borrow_time - t0)
+        if self._pool_logger.isEnabledFor(logging.DEBUG):
+            self._pool_logger.debug('获取对象 %s', obj)
+        return obj
+
+    def _back_a_object(self, obj):
+        is_invalidate = getattr(obj, 'is_available', None) is False
+        self._stats.on_back(time.perf_counter() - getattr(obj, 'the_obj_borrow_time', time.perf_counter()), is_invalidate)
+        if is_invalidate:
+            self._pool_logger.critical('%s 不可用,不放入', obj)
+            self._has_create_object_num -= 1
+            asyncio.ensure_future(self._clean_up_object(obj))
+        else:
+            obj.the_obj_last_use_time = time.time()
+            self._idle_objects.append(obj)
+            if self._pool_logger.isEnabledFor(logging.DEBUG):
+                self._pool_logger.debug('归还对象 %s', obj)
+        self.is_using_num -= 1
+        self._dispatch_to_waiters()
+
+    def get(self, block=True, timeout=None):
+        return _AsyncObjectContext(self, block=block, timeout=timeout)
+
+    def stats(self) -> dict:
+        """ 和 ObjectPool.stats 一样的指标。"""
+        ret = self._stats.to_dict()
+        ret.update(idle_num=len(self._idle_objects), using_num=self.is_using_num,
+                   total_num=self._has_create_object_num, waiting_num=len(self._waiters),
+                   object_pool_size=self.object_pool_size)
+        ret['clean_up_executor'] = self._clean_up_executor.stats()
+        return ret
+
+    def to_prometheus_text(self, pool_name=None) -> str:
+        return stats_to_prometheus_text(self.stats(), pool_name or getattr(self.object_type, '__qualname__', 'async_pool'))
+
+    async def close(self):
+        """ 摧毁所有空闲对象，停止定时清理。"""
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+        idle_objects, self._idle_objects = self._idle_objects, collections.deque()
+        self._has_create_object_num -= len(idle_objects)
+        await asyncio.gather(*[self._clean_up_object(obj) for obj in idle_objects])
+
+
+# noinspection PyProtectedMember
+class _AsyncObjectContext(nb_log.LoggerMixin):
+    def __init__(self, pool: AsyncObjectPool, block, timeout):
+        self._pool = pool
+        self._block = block
+        self._timeout = timeout
+        self.obj = None
+
+    async def __aenter__(self):
+        self.obj = await self._pool._borrow_a_object(self._block, self._timeout)
+        self.obj.is_available = True
+        try:
+            await _maybe_await(self.obj.before_use())
+        except BaseException:
+            self._pool._back_a_object(self.obj)
+            self.obj = None
+            raise
+        return self.obj
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self._pool._pool_logger.critical(exc_type)
+        if exc_type in getattr(self.obj, 'error_type_list_set_not_available', []):
+            self.obj._set_not_available()
+        if self.obj is not None:
+            try:
+                await _maybe_await(self.obj.before_back_to_queue(exc_type, exc_val, exc_tb))
+            except BaseException:
+                self.obj._set_not_available()  # 归还前的清理出错的对象不能再借给别人
+                raise
+            finally:
+                self._pool._back_a_object(self.obj)
+        self.obj = None
+
+
+class AbstractAsyncObject(AbstractObject):
+    """ 方便ide补全，生命周期方法都是 async def 的对象可以继承这个类。"""
+
+    @abc.abstractmethod
+    async def clean_up(self):
+        """ 这里写关闭操作，如果没有逻辑，可以写 pass """
+
+    async def before_use(self):
+        """ 可以每次对取出来的对象做一些操作"""
+        pass
+
+    @abc.abstractmethod
+    async def before_back_to_queue(self, exc_type, exc_val, exc_tb):
+        """ 这里写 async with 语法退出__aexit__前的操作，如果没有逻辑，可以写 pass """
@@ -0,0 +1,174 @@
+import collections
+import concurrent.futures
+import threading
+import time
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import nb_log
+
+"""
+把很多线程提交的单条数据攒成批量，按数量或者时间窗口批量刷出去，例如 mq 批量发布、mysql executemany 批量写入。
+每条数据提交后立即得到一个 Future ，批量刷出成功后 Future 得到这条数据对应的结果。
+"""
+
+
+class _PendingBatch:
+    __slots__ = ('deadline', 'items', 'futures')
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.items = []
+        self.futures = []  # type: typing.List[Future]
+
+
+class BatchFlusher(nb_log.LoggerMixin):
+    def __init__(self, flush_func: typing.Callable[[typing.Any, list], typing.Optional[list]], batch_size=100,
+                 flush_interval_seconds=0.05, max_workers=4, max_retry_times=2):
+        """
+        :param flush_func: flush_func(key, items) 批量刷出同一个key的一批数据，返回和 items 一一对应的结果列表，或者返回None表示每条结果都是None。
+                           结果列表中是异常对象的那一条，它的 Future 设置成这个异常，同一批的其他数据不受影响，也不会整批重试。
+                           一般在 flush_func 里面从对象池借一个对象来批量写入，出错重试时会重新借用，出错的对象设置成不可用后就不会再借到它。
+        :param batch_size: 同一个key攒够这么多条立即刷出
+        :param flush_interval_seconds: 一批数据的第一条提交后最多等待这么久就刷出，不管攒够没有
+        :param max_workers: 同时刷出的批次数量，一般设置成不超过对象池的 object_pool_size
+        :param max_retry_times: 一批刷出失败后重试次数，重试也失败了这一批的所有 Future 都设置成异常
+        """
+        self._flush_func = flush_func
+        self._batch_size = batch_size
+        self._flush_interval_seconds = flush_interval_seconds
+        self._max_retry_times = max_retry_times
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='batch_flusher')
+        self._condition = threading.Condition()
+        self._pending_batches = collections.OrderedDict()  # type: typing.Dict[typing.Any,_PendingBatch] # 按创建顺序排列，所以也是按deadline排序的
+        self._is_shutdown = False
+        self._stats_lock = threading.Lock()
+        self.submit_num = 0
+        self.flush_num = 0
+        self.flush_item_num = 0
+        self.retry_num = 0
+        self.fail_num = 0
+        self._timer_thread = threading.Thread(target=self._flush_expired_batches_forever, name='batch_flusher_timer', daemon=True)
+        self._timer_thread.start()
+
+    def submit(self, item, key=None) -> Future:
+        """
+        :param item: 一条数据
+        :param key: 只有同一个key的数据才会攒到同一批，例如 mq 的 routing_key ，mysql 的 sql 语句
+        :return: 这条数据刷出后的结果
+        """
+        future = Future()
+        with self._condition:
+            if self._is_shutdown:
+                raise RuntimeError('BatchFlusher 已经 shutdown ，不能再提交')
+            batch = self._pending_batches.get(key)
+            if batch is None:
+                batch = self._pending_batches[key] = _PendingBatch(time.monotonic() + self._flush_interval_seconds)
+                self._condition.notify()
+            batch.items.append(item)
+            batch.futures.append(future)
+            if len(batch.items) >= self._batch_size:
+                del self._pending_batches[key]
+            else:
+                batch = None
+        with self._stats_lock:
+            self.submit_num += 1
+        if batch is not None:
+            self._executor.submit(self._flush_batch, key, batch)
+        return future
+
+    def _pop_expired_batches_locked(self, is_all=False):
+        now = time.monotonic()
+        expired_batches = []
+        while self._pending_batches:
+            key, batch = next(iter(self._pending_batches.items()))
+            if not is_all and batch.deadline > now:
+                break
+            del self._pending_batches[key]
+            expired_batches.append((key, batch))
+        return expired_batches
+
+    def _flush_expired_batches_forever(self):
+        while True:
+            with self._condition:
+                while True:
+                    expired_batches = self._pop_expired_batches_locked(is_all=self._is_shutdown)
+                    if expired_batches:
+                        break
+                    if self._is_shutdown:
+                        return
+                    timeout = None
+                    if self._pending_batches:
+                        timeout = next(iter(self._pending_batches.values())).deadline - time.monotonic()
+                    self._condition.wait(timeout)
+            for key, batch in expired_batches:
+                self._executor.submit(self._flush_batch, key, batch)
+
+    def _flush_batch(self, key, batch: _PendingBatch):
+        # 刷出前已经被调用者 cancel 的数据不再刷出。
+        items = []
+        futures = []
+        for item, future in zip(batch.items, batch.futures):
+            if future.set_running_or_notify_cancel():
+                items.append(item)
+                futures.append(future)
+        if not items:
+            return
+        last_error = None
+        for retry_index in range(self._max_retry_times + 1):
+            if retry_index:
+                with self._stats_lock:
+                    self.retry_num += 1
+            try:
+                results = self._flush_func(key, items)
+                if results is None:
+                    results = [None] * len(items)
+                elif len(results) != len(items):
+                    raise ValueError(f'flush_func 返回了 {len(results)} 个结果，但是这一批有 {len(items)} 条数据')
+            except Exception as e:
+                last_error = e
+                self.logger.warning(f'批量刷出 {key} 的 {len(items)} 条数据出错，第 {retry_index + 1} 次， {type(e)} {e}')
+                continue
+            for future, result in zip(futures, results):
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            with self._stats_lock:
+                self.flush_num += 1
+                self.flush_item_num += len(items)
+            return
+        with self._stats_lock:
+            self.fail_num += 1
+        self.logger.error(f'批量刷出 {key} 的 {len(items)} 条数据重试 {self._max_retry_times} 次后仍然失败')
+        for future in futures:
+            future.set_exception(last_error)
+
+    def flush(self):
+        """ 立即刷出所有还没攒够的批次，并等待它们完成。"""
+        with self._condition:
+            expired_batches = self._pop_expired_batches_locked(is_all=True)
+        for key, batch in expired_batches:
+            self._executor.submit(self._flush_batch, key, batch)
+        concurrent.futures.wait([future for key, batch in expired_batches for future in batch.futures])
+
+    def shutdown(self, wait=True):
+        """ 不再接受提交，已经提交的数据全部刷出。"""
+        with self._condition:
+            self._is_shutdown = True
+            self._condition.notify()
+        self._timer_thread.join()
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def stats(self) -> dict:
+        with self._condition:
+            pending_num = sum(len(batch.items) for batch in self._pending_batches.values())
+        with self._stats_lock:
+            return dict(pending_num=pending_num, submit_num=self.submit_num, flush_num=self.flush_num,
+                        flush_item_num=self.flush_item_num, retry_num=self.retry_num, fail_num=self.fail_num)
@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+
+import nb_log
+
+
+class CleanUpExecutor(nb_log.LoggerMixin):
+    """
+    摧毁对象(调用对象的clean_up方法)专用的有界线程池，多个对象池可以共用一个。
+    以前是每摧毁一个对象就开一个线程，一次过期几百个http或者ssh连接就会同时开几百个线程。
+
+    clean_up 超时不再为每个对象单独开一个线程去等待，而是由一个看门狗线程检查正在执行的 clean_up 有没有超时。
+    python没法强制停止线程，超时的工作线程只能放弃，由看门狗补一个新的工作线程顶替它，
+    被放弃的线程等 clean_up 返回后自己退出。被放弃还没退出的线程最多 max_abandoned_num 个，
+    超过之后不再补线程，卡住的 clean_up 会占着线程池的名额，不会无限制地泄露线程。
+    """
+
+    def __init__(self, max_workers=10, max_abandoned_num=None):
+        """
+        :param max_workers: 最多同时有几个线程在摧毁对象
+        :param max_abandoned_num: clean_up 超时被放弃、还没退出的线程最多有几个，None 表示和 max_workers 一样多。
+        """
+        self._max_workers = max_workers
+        self._max_abandoned_num = max_workers if max_abandoned_num is None else max_abandoned_num
+        self._work_queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)  # 有设置超时的 clean_up 开始执行时通知看门狗
+        self._threads = set()  # 占着线程池名额的工作线程
+        self._abandoned_threads = set()  # clean_up 超时被放弃，还没退出的工作线程
+        self._running = {}  # 工作线程 -> (对象, 超时时刻, clean_up_timeout) ，只记录设置了超时的
+        self._thread_seq = 0
+        self._is_watchdog_started = False
+        self.destroy_num = 0
+        self.fail_num = 0
+        self.timeout_num = 0
+        self.total_destroy_seconds = 0.0
+        self.max_destroy_seconds = 0.0
+
+    def submit(self, obj, clean_up_timeout=None):
+        """
+        :param obj: 要摧毁的对象
+        :param clean_up_timeout: clean_up 最多等待多少秒，超时后放弃等待，线程池可以去摧毁下一个对象。None 表示一直等待。
+        """
+        self._work_queue.put((obj, clean_up_timeout))
+        with self._lock:
+            if len(self._threads) < self._max_workers:
+                self._start_thread_locked()
+
+    def _start_thread_locked(self):
+        self._thread_seq += 1
+        t = threading.Thread(target=self._work, name=f'object_pool_clean_up_{self._thread_seq}', daemon=True)
+        self._threads.add(t)
+        t.start()
+
+    def _work(self):
+        current_thread = threading.current_thread()
+        while True:
+            obj, clean_up_timeout = self._work_queue.get()
+            t0 = time.perf_counter()
+            if clean_up_timeout is not None:
+                with self._lock:
+                    self._running[current_thread] = (obj, t0 + clean_up_timeout, clean_up_timeout)
+                    if not self._is_watchdog_started:
+                        self._is_watchdog_started = True
+                        threading.Thread(target=self._watch_timeout, name='object_pool_clean_up_watchdog', daemon=True).start()
+                    self._condition.notify()
+            error = None
+            try:
+                obj.clean_up()
+            except Exception as e:
+                error = e
+            spend_seconds = time.perf_counter() - t0
+            with self._lock:
+                self._running.pop(current_thread, None)
+                is_timeout = current_thread in self._abandoned_threads
+                is_replaced = current_thread not in self._threads  # 已经有新线程顶替它了，执行完就退出
+                if is_timeout:
+                    self._abandoned_threads.discard(current_thread)  # 超时已经被看门狗统计过了
+                else:
+                    self.destroy_num += 1
+                    self.total_destroy_seconds += spend_seconds
+                    self.max_destroy_seconds = max(self.max_destroy_seconds, spend_seconds)
+                    if error is not None:
+                        self.fail_num += 1
+            if is_timeout:
+                self.logger.warning(f'摧毁对象 {obj} 超时之后又完成了，耗时 {round(spend_seconds, 3)} 秒')
+            elif error is not None:
+                self.logger.error(f'摧毁对象 {obj} 出错 {error}', exc_info=error)
+            if is_replaced:
+                return
+            del obj, error
+
+    def _watch_timeout(self):
+        while True:
+            timeout_list = []
+            with self._condition:
+                now = time.perf_counter()
+                next_deadline = None
+                for t, (obj, deadline, clean_up_timeout) in list(self._running.items()):
+                    if deadline > now:
+                        next_deadline = deadline if next_deadline is None else min(next_deadline, deadline)
+                        continue
+                    del self._running[t]
+                    self._abandoned_threads.add(t)
+                    self.destroy_num += 1
+                    self.timeout_num += 1
+                    self.total_destroy_seconds += clean_up_timeout
+                    self.max_destroy_seconds = max(self.max_destroy_seconds, clean_up_timeout)
+                    if len(self._abandoned_threads) <= self._max_abandoned_num:
+                        self._threads.discard(t)
+                        self._start_thread_locked()
+                    timeout_list.append((obj, clean_up_timeout))
+                if not timeout_list:
+                    self._condition.wait(None if next_deadline is None else next_deadline - now)
+            for obj, clean_up_timeout in timeout_list:
+                self.logger.error(f'摧毁对象 {obj} 超过 {clean_up_timeout} 秒没有完成，放弃等待')
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(destroy_num=self.destroy_num, fail_num=self.fail_num, timeout_num=self.timeout_num,
+                        abandoned_thread_num=len(self._abandoned_threads),
+                        avg_destroy_seconds=self.total_destroy_seconds / self.destroy_num if self.destroy_num else 0.0,
+                        max_destroy_seconds=self.max_destroy_seconds)
+
+
+_default_clean_up_executor = None
+_default_clean_up_executor_lock = threading.Lock()
+
+
+def get_default_clean_up_executor() -> CleanUpExecutor:
+    """ 没有指定 clean_up_executor 的对象池都共用这一个。"""
+    global _default_clean_up_executor
+    with _default_clean_up_executor_lock:
+        if _default_clean_up_executor is None:
+            _default_clean_up_executor = CleanUpExecutor()
+        return _default_clean_up_executor
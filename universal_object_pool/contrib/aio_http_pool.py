@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+from universal_object_pool import AsyncObjectPool, AbstractAsyncObject
+
+"""
+asyncio 版本的 http 长连接池，一个事件循环就能同时驱动成千上万个并发请求，不需要每个等待者一个线程。
+只实现了 http/1.1 的 Content-Length 和 chunked 两种响应体，够请求一般的接口和网关用了。
+"""
+
+
+class AsyncHttpResponse:
+    def __init__(self, status, reason, headers: dict, content: bytes, encoding='utf-8'):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self._encoding = encoding
+        self._text = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.content.decode(self._encoding)
+        return self._text
+
+
+class AsyncHttpOperator(AbstractAsyncObject):
+    error_type_list_set_not_available = [ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError]
+
+    def __init__(self, host, port=80, timeout=5):
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._reader = None  # type: asyncio.StreamReader
+        self._writer = None  # type: asyncio.StreamWriter
+        self._is_server_will_close = False
+
+    async def _ensure_connected(self):
+        if self._writer is None or self._is_server_will_close or self._writer.is_closing():
+            await self.clean_up()
+            self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self._host, self._port), self._timeout)
+            self._is_server_will_close = False
+
+    async def clean_up(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def before_back_to_queue(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def request_and_getresponse(self, method, url, body: bytes = None, headers: dict = None, encoding='utf-8') -> AsyncHttpResponse:
+        await self._ensure_connected()
+        headers = dict(headers or {})
+        headers.setdefault('Host', f'{self._host}:{self._port}')
+        headers['Content-Length'] = str(len(body) if body else 0)
+        head = f'{method} {url} HTTP/1.1\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in headers.items()) + '\r\n'
+        self._writer.write(head.encode('latin-1') + (body or b''))
+        await self._writer.drain()
+        return await asyncio.wait_for(self._read_response(encoding), self._timeout)
+
+    async def _read_response(self, encoding):
+        status_line = (await self._reader.readuntil(b'\r\n')).decode('latin-1').rstrip('\r\n')
+        _, status, reason = (status_line.split(' ', 2) + [''])[:3]
+        resp_headers = {}
+        while 1:
+            line = (await self._reader.readuntil(b'\r\n')).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            k, v = line.split(':', 1)
+            resp_headers[k.strip().lower()] = v.strip()
+        if resp_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while 1:
+                size = int((await self._reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if size == 0:
+                    await self._reader.readuntil(b'\r\n')
+                    break
+                chunks.append(await self._reader.readexactly(size))
+                await self._reader.readexactly(2)
+            content = b''.join(chunks)
+        elif 'content-length' in resp_headers:
+            content = await self._reader.readexactly(int(resp_headers['content-length']))
+        else:  # 没有长度信息，只能读到服务端关闭连接
+            content = await self._reader.read()
+            self._is_server_will_close = True
+        if resp_headers.get('connection', '').lower() == 'close':
+            self._is_server_will_close = True
+        return AsyncHttpResponse(int(status), reason, resp_headers, content, encoding)
+
+
+if __name__ == '__main__':
+    http_pool = AsyncObjectPool(object_type=AsyncHttpOperator, object_pool_size=100,
+                                object_init_kwargs=dict(host='127.0.0.1', port=5678), max_idle_seconds=30)
+
+
+    async def test_request():
+        async with http_pool.get() as conn:  # type: AsyncHttpOperator
+            r1 = await conn.request_and_getresponse('GET', '/')
+            print(r1.text[:10], )
+
+
+    async def main():
+        t1 = time.perf_counter()
+        await asyncio.gather(*[test_request() for _ in range(30000)])  # 可以先启动 tests_object_pool/aio_server.py
+        print(time.perf_counter() - t1)
+
+
+    asyncio.get_event_loop().run_until_complete(main())
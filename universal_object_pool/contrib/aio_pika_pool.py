@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+import aio_pika
+import nb_log
+
+from universal_object_pool import AsyncObjectPool, AbstractAsyncObject
+
+"""
+asyncio 版本的 rabbitmq 发布池，使用 aio_pika ，和 pika_pool.py 的 PikaOperator 用法一样。
+"""
+
+
+class AioPikaOperator(AbstractAsyncObject):
+    error_type_list_set_not_available = [aio_pika.exceptions.AMQPError, ConnectionError]
+
+    def __init__(self, connection: aio_pika.RobustConnection, channel: aio_pika.Channel, queue):
+        self.connection = connection
+        self.channel = self.core_obj = channel
+        self._queue = queue
+        self.logger = nb_log.get_logger(self.__class__.__name__)
+
+    @classmethod
+    async def create(cls, host, port, user, password, queue):
+        """ 创建连接是异步的，所以把这个异步工厂函数作为 AsyncObjectPool 的 object_type 。"""
+        connection = await aio_pika.connect_robust(host=host, port=port, login=user, password=password, heartbeat=20)
+        channel = await connection.channel()
+        await channel.declare_queue(queue)
+        return cls(connection, channel, queue)
+
+    async def simple_publish(self, body: str):
+        await self.channel.default_exchange.publish(aio_pika.Message(body=body.encode()), routing_key=self._queue)
+
+    async def clean_up(self):
+        await self.channel.close()
+        await self.connection.close()
+
+    async def before_back_to_queue(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+if __name__ == '__main__':
+    pika_pool = AsyncObjectPool(object_type=AioPikaOperator.create, object_pool_size=10, object_init_kwargs=dict(
+        host='106.55.244.xxx', port=5672, user='xxxx', password='xxxx', queue='test_pika_pool_queue7'),
+                                max_idle_seconds=60)
+
+
+    async def test_publish():
+        async with pika_pool.get() as ch:  # type: AioPikaOperator
+            await ch.simple_publish('hello')
+
+
+    async def main():
+        t1 = time.perf_counter()
+        await asyncio.gather(*[test_publish() for _ in range(50000)])
+        print(time.perf_counter() - t1)
+
+
+    asyncio.get_event_loop().run_until_complete(main())
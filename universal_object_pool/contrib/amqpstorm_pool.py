@@ -0,0 +1,74 @@
+import threading
+import time
+import typing
+import amqpstorm
+from amqpstorm import AMQPError
+
+from universal_object_pool import MultiplexObjectPool, AbstractObject
+from threadpool_executor_shrink_able import BoundedThreadPoolExecutor
+import decorator_libs
+
+
+class AmqpStormOperator(AbstractObject):
+    """
+    amqpstorm 的连接是线程安全的，channel 不是。一个连接同时借给几个线程，每个线程在这个连接上使用自己的 channel ，
+    配合 MultiplexObjectPool 使用，比一个线程独占一个连接，socket 连接数少 max_concurrent_borrowers 倍。
+    """
+    max_concurrent_borrowers = 8
+
+    error_type_list_set_not_available = [AMQPError]
+
+    def __init__(self, host, port, user, password, queue):
+        self._queue = queue
+        self.connection = amqpstorm.Connection(host, user, password, port=port, heartbeat=60)
+        self._thread_local = threading.local()
+        self._all_channels = []
+        self._lock = threading.Lock()
+        self.core_obj = self.connection
+
+    @property
+    def channel(self) -> amqpstorm.Channel:
+        """ 当前线程自己的 channel ，第一次使用时创建，之后同一个线程借到这个连接时复用。"""
+        channel = getattr(self._thread_local, 'channel', None)
+        if channel is None or not channel.is_open:
+            channel = self.connection.channel()
+            channel.queue.declare(queue=self._queue)
+            self._thread_local.channel = channel
+            with self._lock:
+                self._all_channels.append(channel)
+        return channel
+
+    def simple_publish(self, body):
+        self.channel.basic.publish(body=body, routing_key=self._queue)
+
+    def clean_up(self):
+        for channel in self._all_channels:
+            if channel.is_open:
+                channel.close()
+        self.connection.close()
+
+    def before_back_to_queue(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def validate(self):
+        return self.connection.is_open
+
+
+if __name__ == '__main__':
+    amqpstorm_pool = MultiplexObjectPool(object_type=AmqpStormOperator, object_pool_size=10, object_init_kwargs=dict(
+        host='106.55.244.xxx', port=5672, user='xxxx', password='xxxx', queue='test_amqpstorm_pool_queue'),
+                                         max_idle_seconds=60)
+
+
+    def test_publish():
+        with amqpstorm_pool.get() as op:  # type: typing.Union[amqpstorm.Connection,AmqpStormOperator]
+            op.simple_publish('hello')
+
+
+    thread_pool = BoundedThreadPoolExecutor(50)
+    with decorator_libs.TimerContextManager():
+        for x in range(50000):
+            thread_pool.submit(test_publish, )
+        thread_pool.shutdown()
+    print(amqpstorm_pool.stats()['total_num'])  # 50个线程并发，只需要7个连接
+    time.sleep(10000)
@@ -1,6 +1,10 @@
+import os
+import select
+import threading
 import time
 import typing
 import http
+from concurrent.futures import ThreadPoolExecutor
 from http.client import HTTPConnection, HTTPResponse
 import nb_log
 
@@ -9,35 +13,236 @@ from threadpool_executor_shrink_able import BoundedThreadPoolExecutor
 import decorator_libs
 
 
-class CustomHTTPResponse(HTTPResponse):  # 为了ide补全
-    text: str = None
-    content: bytes = None
+def _is_readable_now(sock) -> bool:
+    """
+    不等待，检查socket现在是否可读(对方关闭了连接也算可读)。
+    select.select 不能用于 fd >= FD_SETSIZE(1024) 的socket，爬虫同时保持几千个 keep-alive 连接时 fd 很容易超过，所以用 poll 。
+    """
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(0))  # 对方关闭或者出错时 POLLHUP POLLERR 也会返回
+    return bool(select.select([sock], [], [], 0)[0])  # windows 没有 poll ，windows 的 select 没有 fd 大小的限制
+
+
+class CustomHTTPResponse(HTTPResponse):
+    """
+    content 和 text 都是第一次访问时才读取和解码，只需要bytes或者流式写文件时，内存中不会同时存在 bytes 和 str 两份响应体。
+    """
+    encoding = 'utf-8'
+    _content = None
+    _text = None
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            self._content = self.read()
+        return self._content
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.content.decode(self.encoding)
+        return self._text
+
+    def iter_chunks(self, chunk_size=64 * 1024) -> typing.Iterator[memoryview]:
+        """
+        用 readinto 把响应体读到一个复用的 bytearray 里面，每次 yield 这个缓冲区的 memoryview 切片，不会为每一块新建 bytes 对象。
+        下一次迭代会覆盖上一块的内容，需要保留的话调用者自己 bytes(chunk) 。
+        """
+        buffer = memoryview(bytearray(chunk_size))
+        while True:
+            n = self.readinto(buffer)
+            if not n:
+                break
+            yield buffer[:n]
+
+    def save_to_file(self, file, chunk_size=64 * 1024) -> int:
+        """
+        :param file: 文件路径，或者已经以二进制写模式打开的文件对象
+        :return: 写入的字节数
+        """
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, 'wb') as f:
+                return self.save_to_file(f, chunk_size)
+        size = 0
+        for chunk in self.iter_chunks(chunk_size):
+            file.write(chunk)
+            size += len(chunk)
+        return size
 
 
 class HttpOperator(AbstractObject):
     """ 这个请求速度暴击requests，可以自行测试请求nginx网关本身"""
     error_type_list_set_not_available = [http.client.CannotSendRequest]
+    max_drain_size = 64 * 1024  # 归还时响应体剩余不超过这么多字节就读完复用连接，超过了就关闭连接
+    keep_alive_margin_seconds = 1  # 服务端 Keep-Alive: timeout=N 的连接，提前这么多秒就不再复用，避免和服务端关闭连接撞在一起
+    idempotent_methods = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
 
     def __init__(self, host, port=None, timeout=5,
                  source_address=None):
         self.conn = HTTPConnection(host=host, port=port, timeout=timeout, source_address=source_address, )
+        self.conn.response_class = CustomHTTPResponse
         self.core_obj = self.conn
+        self._last_resp = None  # type: typing.Optional[CustomHTTPResponse]
+        self._keep_alive_expire_time = None  # 服务端声明的当前socket空闲到什么时候会被关闭
+        self._keep_alive_remain_num = None  # 服务端声明的当前socket还能发几个请求
+        self.reconnect_num = 0  # 因为服务端关闭了连接或者即将关闭连接而重连的次数
 
     def clean_up(self):
         self.conn.close()
 
     def before_back_to_queue(self, exc_type, exc_val, exc_tb):
-        pass
+        # 响应体没读完的连接不能直接给下一个借用者发请求，剩下的不多就读完，否则关闭socket，下次请求时自动重连。
+        resp = self._last_resp
+        self._last_resp = None
+        if resp is not None and not resp.isclosed():
+            if resp.length is not None and resp.length <= self.max_drain_size:
+                try:
+                    resp.read()
+                    return
+                except (OSError, http.client.HTTPException):
+                    pass
+            self.conn.close()
+
+    def validate(self):
+        return self.conn.sock is None or self.conn.sock.fileno() != -1  # sock为None时下次请求会自动重连
+
+    def before_use(self):
+        self._close_if_stale()
+
+    def _close_if_stale(self):
+        """
+        服务端已经关闭或者即将关闭的 keep-alive 连接，在发请求之前就关掉，下次请求时 http.client 自动新建连接，不让借用者撞上死socket。
+        空闲的 keep-alive socket 变成可读，说明服务端发了 FIN (或者发了不该发的数据)，这个连接不能再用了。
+        """
+        sock = self.conn.sock
+        if sock is None or (self._last_resp is not None and not self._last_resp.isclosed()):
+            return
+        if (self._keep_alive_expire_time is not None and time.time() >= self._keep_alive_expire_time) or \
+                self._keep_alive_remain_num == 0 or _is_readable_now(sock):
+            self.conn.close()
+            self.reconnect_num += 1
+
+    def _record_keep_alive(self, resp: CustomHTTPResponse, is_reused_sock):
+        if not is_reused_sock:
+            self._keep_alive_expire_time = None
+            self._keep_alive_remain_num = None
+        keep_alive = resp.getheader('Keep-Alive')  # 例如 timeout=5, max=100
+        if keep_alive:
+            for item in keep_alive.split(','):
+                name, _, value = item.strip().partition('=')
+                try:
+                    if name.lower() == 'timeout':
+                        self._keep_alive_expire_time = time.time() + int(value) - self.keep_alive_margin_seconds
+                    elif name.lower() == 'max':
+                        self._keep_alive_remain_num = int(value)
+                except ValueError:
+                    pass
+        # 响应头有 Connection: close 或者是 HTTP/1.0 时 will_close 为True，http.client 读完响应后会自己关闭socket，下次请求自动重连。
 
     # noinspection PyDefaultArgument
     def request_and_getresponse(self, method, url, body=None, headers={}, *,
                                 encode_chunked=False, encoding="utf-8") -> CustomHTTPResponse:
-        self.conn.request(method, url, body=body, headers=headers,
-                          encode_chunked=encode_chunked)
-        resp = self.conn.getresponse()
-        resp.content = resp.read()
-        resp.text = resp.content.decode(encoding)
-        return resp  # noqa
+        resp = self.request_stream(method, url, body=body, headers=headers, encode_chunked=encode_chunked, encoding=encoding)
+        resp._content = resp.read()  # 读完响应体，连接才能被下一个请求复用。text 在第一次访问时才解码。
+        return resp
+
+    # noinspection PyDefaultArgument
+    def request_stream(self, method, url, body=None, headers={}, *,
+                       encode_chunked=False, encoding="utf-8") -> CustomHTTPResponse:
+        """
+        只读取响应头，响应体由调用者用 iter_chunks 、save_to_file 或者 content 读取。
+        必须在归还连接之前读完，没读完的话归还时剩余不多会自动读完，剩余太多会关闭这个连接。
+        """
+        self._close_if_stale()
+        is_reused_sock = self.conn.sock is not None
+        try:
+            self.conn.request(method, url, body=body, headers=headers,
+                              encode_chunked=encode_chunked)
+            resp = self.conn.getresponse()  # type: CustomHTTPResponse
+        except ConnectionError:
+            # 服务端恰好在发请求的同时关闭了空闲连接，幂等请求并且请求体可以重发时，换一个新连接透明重试一次。
+            if not is_reused_sock or method.upper() not in self.idempotent_methods or not isinstance(body, (type(None), bytes, str)):
+                raise
+            self.conn.close()
+            self.reconnect_num += 1
+            is_reused_sock = False
+            self.conn.request(method, url, body=body, headers=headers,
+                              encode_chunked=encode_chunked)
+            resp = self.conn.getresponse()
+        self._record_keep_alive(resp, is_reused_sock)
+        resp.encoding = encoding
+        self._last_resp = resp
+        return resp
+
+    # noinspection PyDefaultArgument
+    def download_to_file(self, url, file, method='GET', body=None, headers={}, chunk_size=64 * 1024) -> int:
+        """
+        响应体用 readinto 分块写入文件，大文件不会整个读到内存。
+        :return: 写入的字节数
+        """
+        return self.request_stream(method, url, body=body, headers=headers).save_to_file(file, chunk_size)
+
+
+def request_batch(http_pool: ObjectPool, request_list: list, max_workers=None, return_exceptions=False, encoding='utf-8',
+                  borrow_timeout=None) -> typing.List[CustomHTTPResponse]:
+    """
+    把一批请求分散到连接池的多个连接上并发发送，按 request_list 的顺序返回响应。
+    每个工作线程只借用一次连接，在这个连接上一个接一个的发请求，不是每个请求借还一次。
+    http.client 不支持 HTTP pipelining (一个连接上不等响应连续发多个请求)，服务端支持得也不好，所以是多个连接并发。
+
+    :param request_list: 每个元素是 (method, url) 或者 (method, url, body, headers) ，或者 request_and_getresponse 的关键字参数字典
+    :param max_workers: 同时使用的连接数，默认是对象池大小
+    :param return_exceptions: True 时出错的请求在结果中对应位置是异常对象，False 时抛出第一个异常
+    """
+    results = [None] * len(request_list)
+    index_iter = iter(range(len(request_list)))
+    index_lock = threading.Lock()
+
+    def _next_index():
+        with index_lock:
+            return next(index_iter, None)
+
+    def _work():
+        with http_pool.get(timeout=borrow_timeout) as conn:  # type: HttpOperator
+            while True:
+                index = _next_index()
+                if index is None:
+                    return
+                req = request_list[index]
+                kwargs = dict(req) if isinstance(req, dict) else dict(zip(('method', 'url', 'body', 'headers'), req))
+                kwargs.setdefault('encoding', encoding)
+                try:
+                    results[index] = conn.request_and_getresponse(**kwargs)
+                except Exception as e:  # 这个连接可能已经坏了，关掉，下一个请求自动重连
+                    conn.conn.close()
+                    results[index] = e
+
+    worker_num = min(max_workers or http_pool.object_pool_size, len(request_list))
+    if worker_num:
+        with ThreadPoolExecutor(worker_num, thread_name_prefix='http_request_batch') as executor:
+            for f in [executor.submit(_work) for _ in range(worker_num)]:
+                f.result()
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    return results
+
+
+# noinspection PyDefaultArgument
+def stream_request(http_pool: ObjectPool, method, url, body=None, headers={}, chunk_size=64 * 1024, borrow_timeout=None) -> typing.Iterator[memoryview]:
+    """
+    从连接池借一个连接，流式迭代响应体，响应体读完或者生成器被关闭时归还连接。第一次迭代时才借用连接。
+    yield 的是复用缓冲区的 memoryview ，见 CustomHTTPResponse.iter_chunks 。
+    """
+    with http_pool.get(timeout=borrow_timeout) as conn:  # type: HttpOperator
+        resp = conn.request_stream(method, url, body=body, headers=headers)
+        try:
+            yield from resp.iter_chunks(chunk_size)
+        except GeneratorExit:
+            return  # 调用者不再读取了，不是错误，正常归还，before_back_to_queue 会处理没读完的响应体。
 
 
 if __name__ == '__main__':
@@ -75,4 +280,8 @@ if __name__ == '__main__':
             thread_pool.submit(test_request, )
             # thread_pool.submit(test_update_multi_threads_use_one_conn, x)
         thread_pool.shutdown()
+
+    with decorator_libs.TimerContextManager():
+        responses = request_batch(http_pool, [('GET', f'/?x={x}') for x in range(30000)])  # 结果和请求的顺序一致
+        print(responses[-1].text)
     time.sleep(10000)
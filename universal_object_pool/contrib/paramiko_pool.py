@@ -1,11 +1,19 @@
+import collections
+import os
+import posixpath
+import selectors
+import socket
+import stat
+import threading
 import time
 import typing
 import decorator_libs
 import paramiko
 import nb_log
+from concurrent.futures import ThreadPoolExecutor
 from threadpool_executor_shrink_able import BoundedThreadPoolExecutor
 
-from universal_object_pool import AbstractObject, ObjectPool
+from universal_object_pool import AbstractObject, ObjectPool, MultiplexObjectPool
 
 """
  t = paramiko.Transport((self._host, self._port))
@@ -20,19 +28,22 @@ from universal_object_pool import AbstractObject, ObjectPool
 """
 
 
-class ParamikoOperator( AbstractObject):
+class ParamikoOperator(AbstractObject):
     """
     这个是linux操作包的池化。例如执行的shell命令耗时比较长，如果不采用池，那么一个接一个的命令执行将会很耗时。
     如果每次临时创建和摧毁linux连接，会很多耗时和耗cpu开销。
-    """
-
-    def __init__(self, host, port, username, password):
-        # self.logger = nb_log.get_logger('ParamikoOperator')
-
-        t = paramiko.Transport((host, port))
-        t.connect(username=username, password=password)
-        self.sftp = paramiko.SFTPClient.from_transport(t)
 
+    一个对象只有一个ssh连接(一个 Transport)，exec 命令和 sftp 都是在这个连接上开的 channel ，paramiko 的 Transport 是线程安全的。
+    配合 MultiplexObjectPool 使用，一个连接同时借给多个线程，每个线程开自己的 channel ，连接数少好几倍，
+    每个连接同时打开的 channel 数量不能超过 sshd 的 MaxSessions(默认10) 。用 ObjectPool 就是和以前一样独占。
+    """
+    def __init__(self, host, port, username, password, max_sessions=10, sftp_window_size=16 * 1024 * 1024):
+        """
+        :param max_sessions: sshd_config 里面的 MaxSessions 。每个借用者最多同时用一个 exec channel 和一个 sftp channel ，
+                             所以在 MultiplexObjectPool 中一个连接最多同时借给 max_sessions // 2 个借用者。
+        :param sftp_window_size: sftp channel 的ssh流控窗口大小，paramiko 默认2MB，高延迟的网络传大文件时窗口太小，发一会就要停下来等对方确认。
+        """
+        self._sftp_window_size = sftp_window_size
         ssh = paramiko.SSHClient()
         # ssh.load_system_host_keys()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -41,17 +52,53 @@ class ParamikoOperator( AbstractObject):
         # private = paramiko.RSAKey.from_private_key_file('C:/Users/Administrator/.ssh/id_rsa')  # 秘钥方式
         # ssh.connect(host, port=port, username=username, pkey=private)
         self.ssh = self.core_obj = ssh
-
-        self.ssh_session = self.ssh.get_transport().open_session()
+        self.max_concurrent_borrowers = max(1, max_sessions // 2)
+        self._thread_local = threading.local()
+        self._idle_sftp_clients = []  # 借用者归还后留下来的 sftp channel ，下一个借用者直接用，数量不超过同时借用者数量
+        self._all_sftp_clients = []
+        self._lock = threading.Lock()
 
         self.logger = nb_log.get_logger(self.__class__.__name__)
 
+    @property
+    def sftp(self) -> paramiko.SFTPClient:
+        """
+        当前借用者自己的 sftp channel ，在同一个ssh连接上打开，归还对象时留给下一个借用者，不用每次重新打开。
+        同一个线程嵌套借到同一个连接时共用一个 sftp ，最外层归还时才留给下一个借用者，所以借用者不要自己 close 它。
+        """
+        sftp = getattr(self._thread_local, 'sftp', None)
+        if sftp is None:
+            with self._lock:
+                sftp = self._idle_sftp_clients.pop() if self._idle_sftp_clients else None
+            if sftp is None:
+                sftp = paramiko.SFTPClient.from_transport(self.ssh.get_transport(), window_size=self._sftp_window_size)
+                with self._lock:
+                    self._all_sftp_clients.append(sftp)
+            self._thread_local.sftp = sftp
+        return sftp
+
     def clean_up(self):
-        self.sftp.close()
+        for sftp in self._all_sftp_clients:
+            sftp.close()
         self.ssh.close()
 
+    def before_use(self):
+        self._thread_local.borrow_depth = getattr(self._thread_local, 'borrow_depth', 0) + 1
+
     def before_back_to_queue(self, exc_type, exc_val, exc_tb):
-        pass
+        self._thread_local.borrow_depth = getattr(self._thread_local, 'borrow_depth', 1) - 1
+        if self._thread_local.borrow_depth > 0:
+            # MultiplexObjectPool 允许同一个线程嵌套借到同一个连接，内外两层用的是同一个 sftp ，外层还没归还，不能留给别的借用者
+            return
+        sftp = getattr(self._thread_local, 'sftp', None)
+        if sftp is not None:
+            self._thread_local.sftp = None
+            if not sftp.get_channel().closed:
+                with self._lock:
+                    self._idle_sftp_clients.append(sftp)
+
+    def validate(self):
+        return self.ssh.get_transport().is_active()
 
     def exec_cmd(self, cmd):
         # paramiko.channel.ChannelFile.readlines()
@@ -65,11 +112,269 @@ class ParamikoOperator( AbstractObject):
             self.logger.error('执行 {} 命令的stderr是 -- > \n{}'.format(cmd, stderr_str))
         return stdout_str, stderr_str
 
+    def iter_exec_cmd(self, cmd, is_combine_stderr=True, chunk_size=32768, encoding='utf-8', timeout=None):
+        """
+        流式执行命令，命令输出一行就 yield 一行(不带换行符)，适合输出很多或者运行很久的命令，不会把全部输出读到内存里。
+        等待输出用的是 selectors ，不轮询，也没有 select.select 的 fd 不能超过1024的限制。生成器提前关闭时关闭这个 channel ，远程命令会收到 SIGHUP 。
+        :param is_combine_stderr: True 则 stderr 合并到 stdout 一起 yield ；False 则只 yield stdout ，stderr 的每一行记录错误日志。
+        :param timeout: 超过这么多秒没有任何输出就关闭 channel 并抛出 socket.timeout ，卡住的远程命令不会一直占着借用的连接。None 表示一直等待。
+        """
+        self.logger.debug('要流式执行的命令是： ' + cmd)
+        channel = self.ssh.get_transport().open_session()
+        selector = selectors.DefaultSelector()
+        try:
+            channel.set_combine_stderr(is_combine_stderr)
+            channel.exec_command(cmd)
+            selector.register(channel, selectors.EVENT_READ)  # 有数据、收到EOF或者 channel 关闭时可读
+            stdout_buffer = bytearray()
+            stderr_buffer = bytearray()
+            is_eof = False
+            while not is_eof:
+                if not selector.select(timeout):
+                    raise socket.timeout(f'执行 {cmd} 命令超过 {timeout} 秒没有输出')
+                is_eof = channel.eof_received or channel.closed  # 先判断EOF再读，EOF之前到达的数据在下面一定能读完
+                while channel.recv_stderr_ready():
+                    stderr_buffer += channel.recv_stderr(chunk_size)
+                    for line in self._pop_lines(stderr_buffer, encoding):
+                        self.logger.error(f'执行 {cmd} 命令的stderr是 -- > {line}')
+                while channel.recv_ready():
+                    stdout_buffer += channel.recv(chunk_size)
+                    yield from self._pop_lines(stdout_buffer, encoding)
+            if stdout_buffer:
+                yield stdout_buffer.decode(encoding, errors='replace')
+            if stderr_buffer:
+                self.logger.error(f'执行 {cmd} 命令的stderr是 -- > {stderr_buffer.decode(encoding, errors="replace")}')
+            exit_status = channel.recv_exit_status()
+            if exit_status != 0:
+                self.logger.warning(f'执行 {cmd} 命令的退出码是 {exit_status}')
+        finally:
+            selector.close()
+            channel.close()
+
+    @staticmethod
+    def _pop_lines(buffer: bytearray, encoding) -> list:
+        """ 取出 buffer 中所有完整的行，不完整的最后一行留在 buffer 里等后面的数据。"""
+        index = buffer.rfind(b'\n')
+        if index == -1:
+            return []
+        lines = buffer[:index].decode(encoding, errors='replace').split('\n')
+        del buffer[:index + 1]
+        return lines
+
+
+def stream_exec_cmd(paramiko_pool: ObjectPool, cmd, is_combine_stderr=True, borrow_timeout=None, timeout=None):
+    """
+    从对象池借一个连接流式执行命令，命令结束或者生成器被关闭时自动归还。第一次迭代时才借用。
+    用 MultiplexObjectPool 时一个运行很久的命令只占用连接上的一个 channel ，不会独占整个连接。
+    timeout 是多少秒没有输出就放弃，见 ParamikoOperator.iter_exec_cmd ，超时后连接正常归还。
+
+    for line in stream_exec_cmd(paramiko_pool, 'tail -n 100000 /var/log/syslog'):
+        print(line)
+    """
+    with paramiko_pool.get(timeout=borrow_timeout) as operator:  # type: ParamikoOperator
+        lines = operator.iter_exec_cmd(cmd, is_combine_stderr=is_combine_stderr, timeout=timeout)
+        try:
+            yield from lines
+        except GeneratorExit:
+            return  # 调用者不再读取了，不是错误，正常归还连接。
+        finally:
+            lines.close()
+
+
+class ParamikoObjectPool(MultiplexObjectPool):
+    """
+    一台linux机器的 ParamikoOperator 连接池，加上批量并发传输文件。以前传文件只能借一个对象用它的 sftp 一个接一个的传。
+    put_many get_many 把文件分散到连接池的多个 sftp channel 上并发传输，大文件先传，最后不会剩一个大文件拖着。
+    paramiko 上传时是流水线写(不等每块的确认就发下一块)，下载时是预读(一次发出所有读请求)，再加上 sftp_window_size 大窗口，单个大文件也能跑满带宽。
+    一个文件传输出错后重试这个文件，ssh连接断开了才把这个连接标记为不可用，重新借一个别的连接重试，本地文件不存在、没有权限这类错误不重试。
+    """
+
+    def __init__(self, host, port, username, password, max_sessions=10, sftp_window_size=16 * 1024 * 1024, object_pool_size=4, **pool_kwargs):
+        """
+        :param object_pool_size: 最多几个ssh连接，每个连接同时借给 max_sessions // 2 个借用者
+        :param pool_kwargs: ObjectPool 的其他参数
+        """
+        super().__init__(ParamikoOperator, dict(host=host, port=port, username=username, password=password, max_sessions=max_sessions,
+                                                sftp_window_size=sftp_window_size),
+                         object_pool_size=object_pool_size, **pool_kwargs)
+        self._max_borrowers_per_object = max(1, max_sessions // 2)
+
+    def put_many(self, file_pairs: typing.List[typing.Tuple[str, str]], max_workers=None, max_retry_times=2, is_make_dirs=True,
+                 return_exceptions=False, borrow_timeout=None) -> typing.List[dict]:
+        """
+        并发上传多个文件。
+        :param file_pairs: [(本地文件路径, 远程文件路径), ...]
+        :param max_workers: 同时传输的文件数，默认是 连接数 * 每个连接的借用者数 ，即所有 sftp channel 都用上
+        :param max_retry_times: 每个文件出错后最多重试几次
+        :param is_make_dirs: 远程目录不存在时自动创建
+        :param return_exceptions: True 时传输失败的文件在结果中对应位置是异常对象，False 时所有文件传完后抛出第一个异常
+        :return: 和 file_pairs 顺序一致，每个文件是 dict(local_path, remote_path, size, seconds, retry_times)
+        """
+        sizes = []
+        for local_path, _ in file_pairs:
+            try:
+                sizes.append(os.path.getsize(local_path))
+            except OSError:
+                sizes.append(0)  # 不影响其他文件，传输这个文件时会再次出错，异常放在结果中这个文件的位置
+        return self._transfer_many('put', file_pairs, sizes, max_workers, max_retry_times, is_make_dirs, return_exceptions, borrow_timeout)
+
+    def get_many(self, file_pairs: typing.List[typing.Tuple[str, str]], max_workers=None, max_retry_times=2, is_make_dirs=True,
+                 return_exceptions=False, borrow_timeout=None) -> typing.List[dict]:
+        """
+        并发下载多个文件，参数和返回值同 put_many ，file_pairs 也是 [(本地文件路径, 远程文件路径), ...] 。
+        """
+        return self._transfer_many('get', file_pairs, None, max_workers, max_retry_times, is_make_dirs, return_exceptions, borrow_timeout)
+
+    def sync_dir(self, local_dir, remote_dir, direction='put', is_skip_unchanged=True, **transfer_kwargs) -> dict:
+        """
+        同步整个目录，direction 为 put 时把本地目录上传到远程，get 时把远程目录下载到本地。不删除目标目录中多出来的文件。
+        传完的文件把修改时间设置成和源文件一样，下次同步时大小和修改时间都相同的文件跳过，只传新增和变化了的文件。
+        :param transfer_kwargs: put_many get_many 的其他参数
+        :return: dict(transferred=put_many/get_many 的结果, skipped_num=跳过的文件数)
+        """
+        if direction not in ('put', 'get'):
+            raise ValueError('direction 只能是 put 或者 get')
+        with self.get(timeout=transfer_kwargs.get('borrow_timeout')) as operator:  # type: ParamikoOperator
+            remote_files = self._walk_remote(operator.sftp, remote_dir)
+        local_files = {}
+        for root, _, file_names in os.walk(local_dir):
+            for file_name in file_names:
+                local_path = os.path.join(root, file_name)
+                st = os.stat(local_path)
+                local_files[os.path.relpath(local_path, local_dir).replace(os.sep, '/')] = (st.st_size, int(st.st_mtime))
+        src_files, dst_files = (local_files, remote_files) if direction == 'put' else (remote_files, local_files)
+        file_pairs = [(os.path.join(local_dir, *rel_path.split('/')), posixpath.join(remote_dir, rel_path))
+                      for rel_path, size_mtime in src_files.items() if not (is_skip_unchanged and dst_files.get(rel_path) == size_mtime)]
+        transfer_func = self.put_many if direction == 'put' else self.get_many
+        return dict(transferred=transfer_func(file_pairs, **transfer_kwargs) if file_pairs else [],
+                    skipped_num=len(src_files) - len(file_pairs))
+
+    @staticmethod
+    def _walk_remote(sftp: paramiko.SFTPClient, remote_dir) -> dict:
+        """ 远程目录下所有文件的 {相对路径: (大小, 修改时间)} ，远程目录不存在时返回空字典。"""
+        files = {}
+        dirs = ['']
+        while dirs:
+            rel_dir = dirs.pop()
+            try:
+                attrs = sftp.listdir_attr(posixpath.join(remote_dir, rel_dir))
+            except FileNotFoundError:
+                continue
+            for attr in attrs:
+                rel_path = posixpath.join(rel_dir, attr.filename)
+                if stat.S_ISDIR(attr.st_mode):
+                    dirs.append(rel_path)
+                elif stat.S_ISREG(attr.st_mode):
+                    files[rel_path] = (attr.st_size, attr.st_mtime)
+        return files
+
+    def _transfer_many(self, direction, file_pairs, sizes, max_workers, max_retry_times, is_make_dirs, return_exceptions, borrow_timeout):
+        results = [None] * len(file_pairs)
+        # 大文件先传。重试的文件放在最前面，断开的连接归还后马上换一个连接重试。
+        todo = collections.deque((index, 0) for index in (sorted(range(len(file_pairs)), key=lambda i: -sizes[i]) if sizes else range(len(file_pairs))))
+        todo_lock = threading.Lock()
+        made_dirs = set()
+        made_dirs_lock = threading.Lock()
+
+        def _make_dirs(operator: ParamikoOperator, path):
+            dir_path = posixpath.dirname(path) if direction == 'put' else os.path.dirname(path)
+            if not dir_path or dir_path in made_dirs:
+                return
+            if direction == 'put':
+                self._make_remote_dirs(operator.sftp, dir_path)
+            else:
+                os.makedirs(dir_path, exist_ok=True)
+            with made_dirs_lock:
+                made_dirs.add(dir_path)
+
+        def _transfer_one(operator: ParamikoOperator, local_path, remote_path):
+            t0 = time.perf_counter()
+            sftp = operator.sftp
+            if direction == 'put':
+                if is_make_dirs:
+                    _make_dirs(operator, remote_path)
+                st = os.stat(local_path)
+                sftp.put(local_path, remote_path)
+                sftp.utime(remote_path, (st.st_atime, st.st_mtime))
+                size = st.st_size
+            else:
+                if is_make_dirs:
+                    _make_dirs(operator, local_path)
+                remote_st = sftp.stat(remote_path)
+                sftp.get(remote_path, local_path)
+                os.utime(local_path, (remote_st.st_atime, remote_st.st_mtime))
+                size = remote_st.st_size
+            return size, time.perf_counter() - t0
+
+        def _work():
+            while True:
+                with todo_lock:
+                    if not todo:
+                        return
+                with self.get(timeout=borrow_timeout) as operator:  # type: ParamikoOperator
+                    while True:
+                        with todo_lock:
+                            if not todo:
+                                return
+                            index, retry_times = todo.popleft()
+                        local_path, remote_path = file_pairs[index]
+                        try:
+                            size, seconds = _transfer_one(operator, local_path, remote_path)
+                        except (FileNotFoundError, PermissionError, IsADirectoryError, NotADirectoryError) as e:
+                            results[index] = e  # 换连接重试也一样会失败
+                        except Exception as e:
+                            if retry_times >= max_retry_times:
+                                results[index] = e
+                                self.logger.error(f'{direction} {local_path} {remote_path} 重试 {retry_times} 次后仍然失败 {e}')
+                                continue
+                            with todo_lock:
+                                todo.appendleft((index, retry_times + 1))
+                            transport = operator.ssh.get_transport()
+                            # 远程磁盘满了、远程路径没有权限这类 sftp 错误连接本身是好的，不能因为一个文件把连接和上面其他借用者的 channel 都扔掉。
+                            # 只有ssh层面出错(sftp channel 断开也是抛 SSHException 或 EOFError)或者连接已经断了才换连接。
+                            if isinstance(e, (paramiko.SSHException, EOFError)) or transport is None or not transport.is_active():
+                                self.logger.warning(f'{direction} {local_path} {remote_path} 出错，连接已断开，换一个连接重试 {e}')
+                                operator._set_not_available()  # 归还后这个连接不再借出，外层循环重新借用时拿到的是别的连接
+                                break
+                            self.logger.warning(f'{direction} {local_path} {remote_path} 出错，在同一个连接上重试 {e}')
+                        else:
+                            results[index] = dict(local_path=local_path, remote_path=remote_path, size=size, seconds=seconds, retry_times=retry_times)
+
+        worker_num = min(max_workers or self.object_pool_size * self._max_borrowers_per_object, len(file_pairs))
+        if worker_num:
+            with ThreadPoolExecutor(worker_num, thread_name_prefix=f'sftp_{direction}_many') as executor:
+                for f in [executor.submit(_work) for _ in range(worker_num)]:
+                    f.result()
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    @staticmethod
+    def _make_remote_dirs(sftp: paramiko.SFTPClient, remote_dir):
+        """ 相当于 mkdir -p 。多个线程同时创建同一个目录时，mkdir 失败了再确认一下目录是否已经存在。"""
+        parts = []
+        dir_path = remote_dir
+        while dir_path not in ('', '/'):
+            try:
+                sftp.stat(dir_path)
+                break
+            except FileNotFoundError:
+                parts.append(dir_path)
+                dir_path = posixpath.dirname(dir_path)
+        for dir_path in reversed(parts):
+            try:
+                sftp.mkdir(dir_path)
+            except IOError:
+                sftp.stat(dir_path)
+
 
 if __name__ == '__main__':
-    paramiko_pool = ObjectPool(object_type=ParamikoOperator,
-                               object_init_kwargs=dict(host='192.168.6.130', port=22, username='ydf', password='372148', ),
-                               max_idle_seconds=120, object_pool_size=20)
+    # 20个线程同时执行命令，每个ssh连接同时借给5个线程(MaxSessions 10)，只需要4个ssh连接。用 ObjectPool 则需要20个连接。
+    paramiko_pool = MultiplexObjectPool(object_type=ParamikoOperator,
+                                        object_init_kwargs=dict(host='192.168.6.130', port=22, username='ydf', password='372148', ),
+                                        max_idle_seconds=120, object_pool_size=4)
 
     ParamikoOperator(**dict(host='192.168.6.130', port=22, username='ydf', password='372148', ))
 
@@ -88,4 +393,15 @@ if __name__ == '__main__':
             thread_pool.submit(test_paramiko, 'date;sleep 20s;date')  # 这个命令单线程for循环顺序执行每次需要20秒，如果不用对象池执行80次要1600秒
             # thread_pool.submit(test_update_multi_threads_use_one_conn, x)
         thread_pool.shutdown()
+    print(paramiko_pool.stats()['total_num'])
+
+    for line in stream_exec_cmd(paramiko_pool, 'for i in $(seq 1 10); do date; sleep 1; done'):  # 每秒打印一行，不用等10秒后一次性返回
+        print(line)
+
+    # 部署文件到多台机器，每台机器一个连接池，每个连接池把文件分散到多个 sftp channel 并发上传。
+    fleet_pools = [ParamikoObjectPool(host=host, port=22, username='ydf', password='372148', object_pool_size=2)
+                   for host in ('192.168.6.130', '192.168.6.131')]
+    with decorator_libs.TimerContextManager(), ThreadPoolExecutor(len(fleet_pools)) as fleet_executor:
+        for sync_result in fleet_executor.map(lambda pool: pool.sync_dir('./dist', '/home/ydf/app/dist'), fleet_pools):
+            print(len(sync_result['transferred']), sync_result['skipped_num'])
     time.sleep(10000)  # 这个可以测试验证，此对象池会自动摧毁连接如果闲置时间太长，会自动摧毁对象
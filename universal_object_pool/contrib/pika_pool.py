@@ -1,4 +1,8 @@
+import concurrent.futures
 import copy
+import functools
+import itertools
+import threading
 import time
 import typing
 import nb_log
@@ -6,31 +10,166 @@ import pika
 from pika.channel import Channel
 from pika.exceptions import AMQPError
 
-from universal_object_pool import ObjectPool, AbstractObject
+from universal_object_pool import ObjectPool, AbstractObject, BatchFlusher
 from threadpool_executor_shrink_able import BoundedThreadPoolExecutor
 import decorator_libs
 
 
+class PublishNackError(Exception):
+    """ broker 对这条消息回复了 Basic.Nack ，没有保证消息已经入队。"""
+
+
+class _PendingBatch:
+    __slots__ = ('future', 'results', 'unconfirmed_num')
+
+    def __init__(self, future: concurrent.futures.Future, size):
+        self.future = future
+        self.results = [None] * size
+        self.unconfirmed_num = size
+
+
+class _ConfirmPublisher:
+    """
+    publish_batch 专用的发布者，用 pika 公开的异步接口 SelectConnection 在自己的 ioloop 线程上开启 publisher confirms 。
+    BlockingChannel 开启 confirm_delivery 后每条 basic_publish 都同步等待确认，一条消息一次往返；
+    这里整批消息连续写出去，broker 的 ack/nack 在 ioloop 线程里按 delivery_tag 对应回每条消息，一批只等待一次。
+    除了 publish_batch 和 close 把任务交给 ioloop 线程，其他方法都只在 ioloop 线程里执行。
+    """
+
+    def __init__(self, parameters: pika.ConnectionParameters, timeout):
+        """
+        :param timeout: 打开连接、等待一批消息被确认的最长秒数
+        """
+        self._timeout = timeout
+        self._channel = None
+        self._next_delivery_tag = 1  # 开启确认后 broker 给这个 channel 上发布的消息从1开始编号
+        self._unconfirmed = {}  # delivery_tag -> (批次, 这条消息在批次中的序号)，按 delivery_tag 从小到大插入
+        self._error = None  # 连接或者 channel 关闭后，之后的批次都直接失败
+        self._opened = threading.Event()
+        self._connection = pika.SelectConnection(parameters, on_open_callback=self._on_connection_open,
+                                                 on_open_error_callback=self._on_connection_closed,
+                                                 on_close_callback=self._on_connection_closed)
+        self._ioloop_thread = threading.Thread(target=self._connection.ioloop.start, name='pika_confirm_publisher', daemon=True)
+        self._ioloop_thread.start()
+        if not self._opened.wait(timeout):
+            self.close()
+            raise AMQPError(f'打开 publisher confirms 连接超过 {timeout} 秒')
+        if self._error is not None:
+            raise self._error
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(self._on_delivery_confirmation, callback=lambda frame: self._opened.set())
+
+    def _on_channel_closed(self, channel, reason):
+        self._fail_all(AMQPError(f'批量发布的 channel 已经关闭 {reason}'))
+        if not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()
+
+    def _on_connection_closed(self, connection, reason):
+        self._fail_all(AMQPError(f'批量发布的连接已经关闭 {reason}'))
+        self._connection.ioloop.stop()
+
+    def _fail_all(self, error):
+        if self._error is None:
+            self._error = error
+        for batch, _ in self._unconfirmed.values():
+            if not batch.future.done():
+                batch.future.set_exception(self._error)
+        self._unconfirmed.clear()
+        self._opened.set()
+
+    def _on_delivery_confirmation(self, method_frame):
+        method = method_frame.method
+        is_ack = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:  # 确认了这个 delivery_tag 以及之前的所有消息
+            tags = list(itertools.takewhile(lambda tag: tag <= method.delivery_tag, self._unconfirmed))
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            item = self._unconfirmed.pop(tag, None)
+            if item is None:
+                continue
+            batch, index = item
+            if not is_ack:
+                batch.results[index] = PublishNackError(f'broker 拒绝了这条消息 delivery_tag={tag}')
+            batch.unconfirmed_num -= 1
+            if batch.unconfirmed_num == 0 and not batch.future.done():
+                batch.future.set_result(batch.results)
+
+    def _publish_batch(self, future: concurrent.futures.Future, bodies, routing_key):
+        if self._error is not None:
+            future.set_exception(self._error)
+            return
+        batch = _PendingBatch(future, len(bodies))
+        if not bodies:
+            future.set_result(batch.results)
+        try:
+            for index, body in enumerate(bodies):
+                self._channel.basic_publish(exchange='', routing_key=routing_key, body=body)
+                self._unconfirmed[self._next_delivery_tag] = (batch, index)
+                self._next_delivery_tag += 1
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+
+    def publish_batch(self, bodies: list, routing_key) -> list:
+        if self._error is not None:
+            raise self._error
+        future = concurrent.futures.Future()
+        self._connection.ioloop.add_callback_threadsafe(functools.partial(self._publish_batch, future, bodies, routing_key))
+        try:
+            return future.result(self._timeout)
+        except concurrent.futures.TimeoutError:
+            raise AMQPError(f'等待 broker 确认超过 {self._timeout} 秒')
+
+    def close(self):
+        def _close():
+            if self._connection.is_closing or self._connection.is_closed:
+                self._connection.ioloop.stop()
+            else:
+                self._connection.close()  # 关闭完成后 _on_connection_closed 停止 ioloop
+
+        if self._ioloop_thread.is_alive():
+            self._connection.ioloop.add_callback_threadsafe(_close)
+            self._ioloop_thread.join(self._timeout)
+
+
 class PikaOperator(AbstractObject, ):
     """
     如果是外网mq，这种快很多。
     """
-    def __init__(self, host, port, user, password, queue):
+    def __init__(self, host, port, user, password, queue, confirm_timeout=30):
+        """
+        :param confirm_timeout: publish_batch 等待 broker 确认整批消息的最长秒数，超时后这个连接设置成不可用
+        """
         self._host = host
         self._port = port
         self._user = user
         self._password = password
         self._queue = queue
+        self._confirm_timeout = confirm_timeout
+        self._confirm_publisher = None  # type: typing.Optional[_ConfirmPublisher]
         self._create_channel()
         self.logger = nb_log.get_logger(self.__class__.__name__)
 
-    def _create_channel(self):
+    def _connection_parameters(self):
         auth = pika.PlainCredentials(self._user, self._password)
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self._host, port=self._port, credentials=auth, heartbeat=20))
+        return pika.ConnectionParameters(host=self._host, port=self._port, credentials=auth, heartbeat=20)
+
+    def _create_channel(self):
+        self.connection = pika.BlockingConnection(self._connection_parameters())
         self.channel = self.connection.channel()
         self.channel.queue_declare(queue=self._queue)
         self.core_obj = self.channel
 
+    def _create_confirm_publisher(self):
+        return _ConfirmPublisher(self._connection_parameters(), self._confirm_timeout)
+
     def simple_publish(self, body):
         # print(self.channel)
         try:
@@ -44,13 +183,60 @@ class PikaOperator(AbstractObject, ):
                                        routing_key=self._queue,
                                        body=body)
 
+    def publish_batch(self, bodies: list, routing_key=None) -> list:
+        """
+        用单独的一个 publisher confirms 连接批量发布，整批消息写完后只等待一次确认，不是每条消息一次往返。
+        出错或者等待确认超时时设置对象不可用，对象池会摧毁它，重试时借到的是别的连接。重试的那一批消息中可能有已经被确认过的，会重复发布。
+        :return: 和 bodies 一一对应，broker ack 的是 None ，nack 的是 PublishNackError
+        """
+        try:
+            if self._confirm_publisher is None:
+                self._confirm_publisher = self._create_confirm_publisher()
+            return self._confirm_publisher.publish_batch(bodies, routing_key or self._queue)
+        except AMQPError:
+            self._set_not_available()
+            raise
+
     def clean_up(self):
+        if self._confirm_publisher is not None:
+            self._confirm_publisher.close()
         self.channel.close()
         self.connection.close()
 
     def before_back_to_queue(self, exc_type, exc_val, exc_tb):
         pass
 
+    def validate(self):
+        return self.connection.is_open and self.channel.is_open
+
+
+class PikaBatchPublisher(BatchFlusher):
+    """
+    多个线程调用 publish 的消息攒成批量，每批从对象池借一个 PikaOperator 用 publisher confirms 批量发布，不再是每发布一条消息就借还一次。
+    publish 返回 Future ，broker ack 这条消息后 Future 完成；broker nack 的那一条 Future 是 PublishNackError ；整批重试失败后 Future 是异常。
+    """
+
+    def __init__(self, pika_pool: ObjectPool, batch_size=200, flush_interval_seconds=0.05, max_workers=None, max_retry_times=2, borrow_timeout=10):
+        """
+        :param pika_pool: object_type 是 PikaOperator 的对象池
+        :param max_workers: 同时发布的批次数量，默认等于对象池大小，每个批次占用一个池化的连接
+        :param borrow_timeout: 每批借用连接的超时时间
+        """
+        super().__init__(self._publish_batch, batch_size=batch_size, flush_interval_seconds=flush_interval_seconds,
+                         max_workers=max_workers or pika_pool.object_pool_size, max_retry_times=max_retry_times)
+        self._pika_pool = pika_pool
+        self._borrow_timeout = borrow_timeout
+
+    def publish(self, body, routing_key=None):
+        """
+        :param routing_key: 为None时发布到 PikaOperator 声明的队列
+        """
+        return self.submit(body, key=routing_key)
+
+    def _publish_batch(self, routing_key, bodies):
+        with self._pika_pool.get(timeout=self._borrow_timeout) as pika_operator:  # type: PikaOperator
+            return pika_operator.publish_batch(bodies, routing_key)
+
 
 if __name__ == '__main__':
     pika_pool = ObjectPool(object_type=PikaOperator, object_pool_size=10, object_init_kwargs=dict(
@@ -75,4 +261,11 @@ if __name__ == '__main__':
             print(x)
             # thread_pool.submit(test_update_multi_threads_use_one_conn, x)
         thread_pool.shutdown()
+
+    batch_publisher = PikaBatchPublisher(pika_pool, batch_size=500)
+    with decorator_libs.TimerContextManager():
+        futures = [batch_publisher.publish(f'hello_batch_{x}') for x in range(50000)]
+        for f in futures:
+            f.result()  # 等到 broker 确认了这条消息
+    print(batch_publisher.stats())
     time.sleep(10000)
@@ -1,9 +1,10 @@
+import collections
 import copy
 
 import nb_log
 import pymysql
 import typing
-from universal_object_pool import ObjectPool, AbstractObject
+from universal_object_pool import ObjectPool, AbstractObject, ValidatePolicy, BatchFlusher
 from threadpool_executor_shrink_able import BoundedThreadPoolExecutor
 import threading
 import time
@@ -27,29 +28,93 @@ db.close()  # or del db
 """
 
 
+class _ParsedStatement:
+    __slots__ = ('query', 'insert_prefix', 'insert_values', 'insert_postfix')
+
+    def __init__(self, query, encoding):
+        self.query = query
+        m = pymysql.cursors.RE_INSERT_VALUES.match(query)
+        if m:
+            # 和 pymysql 的 Cursor.executemany 一样的处理，前缀和后缀按连接的编码提前编码好
+            self.insert_prefix = (m.group(1) % ()).encode(encoding)
+            self.insert_values = m.group(2).rstrip()
+            self.insert_postfix = (m.group(3) or '').encode(encoding)
+        else:
+            self.insert_prefix = self.insert_values = self.insert_postfix = None
+
+
+class SqlStatementCache:
+    """
+    每个连接一个，按sql文本缓存 executemany 的解析结果，最近最少使用的先淘汰。跨借用保留，连接 clean_up 时清空。
+    pymysql 没有实现服务端预处理语句(COM_STMT_PREPARE)，参数都是在客户端转义后拼接进sql的，
+    executemany 每次都要用正则拆分 INSERT ... VALUES (...) 语句，长sql一次要10微秒左右，这里缓存拆分结果。
+    单行的 execute 只是转义参数后用 % 拼接，没有可以缓存的解析，不经过这个缓存。
+    只被借到这个连接的一个线程使用，不需要加锁。
+    """
+
+    def __init__(self, max_size=128, encoding='utf8'):
+        """
+        :param encoding: 连接的编码，拆分出来的 INSERT 前缀和后缀按这个编码成 bytes
+        """
+        self._max_size = max_size
+        self._encoding = encoding
+        self._statements = collections.OrderedDict()  # type: typing.Dict[str,_ParsedStatement]
+        self.hit_num = 0
+        self.miss_num = 0
+
+    def get(self, query) -> _ParsedStatement:
+        statement = self._statements.get(query)
+        if statement is not None:
+            self._statements.move_to_end(query)
+            self.hit_num += 1
+            return statement
+        self.miss_num += 1
+        statement = self._statements[query] = _ParsedStatement(query, self._encoding)
+        if len(self._statements) > self._max_size:
+            self._statements.popitem(last=False)
+        return statement
+
+    def clear(self):
+        self._statements.clear()
+
+    def stats(self) -> dict:
+        return dict(size=len(self._statements), hit_num=self.hit_num, miss_num=self.miss_num)
+
+
 class PyMysqlOperator(AbstractObject):
     error_type_list_set_not_available = []  # 出了特定类型的错误，可以设置对象已经无效不可用了，不归还到队列里面。
 
     # error_type_list_set_not_available = [pymysql.err.InterfaceError]
 
-    def __init__(self, host='192.168.6.130', user='root', password='123456', cursorclass=pymysql.cursors.DictCursor, autocommit=False, **pymysql_connection_kwargs):
+    def __init__(self, host='192.168.6.130', user='root', password='123456', cursorclass=pymysql.cursors.DictCursor, autocommit=False,
+                 statement_cache_size=128, **pymysql_connection_kwargs):
         in_params = copy.copy(locals())
         in_params.update(pymysql_connection_kwargs)
         in_params.pop('self')
         in_params.pop('pymysql_connection_kwargs')
+        in_params.pop('statement_cache_size')
         self.conn = pymysql.Connection(**in_params)
+        self.statement_cache = SqlStatementCache(statement_cache_size, self.conn.encoding)
         self.logger = nb_log.get_logger(self.__class__.__name__)
 
     """ 下面3个是重写的方法"""
 
     def clean_up(self):  # 如果一个对象最近30分钟内没被使用，那么对象池会自动将对象摧毁并从池中删除，会自动调用对象的clean_up方法。
+        self.statement_cache.clear()
         self.conn.close()
 
+    def validate(self):
+        self.conn.ping(reconnect=False)  # 超过 wait_timeout 被服务端断开的连接会抛出异常，对象池会摧毁它再借出别的连接。
+        return True
+
     def before_use(self):
         self.cursor = self.conn.cursor()
         self.core_obj = self.cursor  # 这个是为了operator对象自动拥有cursor对象的所有方法。
 
     def before_back_to_queue(self, exc_type, exc_val, exc_tb):
+        if self.__dict__.get('is_available') is False:
+            # 连接会被对象池摧毁，不再 commit 或者 rollback 。例如流式查询没读完就放弃了，commit 之前要先把剩下的几千万行从网络读完。
+            return
         if exc_type:
             self.conn.rollback()
         else:
@@ -69,12 +134,149 @@ class PyMysqlOperator(AbstractObject):
         """
         return self.cursor.execute(query, args)
 
+    def executemany(self, query, args_list):
+        """
+        和 cursor.executemany 一样把 INSERT ... VALUES (...) 拼接成多行 insert 语句，但是sql的拆分结果从这个连接的 statement_cache 中取，
+        同一个sql执行几百万次只解析一次。不是 INSERT/REPLACE ... VALUES 语句时交给 cursor.executemany 逐条执行。
+        和 pymysql 一样按编码后的字节数拆分，每条语句不超过 cursor.max_stmt_length 字节。
+        """
+        statement = self.statement_cache.get(query)
+        if statement.insert_values is None or not args_list:
+            return self.cursor.executemany(query, args_list)
+        encoding = self.conn.encoding
+        max_stmt_length = self.cursor.max_stmt_length
+        rowcount = 0
+        sql = bytearray(statement.insert_prefix)
+        for index, args in enumerate(args_list):
+            values = self.cursor.mogrify(statement.insert_values, args).encode(encoding)
+            if index:
+                if len(sql) + len(values) + len(statement.insert_postfix) + 1 > max_stmt_length:
+                    rowcount += self.cursor.execute(sql + statement.insert_postfix)
+                    sql = bytearray(statement.insert_prefix)
+                else:
+                    sql += b','
+            sql += values
+        rowcount += self.cursor.execute(sql + statement.insert_postfix)
+        self.cursor.rowcount = rowcount
+        return rowcount
+
+    def iter_query_chunks(self, query, args=None, chunk_size=1000, is_dict_row=True):
+        """
+        用不缓存结果集的 SSCursor/SSDictCursor 流式读取，每次从网络读取 chunk_size 行，内存占用和结果集总行数无关。
+        没读完就关闭的话，剩下的行要全部从网络读完才能复用这个连接，几千万行的导出不如直接设置连接不可用，让对象池摧毁它。
+        :param is_dict_row: True 每行是 dict ，False 每行是 tuple ，tuple 更快更省内存
+        """
+        ss_cursor = self.conn.cursor(pymysql.cursors.SSDictCursor if is_dict_row else pymysql.cursors.SSCursor)
+        is_reading = False
+        try:
+            ss_cursor.execute(query, args)
+            is_reading = True
+            while True:
+                rows = ss_cursor.fetchmany(chunk_size)
+                if not rows:
+                    is_reading = False
+                    break
+                yield rows
+        finally:
+            if is_reading:
+                self._set_not_available()
+            else:
+                ss_cursor.close()
 
 
+def stream_query(mysql_pool: ObjectPool, query, args=None, chunk_size=1000, is_dict_row=True, is_yield_chunk=True, borrow_timeout=None):
+    """
+    从连接池借一个连接流式读取大结果集，结果读完或者生成器被关闭(break 之后被回收、调用 close())时自动归还连接。
+    第一次迭代时才借用连接。
+
+    for rows in stream_query(mysql_pool, 'SELECT * FROM db1.table1', chunk_size=5000):
+        write_to_csv(rows)
+
+    :param is_yield_chunk: True 每次 yield 一批行，False 每次 yield 一行
+    """
+    with mysql_pool.get(timeout=borrow_timeout) as operator:  # type: PyMysqlOperator
+        chunks = operator.iter_query_chunks(query, args, chunk_size=chunk_size, is_dict_row=is_dict_row)
+        try:
+            for rows in chunks:
+                if is_yield_chunk:
+                    yield rows
+                else:
+                    yield from rows
+        except GeneratorExit:
+            return  # 调用者不再读取了，不是错误，正常归还连接。
+        finally:
+            chunks.close()
+
+
+class PyMysqlBatchWriter(BatchFlusher):
+    """
+    多个线程提交的同一个sql的单行写入攒成一批，从连接池借一个连接 executemany 一次，整批只 commit 一次。
+    pymysql 的 executemany 会把 INSERT ... VALUES (...) [ON DUPLICATE KEY UPDATE ...] 拼接成一条多行 insert 语句，
+    10万次单行写入的往返和提交变成几百次。
+
+    write 返回 Future ，这一批提交成功后 Future 的结果是这一批 executemany 的 rowcount(多行 insert 没有单行的影响行数)。
+    这一批因为数据出错(例如唯一键冲突、字段超长)回滚后，改为逐行写入并且每行单独提交，只有出错的那一行的 Future 是异常，
+    其他行的 Future 结果是这一行的 rowcount 。连接断开之类的错误整批重试，重试失败后这一批所有行的 Future 都是异常。
+    """
+
+    def __init__(self, mysql_pool: ObjectPool, batch_size=500, flush_interval_seconds=0.05, max_workers=None, max_retry_times=1, borrow_timeout=10):
+        """
+        :param mysql_pool: object_type 是 PyMysqlOperator 的对象池
+        :param max_workers: 同时写入的批次数量，默认等于连接池大小
+        :param borrow_timeout: 每批借用连接的超时时间
+        """
+        super().__init__(self._write_batch, batch_size=batch_size, flush_interval_seconds=flush_interval_seconds,
+                         max_workers=max_workers or mysql_pool.object_pool_size, max_retry_times=max_retry_times)
+        self._mysql_pool = mysql_pool
+        self._borrow_timeout = borrow_timeout
+
+    def write(self, sql, args):
+        """
+        :param sql: sql语句，相同的sql才会攒到同一批
+        :param args: 这一行的参数
+        """
+        return self.submit(args, key=sql)
+
+    def _write_batch(self, sql, args_list):
+        try:
+            with self._mysql_pool.get(timeout=self._borrow_timeout) as operator:  # type: PyMysqlOperator
+                try:
+                    rowcount = operator.executemany(sql, args_list)  # before_back_to_queue 里面整批 commit 一次，出错则 rollback
+                except pymysql.err.OperationalError:
+                    # 连接出错，归还时不在断开的连接上 rollback ，对象池摧毁这个连接，重试时借到的是别的连接
+                    operator._set_not_available()
+                    raise
+        except pymysql.err.OperationalError:
+            raise  # 整批重试
+        except pymysql.err.DatabaseError as e:
+            if len(args_list) == 1:
+                return [e]
+            self.logger.warning(f'批量写入 {len(args_list)} 行出错，改为逐行写入 {e}')
+            return self._write_rows_one_by_one(sql, args_list)
+        return [rowcount] * len(args_list)
+
+    def _write_rows_one_by_one(self, sql, args_list):
+        results = []
+        with self._mysql_pool.get(timeout=self._borrow_timeout) as operator:  # type: PyMysqlOperator
+            for args in args_list:
+                try:
+                    rowcount = operator.execute(sql, args)
+                    operator.conn.commit()
+                    results.append(rowcount)
+                except pymysql.err.OperationalError as e:
+                    # 前面的行已经提交了，不能整批重试，剩下的行都算失败
+                    operator._set_not_available()
+                    results.extend([e] * (len(args_list) - len(results)))
+                    break
+                except pymysql.err.DatabaseError as e:
+                    operator.conn.rollback()
+                    results.append(e)
+        return results
 
 
 if __name__ == '__main__':
-    mysql_pool = ObjectPool(object_type=PyMysqlOperator, object_pool_size=100, object_init_kwargs={'port': 3306})
+    mysql_pool = ObjectPool(object_type=PyMysqlOperator, object_pool_size=100, object_init_kwargs={'port': 3306},
+                            validate_policy=ValidatePolicy.IDLE_OVER, validate_idle_seconds=60)  # 空闲超过60秒的连接借出前先ping一下
 
 
     def test_update(i):
@@ -126,4 +328,27 @@ if __name__ == '__main__':
             thread_pool.submit(test_update, x)
             # thread_pool.submit(test_update_multi_threads_use_one_conn, x)
         thread_pool.shutdown()
+
+    batch_writer = PyMysqlBatchWriter(mysql_pool, batch_size=1000)
+
+
+    def test_update_batched(i):
+        sql = '''INSERT INTO db1.table1(uname ,age) VALUES(%s ,%s)
+        ON DUPLICATE KEY UPDATE uname = values(uname), age = if(values(age)>age,values(age),age)'''
+        return batch_writer.write(sql, args=(f'name_{i}', i * 5))
+
+
+    thread_pool = BoundedThreadPoolExecutor(20)
+    with decorator_libs.TimerContextManager():  # 10万行只需要约100次 executemany 和 commit
+        futures = [thread_pool.submit(test_update_batched, x) for x in range(300000, 400000)]
+        for f in futures:
+            f.result().result()
+        thread_pool.shutdown()
+    print(batch_writer.stats())
+
+    with decorator_libs.TimerContextManager():  # 内存占用只和 chunk_size 有关，和表的行数无关
+        row_num = 0
+        for chunk in stream_query(mysql_pool, 'SELECT uname, age FROM db1.table1', chunk_size=5000, is_dict_row=False):
+            row_num += len(chunk)
+        print(row_num)
     time.sleep(10000)  #这个可以测试验证，此对象池会自动摧毁连接如果闲置时间太长，会自动摧毁对象
@@ -1,91 +1,134 @@
+import atexit
 import concurrent.futures
 import queue
 import threading
 import time
+import weakref
 
 import nb_log
 
-from universal_object_pool import AbstractObject, ObjectPool
-
-
-class ThreadObjectPool(ObjectPool):
-
-    def __init__(self, object_pool_size=10, max_idle_seconds=60):
-        self.work_queue = queue.Queue(object_pool_size)  # 使工作队列使有界队列。
-        super().__init__(ThreadOperator, {'q': self.work_queue}, object_pool_size, max_idle_seconds)
-
-    def _borrow_a_object(self, block, timeout):
+"""
+以前 ThreadObjectPool 继承 ObjectPool ，每次 submit 都要从对象池借一个 ThreadOperator 线程对象，只是为了往共享的工作队列放一个任务，
+比官方 ThreadPoolExecutor 慢一倍，工作线程每10秒轮询一次队列。
+现在 submit 直接把任务放进队列返回 Future ，线程按需增加到 object_pool_size ，空闲 max_idle_seconds 秒后自动退出，
+阻塞等待任务的超时就是空闲时间，不轮询。
+"""
+
+_all_pools = weakref.WeakSet()
+_is_interpreter_shutdown = False
+
+
+def _python_exit():
+    """ 和官方线程池一样，解释器退出前执行完已经提交的任务，不用等空闲线程超时。"""
+    global _is_interpreter_shutdown
+    _is_interpreter_shutdown = True
+    for pool in list(_all_pools):
+        pool.shutdown(wait=True)
+
+
+_is_daemon_thread = not hasattr(threading, '_register_atexit')
+if _is_daemon_thread:
+    # python3.8及以下没有 threading._register_atexit ，解释器先 join 非守护线程再执行 atexit 。
+    # 和当时官方线程池一样用守护线程，在 atexit 里面执行完已经提交的任务。
+    atexit.register(_python_exit)
+else:
+    # python3.9+ 官方 concurrent.futures.thread 也是这样注册的，比 atexit 早执行，能在join非守护线程之前通知它们退出。
+    threading._register_atexit(_python_exit)  # noqa
+
+
+class ThreadObjectPool(concurrent.futures.Executor, nb_log.LoggerMixin):
+    def __init__(self, object_pool_size=10, max_idle_seconds=60, thread_name_prefix='ThreadObjectPool'):
+        """
+        :param object_pool_size: 最大线程数
+        :param max_idle_seconds: 线程空闲这么久没有任务就退出，有新任务时再按需创建。None 表示线程不退出。
+        :param thread_name_prefix: 线程名字前缀
+        """
+        self._max_workers = object_pool_size
+        self._max_idle_seconds = max_idle_seconds
+        self._thread_name_prefix = thread_name_prefix
+        self._work_queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        # 等待任务的线程数减去队列中的任务数，小于等于0说明没有空闲线程。submit 和线程退出都要在锁里面修改它，
+        # 这样空闲超时的线程只有在确实多余时才退出，不会丢下队列中的任务。
+        self._idle_num = 0
+        self._threads = set()
+        self._thread_seq = 0
+        self._is_shutdown = False
+        _all_pools.add(self)
+
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
         with self._lock:
-            t0 = time.time()
-            try:
-                if self._has_create_object_num < self.object_pool_size:  # 这行改了。
-                    t1 = time.perf_counter()
-                    obj = self.object_type(**self._object_init_kwargs)
-                    self.logger.info(f'创建对象 {obj} ,耗时 {round(time.perf_counter() - t1, 3)}')
-                    self._queue.put(obj)
-                    self._has_create_object_num += 1
-                    # print(self._queue.qsize())
-                t2 = time.time()
-                obj = self._queue.get(block, timeout)
-                # print(time.time() -t2)
-                self.is_using_num += 1
-                self.logger.debug(f'获取对象 {obj}')
-                obj.the_obj_last_use_time = time.time()
-                return obj
-            except queue.Empty as e:
-                self.logger.critical(f'{e}  对象池暂时没有可用的对象了，请把timeout加大、或者不设置timeout(没有对象就进行永久阻塞等待)、或者设置把对象池的数量加大',
-                                     exc_info=True)
-                raise e
-            except Exception as e:
-                self.logger.critical(e, exc_info=True)
-                raise e
-            finally:
-                pass
-                # print(time.time() -t0)
-
-    def submit(self, f, *args, **kwargs):
-        with self.get() as thread_op:  # type:ThreadOperator
-            thread_op.submit(f, *args, **kwargs)
-
-
-class ThreadOperator(AbstractObject, nb_log.LoggerMixin):
-    error_type_list_set_not_available = []  # 出了特定类型的错误，可以设置对象已经无效不可用了，不归还到队列里面。
-
-    def __init__(self, q: queue.Queue):
-        self._work_queue = q
-        self._thread_term_flag = 0
-        self.thread = threading.Thread(target=self._run)
-        self.thread.start()
-
-    """ 下面3个是重写的方法"""
-
-    def clean_up(self):
-        self._thread_term_flag = 1
-
-    def before_use(self):
-        pass
-
-    def before_back_to_queue(self, exc_type, exc_val, exc_tb):
-        pass
-
-    def submit(self, f, *args, **kwargs):
-        item= (f, args, kwargs)
-        self._work_queue.put(item)
+            if self._is_shutdown:
+                raise RuntimeError('cannot schedule new futures after interpreter shutdown' if _is_interpreter_shutdown
+                                   else 'ThreadObjectPool 已经 shutdown ，不能再提交任务')
+            self._work_queue.put((future, fn, args, kwargs))
+            self._idle_num -= 1
+            if self._idle_num < 0 and len(self._threads) < self._max_workers:
+                self._idle_num += 1  # 新线程启动后就去取这个任务
+                self._start_thread_locked()
+        return future
+
+    def _start_thread_locked(self):
+        self._thread_seq += 1
+        t = threading.Thread(target=self._run, name=f'{self._thread_name_prefix}_{self._thread_seq}', daemon=_is_daemon_thread)
+        self._threads.add(t)
+        t.start()
 
     def _run(self):
-        while 1:
-            if self._thread_term_flag == 1:
-                break
+        work_queue = self._work_queue
+        max_idle_seconds = self._max_idle_seconds
+        while True:
             try:
-                item = self._work_queue.get(block=True, timeout=10)
-                f, args, kwargs = item
+                item = work_queue.get(timeout=max_idle_seconds)
             except queue.Empty:
-                pass
-            else:
+                with self._lock:
+                    if self._idle_num <= 0:
+                        continue  # 超时后到拿锁之前又提交了任务，这个线程不能退出
+                    self._idle_num -= 1
+                    self._threads.discard(threading.current_thread())
+                return
+            if item is None:  # shutdown
+                return
+            future, fn, args, kwargs = item
+            del item
+            if future.set_running_or_notify_cancel():
                 try:
-                    f(*args, **kwargs)
+                    result = fn(*args, **kwargs)
                 except BaseException as e:
-                    self.logger.error(e, exc_info=True)
+                    future.set_exception(e)  # 和官方线程池一样不打印，异常由调用 future.result() 的人处理
+                else:
+                    future.set_result(result)
+            del future, fn, args, kwargs  # 不要让上一个任务的参数和结果一直被空闲线程引用着
+            with self._lock:
+                self._idle_num += 1
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        """
+        :param wait: 是否等待队列中的任务都执行完、所有线程退出后再返回
+        :param cancel_futures: 取消队列中还没开始执行的任务
+        """
+        with self._lock:
+            if not self._is_shutdown:
+                self._is_shutdown = True
+                if cancel_futures:
+                    while True:
+                        try:
+                            item = self._work_queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is not None:
+                            item[0].cancel()
+                for _ in range(len(self._threads)):
+                    self._work_queue.put(None)  # 每个线程取到一个 None 就退出，排在已经提交的任务后面
+            threads = list(self._threads)
+        if wait:
+            for t in threads:
+                t.join()
+
+    @property
+    def thread_num(self):
+        return len(self._threads)
 
 
 if __name__ == '__main__':
@@ -97,21 +140,30 @@ if __name__ == '__main__':
 
     def my_fun(x, y):
         z = x + y
-        if x % 1 == 0:
+        if x % 1000 == 0:
             print(x)
+        return z
 
 
     t00 = time.time()
-    for i in range(10 * 1000):
-        # thread_pool.submit(my_fun, i, i * 2)  # 使用线程池测试求和100万次 30秒
-
-        # threading.Thread(target=my_fun, args=(i, i * 2)).start() #  使用临时启动线程池，测试求和100万次150秒
-
-        c_pool.submit(my_fun, i, i * 2)  # 对比官方是15秒。
+    for i in range(100 * 1000):
+        c_pool.submit(my_fun, i, i * 2)
+    c_pool.shutdown()
+    print('官方线程池', time.time() - t00)
 
-    print(time.time() - t00)
+    t00 = time.time()
+    for i in range(100 * 1000):
+        thread_pool.submit(my_fun, i, i * 2)
+    print(list(thread_pool.map(my_fun, range(5), range(5))))
+    print('ThreadObjectPool', time.time() - t00, thread_pool.thread_num)
 
-    # time.sleep(100)
+    time.sleep(5)
 
+    thread_pool_idle = ThreadObjectPool(100, max_idle_seconds=2)
+    for i in range(10 * 1000):
+        thread_pool_idle.submit(my_fun, i, i * 2)
+    time.sleep(5)
+    print('空闲超时后的线程数', thread_pool_idle.thread_num)  # 0
     for i in range(10 * 1000):
-        thread_pool.submit(my_fun, i, i * 2)  # 测试空闲关闭线程后，能否在启动线程
+        thread_pool_idle.submit(my_fun, i, i * 2)  # 测试空闲关闭线程后，能否再启动线程
+    thread_pool_idle.shutdown(wait=True)
@@ -1,17 +1,29 @@
+import collections
 import copy
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
 import time
 import typing
 from urllib.error import URLError
+from urllib.parse import urlsplit
 import nb_log
 import selenium
 from selenium import webdriver
-from selenium.common.exceptions import NoSuchWindowException
+from selenium.common.exceptions import NoSuchWindowException, WebDriverException
 from selenium.webdriver import DesiredCapabilities
-from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver import Chrome
 from selenium.webdriver import PhantomJS
+from selenium.webdriver.chrome.service import Service
 
-from universal_object_pool import ObjectPool, AbstractObject
+try:
+    import psutil  # 可选依赖，只有按内存回收浏览器时才需要
+except ImportError:
+    psutil = None
+
+from universal_object_pool import ObjectPool, AbstractObject, ValidatePolicy
 from threadpool_executor_shrink_able import BoundedThreadPoolExecutor
 import decorator_libs
 
@@ -20,13 +32,118 @@ import decorator_libs
 也比在多线程的函数内部频繁 driver实例化 和driver.quit()强很多。
 """
 
+_chrome_driver_path = None
+_chrome_driver_path_lock = threading.Lock()
+
+
+def get_chrome_driver_path(chrome_driver_path=None):
+    """
+    chromedriver 路径每个进程只解析一次。以前每创建一个浏览器对象都要调用 ChromeDriverManager().install() ，要查询版本甚至联网下载。
+    :param chrome_driver_path: 本地 chromedriver 路径，传了或者设置了环境变量 CHROMEDRIVER_PATH 就完全离线，不使用 webdriver_manager 。
+    """
+    chrome_driver_path = chrome_driver_path or os.environ.get('CHROMEDRIVER_PATH')
+    if chrome_driver_path:
+        if not os.path.isfile(chrome_driver_path):
+            raise FileNotFoundError(f'chromedriver 不存在 {chrome_driver_path}')
+        return chrome_driver_path
+    global _chrome_driver_path
+    with _chrome_driver_path_lock:  # 对象池在多个线程同时创建浏览器时，只让一个线程去解析或下载驱动
+        if _chrome_driver_path is None:
+            from webdriver_manager.chrome import ChromeDriverManager
+            _chrome_driver_path = ChromeDriverManager().install()  # webdriver_manager 包可以自动下载安装chrome驱动，比较方便，不需要自己指定路径。
+        return _chrome_driver_path
+
+
+# chrome 运行时的锁文件和调试端口文件，复制模板时不能带上
+_CHROME_PROFILE_RUNTIME_FILES = ('SingletonLock', 'SingletonSocket', 'SingletonCookie', 'lockfile', 'LOCK', 'DevToolsActivePort')
+
+
+def copy_user_data_dir(user_data_dir_template, user_data_dir_root=None):
+    """
+    把预先准备好的 chrome 用户数据目录模板复制一份给一个浏览器用，多个浏览器不能同时使用同一个用户数据目录。
+    不复制 chrome 运行时的锁文件，模板目录要在 chrome 退出后再复制。
+    :return: 复制出来的目录，浏览器退出后用 remove_user_data_dir 删除
+    """
+    # copytree 的目标目录不能已经存在(python3.8 才有 dirs_exist_ok)，所以复制到新建临时目录下面的 profile 子目录
+    user_data_dir = os.path.join(tempfile.mkdtemp(prefix='chrome_user_data_', dir=user_data_dir_root), 'profile')
+    shutil.copytree(user_data_dir_template, user_data_dir, symlinks=True,
+                    ignore=shutil.ignore_patterns(*_CHROME_PROFILE_RUNTIME_FILES))
+    return user_data_dir
+
+
+def remove_user_data_dir(user_data_dir):
+    """ 删除 copy_user_data_dir 复制出来的目录，连同它外面那一层临时目录。"""
+    shutil.rmtree(os.path.dirname(user_data_dir), ignore_errors=True)
+
+
+def seed_user_data_dir_template(user_data_dir_template, seed_urls=(), chrome_driver_path=None, is_use_headless=True):
+    """
+    准备用户数据目录模板：用这个目录启动一次 chrome ，打开 seed_urls 让 chrome 初始化好配置、写入缓存和cookie，然后退出。
+    也可以不用这个函数，自己手动用 chrome --user-data-dir=模板目录 登录网站、安装插件后关闭浏览器。
+    """
+    options = webdriver.ChromeOptions()
+    options.add_argument(f'--user-data-dir={user_data_dir_template}')
+    options.add_argument('--no-sandbox')
+    if is_use_headless:
+        options.add_argument('--headless')
+        options.add_argument('--disable-gpu')
+    driver = webdriver.Chrome(get_chrome_driver_path(chrome_driver_path), chrome_options=options)
+    try:
+        for url in seed_urls:
+            driver.get(url)
+    finally:
+        driver.quit()
+    return user_data_dir_template
+
+
+def process_tree_memory_mb(pid):
+    """ 进程和它所有子进程的常驻内存之和(MB)。浏览器的内存大部分在渲染进程、gpu进程这些子进程里。没有安装 psutil 或者进程不存在返回 None 。"""
+    if psutil is None:
+        return None
+    try:
+        main_process = psutil.Process(pid)
+        processes = [main_process] + main_process.children(recursive=True)
+    except psutil.Error:
+        return None
+    rss = 0
+    for p in processes:
+        try:
+            rss += p.memory_info().rss
+        except psutil.Error:  # 子进程可能刚好退出了
+            pass
+    return rss / 1024 / 1024
+
 
 class WebDriverOperator(AbstractObject):
     error_type_list_set_not_available = [NoSuchWindowException, URLError]
 
     # 如果出现了这些错误，会自动把对象标记为不可用，会重新生成。
-    def __init__(self, driver_klass=webdriver.Chrome, is_open_picture=True, is_use_mobile_ua=False, is_use_headless=False, **selenium_driver_kwargs):
+    def __init__(self, driver_klass=webdriver.Chrome, is_open_picture=True, is_use_mobile_ua=False, is_use_headless=False,
+                 chrome_driver_path=None, user_data_dir_template=None, user_data_dir_root=None, window_size=None,
+                 is_reset_on_return=True, is_clear_cookies_on_return=True, max_memory_mb=None, **selenium_driver_kwargs):
+        """
+        :param chrome_driver_path: 本地 chromedriver 路径，离线使用，见 get_chrome_driver_path
+        :param user_data_dir_template: chrome 用户数据目录模板，每个浏览器启动前复制一份，带着模板里面的登录状态、缓存、插件启动，见 seed_user_data_dir_template 。
+                                       不传则和以前一样每次使用全新的临时用户目录。
+        :param user_data_dir_root: 复制出来的用户数据目录放在哪个目录下面，默认是系统临时目录
+        :param window_size: 例如 (1920, 1080) ，通过启动参数设置窗口大小，省掉一次 maximize_window 请求，无头模式下 maximize_window 也不起作用。不传则和以前一样最大化窗口。
+        :param is_reset_on_return: 归还时关闭借用者多开的窗口、清空cookie和storage(chrome 清空借用期间访问过的所有域名的，其他浏览器只能清空当前页面域名的)、打开 about:blank ，
+                                   下一个借用者拿到的是干净的浏览器，状态和页面不会越积越多拖慢浏览器。
+        :param is_clear_cookies_on_return: 重置时是否清空cookie和storage，用 user_data_dir_template 保存了登录状态的要设置为False 。
+        :param max_memory_mb: 浏览器所有进程的常驻内存超过这么多MB时 validate 返回False ，需要安装 psutil 。
+                              对象池设置 validate_policy=ValidatePolicy.BACKGROUND 就会在后台定时检查空闲的浏览器，内存过大的摧毁重建，不在借用者的请求路径上。
+        """
+        if max_memory_mb is not None and psutil is None:
+            raise ImportError('按内存回收浏览器需要安装 psutil ，pip install psutil')
+        self._is_reset_on_return = is_reset_on_return
+        self._is_clear_cookies_on_return = is_clear_cookies_on_return
+        self._max_memory_mb = max_memory_mb
         self._is_open_picture = is_open_picture
+        self._chrome_driver_path = chrome_driver_path
+        self._user_data_dir_template = user_data_dir_template
+        self._user_data_dir_root = user_data_dir_root
+        self._window_size = window_size
+        self.user_data_dir = None
         self._is_use_headless = is_use_headless
         self._is_use_mobile_ua = is_use_mobile_ua
         self._selenium_driver_kwargs = selenium_driver_kwargs
@@ -41,10 +158,11 @@ class WebDriverOperator(AbstractObject):
         else:
             raise ValueError(f'driver_klass 设置的不正确')
         self.core_obj = self.driver = driver
+        self._main_window_handle = driver.current_window_handle
         self.logger = nb_log.get_logger(self.__class__.__name__)
 
     def _create_a_chrome_driver(self):
-        driver_path = ChromeDriverManager().install()  # webdriver_manager 包可以自动下载安装chrome驱动，比较方便，不需要自己指定路径。
+        driver_path = get_chrome_driver_path(self._chrome_driver_path)
         options = webdriver.ChromeOptions()
         # options.add_argument(r"user-data-dir=C:\Users\Administrator\AppData\Local\Google\Chrome\User Data")
         # add_argument()方法里填你Chrome浏览器保存Cookies的路径。
@@ -69,10 +187,25 @@ class WebDriverOperator(AbstractObject):
         if not self._is_open_picture:
             options.add_argument('--disable-images')
             options.add_argument('blink-settings=imagesEnabled=false')  # 这句禁用图片才能生效，上面两个禁用图片没起到效果。
-        driver = webdriver.Chrome(driver_path, chrome_options=options, **self._selenium_driver_kwargs)
-        driver.maximize_window()
+        if self._window_size:
+            options.add_argument(f'--window-size={self._window_size[0]},{self._window_size[1]}')
+        if self._user_data_dir_template:
+            self.user_data_dir = copy_user_data_dir(self._user_data_dir_template, self._user_data_dir_root)
+            options.add_argument(f'--user-data-dir={self.user_data_dir}')
+        try:
+            driver = webdriver.Chrome(driver_path, chrome_options=options, **self._selenium_driver_kwargs)
+        except BaseException:
+            self._remove_user_data_dir()
+            raise
+        if not self._window_size:
+            driver.maximize_window()
         return driver
 
+    def _remove_user_data_dir(self):
+        if self.user_data_dir:
+            remove_user_data_dir(self.user_data_dir)
+            self.user_data_dir = None
+
     def _create_a_phantomjs_driver(self):
         capabilities = DesiredCapabilities.PHANTOMJS.copy()
         capabilities['platform'] = "WINDOWS"
@@ -92,20 +225,410 @@ class WebDriverOperator(AbstractObject):
     """ 下面3个是重写的方法"""
 
     def clean_up(self):  # 如果一个对象长时间内没被使用，那么对象池会自动将对象摧毁并从池中删除，会自动调用对象的clean_up方法。
-        self.driver.quit()
+        try:
+            self.driver.quit()
+        finally:
+            self._remove_user_data_dir()
 
     def before_back_to_queue(self, exc_type, exc_val, exc_tb):
-        pass
+        if not self._is_reset_on_return or self.__dict__.get('is_available') is False:
+            return
+        try:
+            self.reset()
+        except Exception as e:  # 重置不了的浏览器状态不可控，不再借出
+            self.logger.warning(f'重置浏览器出错，摧毁它 {e}')
+            self._set_not_available()
+
+    def reset(self):
+        """ 关闭多开的窗口，清空cookie和storage，打开空白页。每一步都是一次 webdriver 请求，比重新创建浏览器快几个数量级。"""
+        driver = self.driver
+        is_clear_by_cdp = self._is_clear_cookies_on_return and hasattr(driver, 'execute_cdp_cmd')
+        origins = set()
+        for handle in driver.window_handles:
+            if handle != self._main_window_handle or is_clear_by_cdp:
+                driver.switch_to.window(handle)
+            if is_clear_by_cdp:
+                origins.update(self._get_visited_origins())  # 关闭窗口之前收集，关闭后就查不到这个窗口访问过哪些域名了
+            if handle != self._main_window_handle:
+                driver.close()
+        driver.switch_to.window(self._main_window_handle)
+        if self._is_clear_cookies_on_return:
+            try:
+                # sessionStorage 属于标签页，下面的 CDP 命令清不掉，只能在当前页面清除当前域名的
+                driver.execute_script('window.localStorage.clear(); window.sessionStorage.clear();')
+            except WebDriverException:
+                pass  # about:blank data: 这类页面没有 storage ，访问会报 SecurityError
+            if is_clear_by_cdp:
+                self._clear_browser_data_by_cdp(origins)
+            else:
+                driver.delete_all_cookies()  # 只能删除当前域名的cookie
+        driver.get('about:blank')
+
+    def _get_visited_origins(self) -> set:
+        """
+        当前窗口这次借用期间访问过的域名。CDP 没有通配所有域名的 origin ，Storage.clearDataForOrigin 只能一个一个域名地清空，
+        所以从这个标签页的前进后退历史和当前页面的所有 iframe 收集。
+        """
+        origins = set()
+        try:
+            history = self.driver.execute_cdp_cmd('Page.getNavigationHistory', {})
+            frame_trees = [self.driver.execute_cdp_cmd('Page.getFrameTree', {})['frameTree']]
+        except WebDriverException as e:
+            self.logger.warning(f'通过 CDP 获取访问过的域名出错 {e}')
+            return origins
+        for entry in history['entries']:
+            parts = urlsplit(entry['url'])
+            if parts.scheme in ('http', 'https') and parts.netloc:
+                origins.add(f'{parts.scheme}://{parts.netloc.rpartition("@")[2].lower()}')
+        while frame_trees:
+            frame_tree = frame_trees.pop()
+            origin = frame_tree['frame'].get('securityOrigin', '')
+            if origin.startswith(('http://', 'https://')):
+                origins.add(origin)
+            frame_trees.extend(frame_tree.get('childFrames', []))
+        return origins
+
+    def _clear_browser_data_by_cdp(self, origins):
+        """ 清空每个访问过的域名的 localStorage indexeddb cache_storage service_workers 等，以及所有cookie和http缓存。出错只记录日志，不摧毁浏览器。"""
+        try:
+            for origin in sorted(origins):
+                self.driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+            self.driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+            self.driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+        except WebDriverException as e:
+            self.logger.warning(f'通过 CDP 清空浏览器数据出错 {e}')
+
+    def memory_mb(self):
+        """ 浏览器所有进程的常驻内存，chromedriver/phantomjs 服务进程的子进程就是浏览器进程。没有安装 psutil 返回 None 。"""
+        service = getattr(self.driver, 'service', None)
+        if service is None or getattr(service, 'process', None) is None:
+            return None
+        return process_tree_memory_mb(service.process.pid)
+
+    def validate(self):
+        if self.driver.current_window_handle is None:  # 浏览器被关闭或者崩溃了会抛出异常
+            return False
+        if self._max_memory_mb is not None:
+            memory_mb = self.memory_mb()
+            if memory_mb is not None and memory_mb > self._max_memory_mb:
+                self.logger.info(f'浏览器占用内存 {round(memory_mb)} MB ，超过 {self._max_memory_mb} MB')
+                return False
+        return True
 
     """以下可以自定义其他方法。
     因为设置了self.core_obj = self.driver ，父类重写了__getattr__,所以此对象自动拥有driver对象的所有方法,如果是同名同意义的方法不需要一个个重写。
     """
 
 
+"""
+标签页级别的池化。WebDriverOperator 每个对象是一个完整的chrome进程，几百MB内存，所以对象池大小只能设置很小，并发打开网页的数量受内存限制。
+ChromeTabPool 只启动少量 chrome 进程，每个 chrome 开多个标签页，借用的单位是一个标签页：
+每个标签页是一个通过 debuggerAddress 连接到同一个 chrome 的 webdriver 会话，会话只操作自己的标签页，所以多个线程可以同时在同一个浏览器里打开不同网页。
+同一个浏览器的标签页共享cookie和缓存，需要隔离登录状态的场景还是要用不同的浏览器，即 WebDriverOperator 。
+"""
+
+
+def _find_chrome_binary():
+    for name in ('google-chrome', 'google-chrome-stable', 'chromium', 'chromium-browser', 'chrome'):
+        path = shutil.which(name)
+        if path:
+            return path
+    for path in (r'C:\Program Files\Google\Chrome\Application\chrome.exe', r'C:\Program Files (x86)\Google\Chrome\Application\chrome.exe',
+                 '/Applications/Google Chrome.app/Contents/MacOS/Google Chrome'):
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError('没有找到 chrome 浏览器，请传 chrome_binary_path')
+
+
+class ChromeBrowser(nb_log.LoggerMixin):
+    """ 一个开启了远程调试端口的 chrome 进程，和一个它的所有标签页共用的 chromedriver 服务。由 ChromeTabPool 创建和关闭。"""
+
+    def __init__(self, chrome_binary_path=None, chrome_driver_path=None, is_use_headless=True, user_data_dir_template=None,
+                 user_data_dir_root=None, chrome_args=(), start_timeout=30):
+        self._chrome_binary_path = chrome_binary_path
+        self._chrome_driver_path = chrome_driver_path
+        self._is_use_headless = is_use_headless
+        self._user_data_dir_template = user_data_dir_template
+        self._user_data_dir_root = user_data_dir_root
+        self._chrome_args = list(chrome_args)
+        self._start_timeout = start_timeout
+        self._start_lock = threading.Lock()
+        self._start_error = None
+        self.tab_lock = threading.Lock()  # 同一个浏览器里面新开标签页要串行，靠打开前后 window_handles 的差集找到自己的标签页
+        self.process = None  # type: typing.Optional[subprocess.Popen]
+        self.service = None  # type: typing.Optional[Service]
+        self.user_data_dir = None
+        self.debugger_address = None
+        # 下面这些在 ChromeTabPool 的 _browser_lock 内修改
+        self.tab_num = 0
+        self.use_num = 0
+        self.is_retired = False  # 内存太大或者使用次数太多，不再开新标签页，最后一个标签页关闭后退出浏览器
+        self.last_memory_check_time = 0
+
+    def ensure_started(self):
+        """ 第一个在这个浏览器开标签页的线程启动浏览器，同时开标签页的其他线程等它启动完成。"""
+        with self._start_lock:
+            if self._start_error is not None:
+                raise self._start_error
+            if self.process is None:
+                try:
+                    self._start()
+                except BaseException as e:
+                    self._start_error = e
+                    self.is_retired = True
+                    self.quit()
+                    raise
+
+    def _start(self):
+        t0 = time.time()
+        if self._user_data_dir_template:
+            self.user_data_dir = copy_user_data_dir(self._user_data_dir_template, self._user_data_dir_root)
+        else:
+            # 和复制模板时一样放在临时目录下面的子目录，退出时统一用 remove_user_data_dir 删除
+            self.user_data_dir = os.path.join(tempfile.mkdtemp(prefix='chrome_user_data_', dir=self._user_data_dir_root), 'profile')
+            os.mkdir(self.user_data_dir)
+        args = [self._chrome_binary_path or _find_chrome_binary(), f'--user-data-dir={self.user_data_dir}', '--remote-debugging-port=0',
+                '--no-first-run', '--no-default-browser-check', '--no-sandbox']
+        if self._is_use_headless:
+            args += ['--headless', '--disable-gpu']
+        args += self._chrome_args + ['about:blank']
+        self.process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # 端口传0由chrome自己选空闲端口，启动后写在用户数据目录的 DevToolsActivePort 文件第一行，不会有多个浏览器抢同一个端口的问题。
+        port_file = os.path.join(self.user_data_dir, 'DevToolsActivePort')
+        while True:
+            if os.path.isfile(port_file):
+                with open(port_file) as f:
+                    port = f.readline().strip()
+                if port:
+                    break
+            if self.process.poll() is not None:
+                raise RuntimeError(f'chrome 启动失败，退出码 {self.process.returncode}')
+            if time.time() - t0 > self._start_timeout:
+                raise TimeoutError(f'chrome 超过 {self._start_timeout} 秒没有启动完成')
+            time.sleep(0.05)
+        self.debugger_address = f'127.0.0.1:{port}'
+        self.service = Service(get_chrome_driver_path(self._chrome_driver_path))
+        self.service.start()
+        self.logger.info(f'启动浏览器 {self.debugger_address} ,耗时 {round(time.time() - t0, 3)}')
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def memory_mb(self):
+        """ chrome 主进程和所有子进程(渲染进程、gpu进程等)的常驻内存之和，没有安装 psutil 返回 None 。"""
+        if not self.is_alive():
+            return None
+        return process_tree_memory_mb(self.process.pid)
+
+    def quit(self):
+        if self.service is not None:
+            try:
+                self.service.stop()
+            except Exception as e:
+                self.logger.warning(f'停止 chromedriver 出错 {e}')
+            self.service = None
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.logger.info(f'关闭浏览器 {self.debugger_address}')
+        if self.user_data_dir:
+            remove_user_data_dir(self.user_data_dir)
+            self.user_data_dir = None
+
+
+class ChromeTabOperator(AbstractObject):
+    """ ChromeTabPool 借出的对象，一个标签页。和 WebDriverOperator 一样，可以直接调用 driver 的方法。"""
+    error_type_list_set_not_available = [NoSuchWindowException, URLError]
+
+    def __init__(self, tab_pool: 'ChromeTabPool', open_tab_timeout=10):
+        # noinspection PyProtectedMember
+        self.browser = tab_pool._acquire_browser_for_new_tab()
+        self._tab_pool = tab_pool
+        self.driver = None
+        try:
+            options = webdriver.ChromeOptions()
+            options.add_experimental_option('debuggerAddress', self.browser.debugger_address)
+            self.driver = webdriver.Remote(command_executor=self.browser.service.service_url, desired_capabilities=options.to_capabilities())
+            with self.browser.tab_lock:
+                old_handles = set(self.driver.window_handles)
+                self.driver.execute_script('window.open("about:blank", "_blank");')
+                t0 = time.time()
+                while True:
+                    new_handles = set(self.driver.window_handles) - old_handles
+                    if new_handles:
+                        break
+                    if time.time() - t0 > open_tab_timeout:
+                        raise TimeoutError(f'超过 {open_tab_timeout} 秒没有打开新标签页')
+                    time.sleep(0.02)
+                self.driver.switch_to.window(new_handles.pop())
+        except BaseException:
+            if self.driver is not None:
+                self.driver.quit()
+            # noinspection PyProtectedMember
+            tab_pool._on_tab_closed(self.browser)
+            raise
+        self.core_obj = self.driver
+        self.logger = nb_log.get_logger(self.__class__.__name__)
+
+    def clean_up(self):
+        try:
+            self.driver.close()  # 只关闭自己的标签页
+            self.driver.quit()  # 通过 debuggerAddress 连接的会话退出时不会关闭浏览器
+        finally:
+            # noinspection PyProtectedMember
+            self._tab_pool._on_tab_closed(self.browser)
+
+    def before_back_to_queue(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def validate(self):
+        return not self.browser.is_retired and self.browser.is_alive() and self.driver.current_window_handle is not None
+
+
+class ChromeTabPool(ObjectPool):
+    def __init__(self, max_browser_num=2, tabs_per_browser=8, chrome_binary_path=None, chrome_driver_path=None, is_use_headless=True,
+                 user_data_dir_template=None, user_data_dir_root=None, chrome_args=(), open_tab_timeout=10,
+                 max_browser_memory_mb=None, memory_check_interval_seconds=10, max_browser_uses=None, **pool_kwargs):
+        """
+        对象池大小是 max_browser_num * tabs_per_browser 。一个浏览器的标签页全部关闭(例如空闲超时被摧毁)后退出这个 chrome ，
+        需要一直保持浏览器启动着可以设置 min_idle 。
+        :param max_browser_num: 最多同时运行几个 chrome 进程，一般设置成cpu核数附近
+        :param tabs_per_browser: 每个 chrome 最多开几个标签页
+        :param chrome_binary_path: chrome 可执行文件路径，不传则自动查找
+        :param chrome_driver_path: 见 get_chrome_driver_path
+        :param user_data_dir_template: 见 WebDriverOperator
+        :param chrome_args: 其他 chrome 启动参数，例如 ['--blink-settings=imagesEnabled=false']
+        :param max_browser_memory_mb: 一个 chrome 所有进程的常驻内存超过这么多MB后不再开新标签页，已有的标签页归还后关闭，
+                                      最后一个标签页关闭后退出这个chrome，需要的时候再启动新的chrome。需要安装 psutil 。
+        :param memory_check_interval_seconds: 每个浏览器最多每隔多少秒检查一次内存，在标签页归还时检查
+        :param max_browser_uses: 一个 chrome 的标签页累计被借用这么多次后按上面同样的方式回收这个 chrome ，不需要 psutil 。
+        :param pool_kwargs: ObjectPool 的其他参数，例如 max_idle_seconds min_idle
+        """
+        if max_browser_memory_mb is not None and psutil is None:
+            raise ImportError('按内存回收浏览器需要安装 psutil ，pip install psutil')
+        self._max_browser_num = max_browser_num
+        self._tabs_per_browser = tabs_per_browser
+        self._browser_kwargs = dict(chrome_binary_path=chrome_binary_path, chrome_driver_path=chrome_driver_path, is_use_headless=is_use_headless,
+                                    user_data_dir_template=user_data_dir_template, user_data_dir_root=user_data_dir_root, chrome_args=chrome_args)
+        self._max_browser_memory_mb = max_browser_memory_mb
+        self._memory_check_interval_seconds = memory_check_interval_seconds
+        self._max_browser_uses = max_browser_uses
+        self._browsers = []  # type: typing.List[ChromeBrowser]
+        self._browser_lock = threading.Lock()
+        super().__init__(ChromeTabOperator, dict(tab_pool=self, open_tab_timeout=open_tab_timeout),
+                         object_pool_size=max_browser_num * tabs_per_browser, **pool_kwargs)
+
+    def _acquire_browser_for_new_tab(self) -> ChromeBrowser:
+        """ 新标签页开在标签页最少的浏览器里，所有浏览器都有标签页了并且浏览器数量没达到上限就启动一个新浏览器，让页面渲染分散到多个进程。"""
+        with self._browser_lock:
+            for browser in self._browsers:
+                if browser.process is not None and not browser.is_alive():
+                    browser.is_retired = True  # 浏览器崩溃了
+            live_browsers = [browser for browser in self._browsers if not browser.is_retired]
+            candidates = [browser for browser in live_browsers if browser.tab_num < self._tabs_per_browser]
+            browser = min(candidates, key=lambda b: b.tab_num) if candidates else None
+            if len(live_browsers) < self._max_browser_num and (browser is None or browser.tab_num > 0):
+                browser = ChromeBrowser(**self._browser_kwargs)
+                self._browsers.append(browser)
+            elif browser is None:
+                browser = min(live_browsers, key=lambda b: b.tab_num)
+            browser.tab_num += 1
+        try:
+            browser.ensure_started()
+        except BaseException:
+            self._on_tab_closed(browser)
+            raise
+        return browser
+
+    def _on_tab_closed(self, browser: ChromeBrowser):
+        # 最后一个标签页关闭后就退出浏览器，不管有没有回收。标签页都因为空闲超时被摧毁了，说明这个浏览器也闲置了，不能让 chrome 进程一直留着。
+        # 新开标签页在 _browser_lock 内先把 tab_num 加1，所以这里减到0时没有线程正在往这个浏览器开标签页。
+        with self._browser_lock:
+            browser.tab_num -= 1
+            is_quit = browser.tab_num == 0
+            if is_quit:
+                browser.is_retired = True
+                self._browsers.remove(browser)
+        if is_quit:
+            browser.quit()
+
+    def _check_browser_retire(self, browser: ChromeBrowser):
+        """ 标签页归还时调用，返回这个浏览器是否已经回收了。"""
+        with self._browser_lock:
+            if browser.is_retired:
+                return True
+            browser.use_num += 1
+            if self._max_browser_uses is not None and browser.use_num >= self._max_browser_uses:
+                browser.is_retired = True
+                self._pool_logger.info('浏览器 %s 标签页累计借用 %s 次，回收这个浏览器', browser.debugger_address, browser.use_num)
+                return True
+            now = time.time()
+            is_check_memory = self._max_browser_memory_mb is not None and now - browser.last_memory_check_time >= self._memory_check_interval_seconds
+            if is_check_memory:
+                browser.last_memory_check_time = now
+        if is_check_memory:
+            memory_mb = browser.memory_mb()
+            if memory_mb is not None and memory_mb > self._max_browser_memory_mb:
+                with self._browser_lock:
+                    browser.is_retired = True
+                self._pool_logger.info('浏览器 %s 占用内存 %s MB ，回收这个浏览器', browser.debugger_address, round(memory_mb))
+                return True
+        return False
+
+    def _try_acquire_locked(self):
+        """ 优先借出正在被使用的标签页最少的浏览器中的空闲标签页。"""
+        if self._idle_objects:
+            idle_num_per_browser = collections.Counter(tab.browser for tab in self._idle_objects)
+            tab = min(reversed(self._idle_objects),
+                      key=lambda t: (t.browser.is_retired, t.browser.tab_num - idle_num_per_browser[t.browser]))  # 同样负载时取最近归还的
+            self._idle_objects.remove(tab)
+            return tab
+        return super()._try_acquire_locked()
+
+    def _is_need_validate_on_borrow(self, obj: ChromeTabOperator):
+        return obj.browser.is_retired or not obj.browser.is_alive() or super()._is_need_validate_on_borrow(obj)
+
+    def _is_need_recycle(self, obj: ChromeTabOperator):
+        return super()._is_need_recycle(obj) or self._check_browser_retire(obj.browser)
+
+    def _back_a_object(self, obj: ChromeTabOperator):
+        super()._back_a_object(obj)
+        if obj.browser.is_retired:
+            self._destroy_idle_tabs_of_retired_browsers()
+
+    def _destroy_idle_tabs_of_retired_browsers(self):
+        with self._lock:
+            tabs = [tab for tab in self._idle_objects if tab.browser.is_retired]
+            for tab in tabs:
+                self._idle_objects.remove(tab)
+            self._has_create_object_num -= len(tabs)
+            self._on_objects_leave_pool_locked(tabs)
+            self._dispatch_to_waiters_locked()
+        for tab in tabs:
+            self._destroy_object(tab)
+
+    def stats(self) -> dict:
+        ret = super().stats()
+        with self._browser_lock:
+            browsers = list(self._browsers)
+        ret['browsers'] = [dict(debugger_address=b.debugger_address, tab_num=b.tab_num, use_num=b.use_num, is_retired=b.is_retired,
+                                memory_mb=b.memory_mb()) for b in browsers]
+        return ret
+
+
 if __name__ == '__main__':
+    # 先准备一次模板目录，以后每个浏览器都从模板复制，不用每次冷启动一个全新的用户目录。
+    template_dir = os.path.join(tempfile.gettempdir(), 'chrome_user_data_template')
+    if not os.path.exists(template_dir):
+        seed_user_data_dir_template(template_dir, seed_urls=['https://www.autohome.com.cn/news/'])
     driver_pool = ObjectPool(object_type=WebDriverOperator,
-                             object_init_kwargs=dict(driver_klass=webdriver.Chrome, is_use_mobile_ua=False, ),
-                             object_pool_size=2, max_idle_seconds=60)
+                             object_init_kwargs=dict(driver_klass=webdriver.Chrome, is_use_mobile_ua=False,
+                                                     user_data_dir_template=template_dir, window_size=(1920, 1080),
+                                                     max_memory_mb=1500 if psutil else None),
+                             object_pool_size=2, max_idle_seconds=60, validate_policy=ValidatePolicy.BACKGROUND)
 
 
     def test_open_page(url):
@@ -121,4 +644,21 @@ if __name__ == '__main__':
             thread_pool.submit(test_open_page, urlx)
             # thread_pool.submit(test_update_multi_threads_use_one_conn, x)
         thread_pool.shutdown()
+
+    # 2个浏览器进程，每个开10个标签页，可以同时打开20个网页，内存只有20个浏览器的零头。
+    tab_pool = ChromeTabPool(max_browser_num=2, tabs_per_browser=10, max_browser_memory_mb=2000 if psutil else None, max_browser_uses=500)
+
+
+    def test_open_page_in_tab(url):
+        with tab_pool.get(timeout=60) as tab:  # type: typing.Union[webdriver.Chrome,ChromeTabOperator]
+            tab.get(url)
+            tab.save_screenshot(f'tab_{int(time.time() * 1000)}.png')
+
+
+    thread_pool = BoundedThreadPoolExecutor(20)
+    with decorator_libs.TimerContextManager():
+        for p in range(1, 40):
+            thread_pool.submit(test_open_page_in_tab, f'https://www.autohome.com.cn/news/{p}/#liststart')
+        thread_pool.shutdown()
+    print(tab_pool.stats()['browsers'])
     time.sleep(1000)
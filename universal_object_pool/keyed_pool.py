@@ -0,0 +1,286 @@
+import collections
+import logging
+import queue
+import threading
+import time
+import typing
+
+import decorator_libs
+import nb_log
+
+from universal_object_pool import _ObjectContext, _BorrowWaiter, _CREATE_PERMIT, _disabled_logger
+from universal_object_pool.clean_up_executor import CleanUpExecutor, get_default_clean_up_executor
+from universal_object_pool.pool_stats import PoolStats, stats_to_prometheus_text
+
+"""
+按key借用对象的对象池，例如http爬虫要请求几千个host，每个host一个key，所有key共用一个总容量上限和一个后台清理线程。
+不需要给每个host都实例化一个 ObjectPool(每个都有自己的清理线程和固定的大小)。
+
+with keyed_pool.get(key=('10.0.0.5', 80)) as conn:
+    ...
+"""
+
+
+class _KeyState:
+    __slots__ = ('idle_objects', 'waiters', 'total_num', 'creating_num', 'using_num')
+
+    def __init__(self):
+        self.idle_objects = collections.deque()
+        self.waiters = collections.deque()  # type: typing.Deque[_BorrowWaiter]
+        self.total_num = 0  # 包括正在创建中的
+        self.creating_num = 0
+        self.using_num = 0
+
+
+class KeyedObjectPool(nb_log.LoggerMixin, nb_log.LoggerLevelSetterMixin):
+    def __init__(self, object_type, object_init_kwargs_func: typing.Callable[[typing.Hashable], dict] = None,
+                 object_init_kwargs: dict = None, max_num_per_key=10, max_total_num=100, max_idle_seconds=30 * 60,
+                 max_concurrent_create_num_per_key=5, cleanup_interval_seconds=10, cleanup_batch_size=None,
+                 clean_up_executor: CleanUpExecutor = None, clean_up_timeout=None,
+                 log_level=20, is_pool_log_enabled=True):
+        """
+        :param object_type: 对象类型，将会实例化此类
+        :param object_init_kwargs_func: 根据key返回这个key的对象的初始化参数字典。不传则key必须是元组，作为位置参数，例如 HttpOperator(*('10.0.0.5', 80))
+        :param object_init_kwargs: 所有key共用的初始化参数
+        :param max_num_per_key: 每个key最多多少个对象
+        :param max_total_num: 所有key加起来最多多少个对象。达到上限时，会摧毁所有key里面最久没被使用的空闲对象，腾出名额。
+        :param max_idle_seconds: 最大空闲时间，大于次时间没被使用的对象，将会被自动摧毁和弹出。
+        :param max_concurrent_create_num_per_key: 每个key最多同时有几个线程在创建对象。
+        :param cleanup_interval_seconds: 每隔多少秒检查一次空闲超时的对象，所有key共用这一个线程。
+        :param cleanup_batch_size: 每次检查最多摧毁多少个空闲超时的对象，None 表示不限制。
+        :param clean_up_executor: 摧毁对象用的有界线程池，不传则用默认共用的。
+        :param clean_up_timeout: 每个对象的 clean_up 最多等待多少秒，None 表示一直等待。
+        :param log_level: 对象池内部日志的级别。
+        :param is_pool_log_enabled: 为False则完全关闭对象池内部日志。
+        """
+        self.object_type = object_type
+        self._object_init_kwargs_func = object_init_kwargs_func
+        self._object_init_kwargs = {} if object_init_kwargs is None else object_init_kwargs
+        self._max_num_per_key = max_num_per_key
+        self._max_total_num = max_total_num
+        self._max_idle_seconds = max_idle_seconds
+        self._max_concurrent_create_num_per_key = max(1, max_concurrent_create_num_per_key)
+        self._cleanup_batch_size = cleanup_batch_size
+        self._clean_up_executor = clean_up_executor or get_default_clean_up_executor()
+        self._clean_up_timeout = clean_up_timeout
+        self._lock = threading.Lock()  # 所有key共用一把锁，跨key淘汰空闲对象时不会死锁，锁内只做簿记。
+        self._key_states = {}  # type: typing.Dict[typing.Hashable, _KeyState]
+        self._keys_with_waiters = collections.OrderedDict()  # 有借用者在排队的key，空出总名额时按顺序分配
+        self._lru_idle_objects = collections.OrderedDict()  # id(obj) -> obj ，所有key的空闲对象按归还时间排序，左边最久
+        self._total_num = 0
+        self._stats = PoolStats()
+        self.logger.setLevel(log_level)
+        self._pool_logger = self.logger if is_pool_log_enabled else _disabled_logger
+        decorator_libs.keep_circulating(cleanup_interval_seconds, block=False, daemon=True)(self._check_and_cleanup_objects)()
+
+    def _create_object(self, key):
+        t1 = time.perf_counter()
+        is_success = False
+        try:
+            if self._object_init_kwargs_func is None:
+                obj = self.object_type(*key, **self._object_init_kwargs)
+            else:
+                obj = self.object_type(**self._object_init_kwargs, **self._object_init_kwargs_func(key))
+            obj.the_obj_pool_key = key
+            is_success = True
+            self._stats.on_create(time.perf_counter() - t1, True)
+            self._pool_logger.info('创建对象 %s key为 %s ,耗时 %s', obj, key, round(time.perf_counter() - t1, 3))
+            return obj
+        finally:
+            to_be_destroy_objects = []
+            with self._lock:
+                st = self._key_states[key]
+                st.creating_num -= 1
+                if not is_success:  # 创建失败，还回名额
+                    st.total_num -= 1
+                    st.using_num -= 1
+                    self._total_num -= 1
+                self._dispatch_key_waiters_locked(key, to_be_destroy_objects)
+                if not is_success:
+                    self._dispatch_all_waiting_keys_locked(to_be_destroy_objects)
+                    self._forget_key_if_empty_locked(key)
+            if not is_success:
+                self._stats.on_create(time.perf_counter() - t1, False)
+            self._destroy_objects(to_be_destroy_objects)
+
+    def _destroy_objects(self, objs):
+        for obj in objs:
+            self._stats.on_destroy()
+            self._clean_up_executor.submit(obj, self._clean_up_timeout)
+
+    def _remove_idle_locked(self, obj):
+        del self._lru_idle_objects[id(obj)]
+        st = self._key_states[obj.the_obj_pool_key]
+        st.idle_objects.remove(obj)
+        st.total_num -= 1
+        self._total_num -= 1
+        self._forget_key_if_empty_locked(obj.the_obj_pool_key)
+
+    def _forget_key_if_empty_locked(self, key):
+        st = self._key_states.get(key)
+        if st is not None and st.total_num == 0 and not st.waiters:  # 几千个host的key用完就删，不然字典越来越大
+            del self._key_states[key]
+
+    def _try_acquire_locked(self, key, st: _KeyState, to_be_destroy_objects: list):
+        if st.idle_objects:
+            obj = st.idle_objects.pop()
+            del self._lru_idle_objects[id(obj)]
+            return obj
+        if st.total_num >= self._max_num_per_key or st.creating_num >= self._max_concurrent_create_num_per_key:
+            return None
+        if self._total_num >= self._max_total_num:
+            if not self._lru_idle_objects:
+                return None
+            # 总数达到上限，摧毁别的key里面最久没用的空闲对象腾出名额。这个key没有空闲对象，所以一定是别的key的。
+            lru_obj = next(iter(self._lru_idle_objects.values()))
+            self._remove_idle_locked(lru_obj)
+            to_be_destroy_objects.append(lru_obj)
+        st.total_num += 1
+        st.creating_num += 1
+        self._total_num += 1
+        return _CREATE_PERMIT
+
+    def _dispatch_key_waiters_locked(self, key, to_be_destroy_objects: list):
+        st = self._key_states.get(key)
+        if st is None:
+            return
+        while st.waiters:
+            ret = self._try_acquire_locked(key, st, to_be_destroy_objects)
+            if ret is None:
+                break
+            waiter = st.waiters.popleft()
+            if ret is _CREATE_PERMIT:
+                waiter.is_permit_create = True
+            else:
+                waiter.obj = ret
+            waiter.condition.notify()
+        if not st.waiters:
+            self._keys_with_waiters.pop(key, None)
+
+    def _dispatch_all_waiting_keys_locked(self, to_be_destroy_objects: list):
+        """ 空出了总名额或者有了可以淘汰的空闲对象，其他因为总数上限而排队的key可能可以创建对象了。"""
+        for key in list(self._keys_with_waiters):
+            self._dispatch_key_waiters_locked(key, to_be_destroy_objects)
+
+    def _wait_in_line_locked(self, key, st: _KeyState, timeout):
+        waiter = _BorrowWaiter(self._lock)
+        st.waiters.append(waiter)
+        self._keys_with_waiters[key] = None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while waiter.obj is None and not waiter.is_permit_create:
+            if deadline is None:
+                waiter.condition.wait()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    st.waiters.remove(waiter)
+                    if not st.waiters:
+                        self._keys_with_waiters.pop(key, None)
+                        self._forget_key_if_empty_locked(key)
+                    return None
+                waiter.condition.wait(remaining)
+        return _CREATE_PERMIT if waiter.is_permit_create else waiter.obj
+
+    def _borrow_a_object(self, key, block, timeout):
+        t0 = time.perf_counter()
+        to_be_destroy_objects = []
+        try:
+            with self._lock:
+                st = self._key_states.get(key)
+                if st is None:
+                    st = self._key_states[key] = _KeyState()
+                ret = None
+                if not st.waiters:
+                    ret = self._try_acquire_locked(key, st, to_be_destroy_objects)
+                if ret is None and block and (timeout is None or timeout > 0):
+                    ret = self._wait_in_line_locked(key, st, timeout)
+                if ret is None:
+                    self._forget_key_if_empty_locked(key)
+                    raise queue.Empty
+                st.using_num += 1
+            self._destroy_objects(to_be_destroy_objects)
+            obj = self._create_object(key) if ret is _CREATE_PERMIT else ret
+            obj.the_obj_borrow_time = time.perf_counter()
+            self._stats.on_borrow(obj.the_obj_borrow_time - t0)
+            if self._pool_logger.isEnabledFor(logging.DEBUG):
+                self._pool_logger.debug('获取对象 %s key为 %s', obj, key)
+            return obj
+        except queue.Empty as e:
+            self._stats.on_borrow_timeout()
+            self._pool_logger.critical('%s  key %s 暂时没有可用的对象了，请把timeout加大、或者把 max_num_per_key max_total_num 加大',
+                                       e, key, exc_info=True)
+            raise e
+        except Exception as e:
+            self._pool_logger.critical(e, exc_info=True)
+            raise e
+
+    def _back_a_object(self, obj):
+        key = obj.the_obj_pool_key
+        is_invalidate = getattr(obj, 'is_available', None) is False
+        self._stats.on_back(time.perf_counter() - getattr(obj, 'the_obj_borrow_time', time.perf_counter()), is_invalidate)
+        to_be_destroy_objects = [obj] if is_invalidate else []
+        with self._lock:
+            st = self._key_states[key]
+            st.using_num -= 1
+            if is_invalidate:
+                st.total_num -= 1
+                self._total_num -= 1
+            else:
+                obj.the_obj_last_use_time = time.time()
+                st.idle_objects.append(obj)
+                self._lru_idle_objects[id(obj)] = obj
+            self._dispatch_key_waiters_locked(key, to_be_destroy_objects)
+            self._dispatch_all_waiting_keys_locked(to_be_destroy_objects)
+            self._forget_key_if_empty_locked(key)
+        if is_invalidate:
+            self._pool_logger.critical('%s 不可用,不放入', obj)
+        elif self._pool_logger.isEnabledFor(logging.DEBUG):
+            self._pool_logger.debug('归还对象 %s key为 %s', obj, key)
+        self._destroy_objects(to_be_destroy_objects)
+
+    def _check_and_cleanup_objects(self):
+        to_be_destroy_objects = []
+        with self._lock:
+            expire_time = time.time() - self._max_idle_seconds
+            while self._lru_idle_objects:
+                obj = next(iter(self._lru_idle_objects.values()))
+                if obj.the_obj_last_use_time >= expire_time:
+                    break
+                if self._cleanup_batch_size is not None and len(to_be_destroy_objects) >= self._cleanup_batch_size:
+                    break
+                self._remove_idle_locked(obj)
+                to_be_destroy_objects.append(obj)
+            if to_be_destroy_objects:
+                self._dispatch_all_waiting_keys_locked(to_be_destroy_objects)
+        for obj in to_be_destroy_objects:
+            self._pool_logger.info('此对象空闲时间超过 %s  秒，自动摧毁%s', self._max_idle_seconds, obj)
+        self._destroy_objects(to_be_destroy_objects)
+
+    def get(self, key, block=True, timeout=None):
+        return _KeyedObjectContext(self, key, block=block, timeout=timeout)
+
+    def stats(self) -> dict:
+        ret = self._stats.to_dict()
+        with self._lock:
+            ret.update(idle_num=len(self._lru_idle_objects), total_num=self._total_num,
+                       using_num=sum(st.using_num for st in self._key_states.values()),
+                       waiting_num=sum(len(st.waiters) for st in self._key_states.values()),
+                       object_pool_size=self._max_total_num, key_num=len(self._key_states))
+        ret['clean_up_executor'] = self._clean_up_executor.stats()
+        return ret
+
+    def to_prometheus_text(self, pool_name=None) -> str:
+        return stats_to_prometheus_text(self.stats(), pool_name or self.object_type.__name__)
+
+
+# noinspection PyProtectedMember
+class _KeyedObjectContext(_ObjectContext):
+    def __init__(self, pool: KeyedObjectPool, key, block, timeout):
+        super().__init__(pool, block, timeout)  # noqa
+        self._key = key
+
+    def __enter__(self):
+        self.obj = self._pool._borrow_a_object(self._key, self._block, self._timeout)
+        self.obj.is_available = True
+        self.obj.before_use()
+        return self.obj
@@ -0,0 +1,113 @@
+import inspect
+import time
+
+from universal_object_pool import ObjectPool, ValidatePolicy, _CREATE_PERMIT
+
+"""
+共享借用的对象池。ObjectPool 的对象是独占的，一个对象同一时间只借给一个借用者。
+有些对象可以安全的同时被几个线程使用，例如一个 amqpstorm 连接上每个线程开自己的 channel ，独占使用太浪费连接数。
+
+对象的类属性 max_concurrent_borrowers 声明最多同时借给几个借用者。借用时优先借给当前借用者最少的对象，
+所有对象都满了才创建新对象，这样socket连接数可以少好几倍。
+
+对象是共享的，任何一个借用者调用 _set_not_available 后对象马上停止借出，等最后一个借用者归还后摧毁。
+不能只靠归还时检查 is_available ，因为别的借用者借出时会把它重新设置为 True 。
+"""
+
+
+class MultiplexObjectPool(ObjectPool):
+    def __init__(self, *args, **kwargs):
+        validate_policy = inspect.signature(ObjectPool.__init__).bind(self, *args, **kwargs).arguments.get('validate_policy')
+        if validate_policy != ValidatePolicy.NONE:
+            # 对象可能正在被别的借用者使用，检查不通过也不能直接摧毁，所以不支持任何 validate_policy 。
+            raise ValueError('MultiplexObjectPool 的对象可能同时被多个借用者使用，不支持 validate_policy ，'
+                             '请在出错时调用对象的 _set_not_available 或者设置 error_type_list_set_not_available')
+        self._all_objects = []  # 所有可以借出的对象，包括正在被借用的。父类 __init__ 里面就会预热创建对象和启动清理线程，所以要先赋值。
+        super().__init__(*args, **kwargs)
+
+    def _create_object(self):
+        obj = super()._create_object()
+        obj.the_obj_borrower_num = 0
+        obj.the_obj_is_retired = False  # 不可用或者到期了，不再借出，等最后一个借用者归还后摧毁
+        obj.the_obj_on_set_not_available = self._retire
+        return obj
+
+    def _on_created_object_to_idle_locked(self, obj):
+        super()._on_created_object_to_idle_locked(obj)
+        self._all_objects.append(obj)  # 放进空闲队列的同时才能被别人借到，否则可能借到一个既不在空闲队列也没人借用的对象
+
+    def _retire_locked(self, obj):
+        """ 停止借出这个对象，必须在持有 self._lock 时调用。返回 False 表示之前已经停止借出了。"""
+        if obj.the_obj_is_retired:
+            return False
+        obj.the_obj_is_retired = True
+        self._all_objects.remove(obj)
+        self._has_create_object_num -= 1
+        if obj.the_obj_borrower_num == 0:
+            self._idle_objects.remove(obj)
+        self._dispatch_to_waiters_locked()
+        return True
+
+    def _retire(self, obj):
+        """ 对象的 _set_not_available 被调用时马上停止借出，不等到归还。"""
+        with self._lock:
+            is_first_retire = self._retire_locked(obj)
+            is_destroy = is_first_retire and obj.the_obj_borrower_num == 0
+        if is_first_retire:
+            self._pool_logger.critical('%s 不可用,不再借出', obj)
+            self._start_fill_to_min_idle_in_background()
+        if is_destroy:
+            self._destroy_object(obj)
+
+    def _occupy_locked(self, obj):
+        if obj.the_obj_borrower_num == 0:
+            self._idle_objects.remove(obj)
+        obj.the_obj_borrower_num += 1
+
+    def _try_acquire_locked(self):
+        least_loaded_obj = None
+        for obj in self._all_objects:
+            if obj.the_obj_borrower_num < obj.max_concurrent_borrowers and \
+                    (least_loaded_obj is None or obj.the_obj_borrower_num < least_loaded_obj.the_obj_borrower_num):
+                least_loaded_obj = obj
+                if obj.the_obj_borrower_num == 0:
+                    break
+        if least_loaded_obj is not None:
+            self._occupy_locked(least_loaded_obj)
+            return least_loaded_obj
+        if self._has_create_object_num < self.object_pool_size and self._creating_num < self._max_concurrent_create_num:
+            self._has_create_object_num += 1
+            self._creating_num += 1
+            return _CREATE_PERMIT
+        return None
+
+    def _on_borrow_created_object_locked(self, obj):
+        self.is_using_num += 1
+        obj.the_obj_borrower_num += 1
+        self._all_objects.append(obj)
+
+    def _on_objects_leave_pool_locked(self, objs):
+        for obj in objs:
+            self._all_objects.remove(obj)
+
+    def _back_a_object(self, obj):
+        is_invalidate = obj.__dict__.get('is_available') is False
+        self._stats.on_back(time.perf_counter() - getattr(obj, 'the_obj_borrow_time', time.perf_counter()), is_invalidate)
+        if is_invalidate:
+            self._retire(obj)  # 一般 _set_not_available 时已经停止借出了，这里兜底直接给 is_available 赋值 False 的情况
+        is_recycle = not obj.the_obj_is_retired and self._is_need_recycle(obj)
+        with self._lock:
+            obj.the_obj_borrower_num -= 1
+            self.is_using_num -= 1
+            is_first_retire = is_recycle and self._retire_locked(obj)
+            is_destroy = obj.the_obj_is_retired and obj.the_obj_borrower_num == 0
+            if not obj.the_obj_is_retired and obj.the_obj_borrower_num == 0:
+                obj.the_obj_last_use_time = time.time()
+                self._idle_objects.append(obj)
+            self._dispatch_to_waiters_locked()
+        if is_first_retire:
+            self._stats.on_recycle()
+            self._pool_logger.info('%s 达到最大存活时间或者最大使用次数，不再借出', obj)
+            self._start_fill_to_min_idle_in_background()
+        if is_destroy:
+            self._destroy_object(obj)
@@ -0,0 +1,126 @@
+import bisect
+import threading
+import typing
+
+"""
+对象池的运行指标，借用等待耗时、占用耗时、创建耗时直方图，超时次数、失效次数、检查不可用次数、到期回收次数、创建和摧毁次数。
+可以根据这些数据来设置 object_pool_size ，以及在借用超时之前就发现对象池不够用了。
+"""
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+
+class Histogram:
+    """ 固定分桶的直方图，只记录每个桶的次数和总和，不保存每个样本，内存占用固定。"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)  # 最后一个是 +Inf 桶
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> dict:
+        cumulative = []
+        total = 0
+        for c in self.bucket_counts:
+            total += c
+            cumulative.append(total)
+        return dict(count=self.count, sum=self.sum,
+                    buckets=dict(zip([str(b) for b in self.buckets] + ['+Inf'], cumulative)))
+
+
+class PoolStats:
+    """ 所有的修改都在 self._lock 内进行，多线程下计数准确。"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._lock = threading.Lock()
+        self.borrow_wait_seconds = Histogram(buckets)
+        self.hold_seconds = Histogram(buckets)
+        self.create_seconds = Histogram(buckets)
+        self.borrow_num = 0
+        self.borrow_timeout_num = 0
+        self.invalidate_num = 0
+        self.validate_fail_num = 0
+        self.recycle_num = 0
+        self.create_num = 0
+        self.create_fail_num = 0
+        self.destroy_num = 0
+
+    def on_borrow(self, wait_seconds):
+        with self._lock:
+            self.borrow_num += 1
+            self.borrow_wait_seconds.observe(wait_seconds)
+
+    def on_borrow_timeout(self):
+        with self._lock:
+            self.borrow_timeout_num += 1
+
+    def on_back(self, hold_seconds, is_invalidate):
+        with self._lock:
+            self.hold_seconds.observe(hold_seconds)
+            if is_invalidate:
+                self.invalidate_num += 1
+
+    def on_validate_fail(self):
+        with self._lock:
+            self.validate_fail_num += 1
+
+    def on_recycle(self):
+        with self._lock:
+            self.recycle_num += 1
+
+    def on_create(self, create_seconds, is_success):
+        with self._lock:
+            if is_success:
+                self.create_num += 1
+                self.create_seconds.observe(create_seconds)
+            else:
+                self.create_fail_num += 1
+
+    def on_destroy(self, num=1):
+        with self._lock:
+            self.destroy_num += num
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return dict(borrow_num=self.borrow_num, borrow_timeout_num=self.borrow_timeout_num,
+                        invalidate_num=self.invalidate_num, validate_fail_num=self.validate_fail_num,
+                        recycle_num=self.recycle_num, create_num=self.create_num,
+                        create_fail_num=self.create_fail_num, destroy_num=self.destroy_num,
+                        borrow_wait_seconds=self.borrow_wait_seconds.to_dict(),
+                        hold_seconds=self.hold_seconds.to_dict(),
+                        create_seconds=self.create_seconds.to_dict(), )
+
+
+_GAUGE_KEYS = ('idle_num', 'using_num', 'total_num', 'waiting_num', 'object_pool_size')
+
+
+def stats_to_prometheus_text(stats: dict, pool_name: str, prefix='object_pool') -> str:
+    """
+    把 pool.stats() 的结果转成 Prometheus 文本格式，可以直接作为 /metrics 接口的返回内容。
+    :param stats: pool.stats() 的返回值
+    :param pool_name: 作为 pool 标签的值，区分同一个进程中的多个对象池
+    :param prefix: 指标名前缀
+    """
+    lines = []  # type: typing.List[str]
+    label = f'pool="{pool_name}"'
+    for key, value in stats.items():
+        name = f'{prefix}_{key}'
+        if isinstance(value, dict) and 'buckets' in value:
+            lines.append(f'# TYPE {name} histogram')
+            for le, cumulative_count in value['buckets'].items():
+                lines.append(f'{name}_bucket{{{label},le="{le}"}} {cumulative_count}')
+            lines.append(f'{name}_sum{{{label}}} {value["sum"]}')
+            lines.append(f'{name}_count{{{label}}} {value["count"]}')
+        elif isinstance(value, dict):  # 例如 clean_up_executor 的统计
+            for sub_key, sub_value in value.items():
+                lines.append(f'{name}_{sub_key}{{{label}}} {sub_value}')
+        elif isinstance(value, (int, float)):
+            lines.append(f'# TYPE {name} {"gauge" if key in _GAUGE_KEYS else "counter"}')
+            lines.append(f'{name}{{{label}}} {value}')
+    return '\n'.join(lines) + '\n'